@@ -0,0 +1,73 @@
+"""Size and parsing time of the payload descriptor of a very large payload.
+
+    python benchmarks/bench_payload_descriptor.py --blobs 100000
+
+The first version of the descriptor (indented json of the pydantic model) is
+compared to the compact encoding, which `push_payload` parses lazily.
+"""
+import argparse
+import hashlib
+import time
+
+from docker_charon.common import (
+    BlobLocationInRegistry,
+    BlobPathInZip,
+    PayloadDescriptor,
+)
+
+ZIP_BLOB_PATH_TEMPLATE = "blobs/{digest}"
+
+
+def make_payload_descriptor(number_of_blobs: int) -> PayloadDescriptor:
+    """A mirror-like payload, half of the blobs are already in the registry."""
+    manifests_paths = {}
+    blobs_paths = {}
+    for i in range(number_of_blobs):
+        digest = f"sha256:{hashlib.sha256(str(i).encode()).hexdigest()}"
+        if i % 2:
+            blobs_paths[digest] = BlobLocationInRegistry(repository=f"repo-{i % 500}")
+        else:
+            blobs_paths[digest] = BlobPathInZip(zip_path=f"blobs/{digest}")
+        if i % 10 == 0:
+            manifests_paths[f"repo-{i % 500}:{i}"] = f"manifests/repo-{i % 500}:{i}"
+    return PayloadDescriptor(manifests_paths=manifests_paths, blobs_paths=blobs_paths)
+
+
+def measure(function, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--blobs", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    payload_descriptor = make_payload_descriptor(args.blobs)
+    first_version = payload_descriptor.to_json(ZIP_BLOB_PATH_TEMPLATE)
+    compact = payload_descriptor.to_json(ZIP_BLOB_PATH_TEMPLATE, compact=True)
+    digests = list(payload_descriptor.blobs_paths)
+
+    def parse_and_read_all(content: str):
+        parsed = PayloadDescriptor.from_json(content)
+        for digest in digests:
+            parsed.blobs_paths[digest]
+
+    print(f"{args.blobs} blobs")
+    for name, content in [("first version", first_version), ("compact", compact)]:
+        parsing = measure(lambda: PayloadDescriptor.from_json(content), args.repeat)
+        reading = measure(lambda: parse_and_read_all(content), args.repeat)
+        print(
+            f"{name:>14}: {len(content) / 2**20:7.2f} MiB, "
+            f"parsed in {parsing * 1000:8.1f} ms, "
+            f"parsed and all blobs read in {reading * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
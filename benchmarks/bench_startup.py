@@ -0,0 +1,142 @@
+"""Startup time of the docker-charon command line.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --output results.json
+    python benchmarks/bench_startup.py --baseline results.json --tolerance 0.2
+
+Three commands are measured, each one in a new process:
+--help, which imports nothing but typer; inspect-payload, a cheap command
+which only reads the payload descriptor and the manifests; and make-payload
+of a single small image from a `FakeRegistry`, which imports everything.
+The --help of an empty typer app is measured too, it's as fast as --help
+can be.
+
+With --baseline, the command fails if a command is more than --tolerance
+slower than in the baseline.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from fake_registry import FakeRegistry
+from synthetic_images import SyntheticImages
+
+KiB = 2**10
+
+EMPTY_TYPER_APP = """
+import typer
+
+app = typer.Typer()
+app.command("first")(lambda: None)
+app.command("second")(lambda: None)
+app()
+"""
+
+
+@dataclass
+class Measure:
+    command: str
+    # seconds
+    fastest: float
+    median: float
+
+
+def time_process(name: str, command: list[str], runs: int) -> Measure:
+    run_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        run_times.append(time.perf_counter() - start)
+    return Measure(name, min(run_times), statistics.median(run_times))
+
+
+def time_command(arguments: list[str], runs: int) -> Measure:
+    return time_process(
+        arguments[0], [sys.executable, "-m", "docker_charon", *arguments], runs
+    )
+
+
+def measure_commands(directory: Path, runs: int) -> list[Measure]:
+    images = SyntheticImages(1, 2, 64 * KiB)
+    payload_path = directory / "payload.zip"
+    with FakeRegistry() as registry:
+        images.write_to(registry.content)
+        make_payload = [
+            "make-payload",
+            ",".join(images.get_docker_images()),
+            "--registry",
+            registry.host,
+            "--insecure",
+            "--file",
+            str(payload_path),
+        ]
+        return [
+            time_process(
+                "empty typer app",
+                [sys.executable, "-c", EMPTY_TYPER_APP, "--help"],
+                runs,
+            ),
+            time_command(["--help"], runs),
+            time_command(make_payload, runs),
+            time_command(["inspect-payload", "--file", str(payload_path)], runs),
+        ]
+
+
+def find_regressions(
+    measures: list[Measure], baseline: list[dict], tolerance: float
+) -> list[str]:
+    baseline = {measure["command"]: measure for measure in baseline}
+    regressions = []
+    for measure in measures:
+        reference = baseline.get(measure.command)
+        if reference is not None and measure.median > reference["median"] * (
+            1 + tolerance
+        ):
+            regressions.append(
+                f"{measure.command}: {measure.median:.3f} s > "
+                f"{reference['median']:.3f} s"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", type=Path, help="writes the results as json")
+    parser.add_argument("--baseline", type=Path, help="results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        measures = measure_commands(Path(directory), args.runs)
+    for measure in measures:
+        print(
+            f"{measure.command:>16}: fastest {measure.fastest * 1000:6.1f} ms, "
+            f"median {measure.median * 1000:6.1f} ms"
+        )
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps([asdict(measure) for measure in measures], indent=4)
+        )
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = find_regressions(measures, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
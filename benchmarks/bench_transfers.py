@@ -0,0 +1,244 @@
+"""Wall time, throughput and peak memory of make_payload and push_payload.
+
+    python benchmarks/bench_transfers.py
+    python benchmarks/bench_transfers.py --scenario high-latency --scale 4
+    python benchmarks/bench_transfers.py --output results.json
+    python benchmarks/bench_transfers.py --baseline results.json --tolerance 0.2
+    python benchmarks/bench_transfers.py --tls-cert cert.pem --tls-key key.pem
+
+The registries are `FakeRegistry` instances of this process, with synthetic
+images, so nothing is downloaded and the results don't depend on the network.
+Each measure runs in a new process, which only runs docker-charon, so that its
+peak RSS is the one of docker-charon alone.
+
+With --tls-cert and --tls-key, the registries use https and token
+authentication, like most real registries. The certificate must be valid for
+localhost, it's trusted through REQUESTS_CA_BUNDLE.
+
+With --baseline, the command fails if a wall time is more than --tolerance
+slower than in the baseline, or a peak RSS more than --tolerance bigger.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from fake_registry import FakeRegistry
+from synthetic_images import SyntheticImages
+
+import docker_charon
+
+KiB = 2**10
+MiB = 2**20
+USERNAME = "charon"
+PASSWORD = "benchmark"
+
+
+@dataclass
+class Scenario:
+    images: SyntheticImages
+    # seconds added to each request
+    latency: float = 0
+    # bytes per second, for each connection
+    bandwidth: Optional[float] = None
+    # above this, the registries answer 429
+    max_concurrent_requests: Optional[int] = None
+
+
+SCENARIOS = {
+    "many-small-layers": Scenario(SyntheticImages(20, 10, 256 * KiB, overlap=0.5)),
+    "few-big-layers": Scenario(SyntheticImages(3, 3, 32 * MiB, overlap=1 / 3)),
+    "high-latency": Scenario(SyntheticImages(10, 5, MiB, overlap=0.4), latency=0.05),
+    "limited-bandwidth": Scenario(
+        SyntheticImages(4, 4, 4 * MiB, overlap=0.25), bandwidth=20 * MiB
+    ),
+    "rate-limited": Scenario(
+        SyntheticImages(4, 8, 2 * MiB),
+        bandwidth=10 * MiB,
+        max_concurrent_requests=3,
+    ),
+}
+
+
+@dataclass
+class Measure:
+    scenario: str
+    operation: str
+    wall_time: float
+    # the blobs of the images, in MiB per second of wall time
+    throughput: float
+    # MiB
+    peak_rss: float
+
+
+def get_peak_rss() -> float:
+    # on linux, ru_maxrss keeps the peak of the parent process across fork and
+    # exec, which would be the one of the registries.
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / KiB
+    # bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / MiB
+
+
+def run_operation(operation: str, arguments: dict, results: multiprocessing.Queue):
+    start = time.perf_counter()
+    if operation == "make_payload":
+        docker_charon.make_payload(**arguments)
+    else:
+        docker_charon.push_payload(**arguments)
+    results.put((time.perf_counter() - start, get_peak_rss()))
+
+
+def measure(operation: str, arguments: dict) -> tuple[float, float]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(
+        target=run_operation, args=(operation, arguments, results)
+    )
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{operation} failed with exit code {process.exitcode}")
+    return results.get()
+
+
+def run_scenario(
+    name: str,
+    scenario: Scenario,
+    directory: Path,
+    tls_cert: Optional[str] = None,
+    tls_key: Optional[str] = None,
+) -> list[Measure]:
+    payload_path = directory / f"{name}.zip"
+    registry_arguments = dict(
+        latency=scenario.latency,
+        bandwidth=scenario.bandwidth,
+        max_concurrent_requests=scenario.max_concurrent_requests,
+    )
+    credentials = dict(secure=False)
+    if tls_cert is not None:
+        registry_arguments.update(
+            username=USERNAME, password=PASSWORD, certfile=tls_cert, keyfile=tls_key
+        )
+        credentials = dict(secure=True, username=USERNAME, password=PASSWORD)
+    source = FakeRegistry(**registry_arguments)
+    destination = FakeRegistry(**registry_arguments)
+    measures = []
+    with source, destination:
+        blobs_size = scenario.images.write_to(source.content)
+        operations = {
+            "make_payload": dict(
+                zip_file=payload_path,
+                docker_images_to_transfer=scenario.images.get_docker_images(),
+                registry=source.host,
+                **credentials,
+            ),
+            "push_payload": dict(
+                zip_file=payload_path, registry=destination.host, **credentials
+            ),
+        }
+        for operation, arguments in operations.items():
+            wall_time, peak_rss = measure(operation, arguments)
+            measures.append(
+                Measure(
+                    name, operation, wall_time, blobs_size / MiB / wall_time, peak_rss
+                )
+            )
+    payload_path.unlink()
+    return measures
+
+
+def scale_scenario(scenario: Scenario, scale: float) -> Scenario:
+    images = scenario.images
+    images = SyntheticImages(
+        images.images,
+        images.layers_per_image,
+        int(images.layer_size * scale),
+        images.overlap,
+        images.repository,
+        images.seed,
+    )
+    return Scenario(
+        images, scenario.latency, scenario.bandwidth, scenario.max_concurrent_requests
+    )
+
+
+def find_regressions(
+    measures: list[Measure], baseline: list[dict], tolerance: float
+) -> list[str]:
+    baseline = {
+        (measure["scenario"], measure["operation"]): measure for measure in baseline
+    }
+    regressions = []
+    for measure in measures:
+        reference = baseline.get((measure.scenario, measure.operation))
+        if reference is None:
+            continue
+        for metric in ("wall_time", "peak_rss"):
+            if getattr(measure, metric) > reference[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{measure.scenario} {measure.operation}: {metric} "
+                    f"{getattr(measure, metric):.2f} > {reference[metric]:.2f}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario", action="append", choices=list(SCENARIOS), dest="scenarios"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1, help="multiplies the size of the layers"
+    )
+    parser.add_argument("--output", type=Path, help="writes the results as json")
+    parser.add_argument("--baseline", type=Path, help="results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--tls-cert", help="enables https and token authentication")
+    parser.add_argument("--tls-key")
+    args = parser.parse_args()
+    if args.tls_cert is not None:
+        # inherited by the processes running docker-charon
+        os.environ["REQUESTS_CA_BUNDLE"] = args.tls_cert
+
+    measures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.scenarios or list(SCENARIOS):
+            scenario = scale_scenario(SCENARIOS[name], args.scale)
+            for measure in run_scenario(
+                name, scenario, Path(directory), args.tls_cert, args.tls_key
+            ):
+                print(
+                    f"{measure.scenario:>18} {measure.operation:>12}: "
+                    f"{measure.wall_time:7.2f} s, {measure.throughput:7.1f} MiB/s, "
+                    f"peak RSS {measure.peak_rss:7.1f} MiB"
+                )
+                measures.append(measure)
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps([asdict(measure) for measure in measures], indent=4)
+        )
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = find_regressions(measures, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""An in-process docker registry, good enough for docker-charon and dxf.
+
+It implements the endpoints of the registry API v2 which are used when pulling
+and pushing images: manifests, blobs, uploads (monolithic and chunked), cross
+repository mounts, tags, catalog and token authentication. Everything is kept
+in memory.
+
+Latency and bandwidth can be injected to look like a remote registry: each
+request waits `latency` seconds before being answered, and the bodies are sent
+and received at most at `bandwidth` bytes per second, for each connection.
+
+Rate limiting can be injected too: above `max_concurrent_requests` requests
+in flight, the registry answers 429 with a `Retry-After` header, like Docker Hub.
+
+Token authentication is only enabled with a username and a password. dxf
+always asks for the token over https, so a certificate is needed too.
+"""
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import re
+import secrets
+import ssl
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+# bodies are sent and received by pieces of this size when the bandwidth is limited
+THROTTLE_PIECE_SIZE = 2**16
+
+
+def get_digest(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+@dataclass
+class RegistryContent:
+    blobs: dict[str, bytes] = field(default_factory=dict)
+    # the blobs which are available in each repository
+    repositories_blobs: dict[str, set[str]] = field(default_factory=dict)
+    # (repository, tag or digest) -> (manifest, media type)
+    manifests: dict[tuple[str, str], tuple[bytes, str]] = field(default_factory=dict)
+    uploads: dict[str, bytearray] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_blob(self, repository: str, data: bytes) -> str:
+        digest = get_digest(data)
+        with self.lock:
+            self.blobs[digest] = data
+            self.repositories_blobs.setdefault(repository, set()).add(digest)
+        return digest
+
+    def has_blob(self, repository: str, digest: str) -> bool:
+        return digest in self.repositories_blobs.get(repository, set())
+
+    def set_manifest(
+        self, repository: str, reference: str, manifest: bytes, media_type: str
+    ) -> str:
+        digest = get_digest(manifest)
+        with self.lock:
+            self.manifests[repository, reference] = (manifest, media_type)
+            self.manifests[repository, digest] = (manifest, media_type)
+        return digest
+
+    def get_tags(self, repository: str) -> list[str]:
+        return sorted(
+            reference
+            for manifest_repository, reference in self.manifests
+            if manifest_repository == repository and not reference.startswith("sha256:")
+        )
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set by `FakeRegistry`
+    registry: FakeRegistry
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_HEAD(self):
+        self.route("HEAD")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.read_throttled(size)
+                self.rfile.readline()
+            return bytes(body)
+        return self.read_throttled(int(self.headers.get("Content-Length") or 0))
+
+    def read_throttled(self, size: int) -> bytes:
+        if self.registry.bandwidth is None:
+            return self.rfile.read(size)
+        body = bytearray()
+        while len(body) < size:
+            piece = self.rfile.read(min(THROTTLE_PIECE_SIZE, size - len(body)))
+            if not piece:
+                break
+            body += piece
+            time.sleep(len(piece) / self.registry.bandwidth)
+        return bytes(body)
+
+    def send(self, status: int, body: bytes = b"", headers: dict[str, str] = {}):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == "HEAD" or not body:
+            return
+        if self.registry.bandwidth is None:
+            self.wfile.write(body)
+            return
+        body = memoryview(body)
+        for start in range(0, len(body), THROTTLE_PIECE_SIZE):
+            piece = body[start : start + THROTTLE_PIECE_SIZE]
+            self.wfile.write(piece)
+            time.sleep(len(piece) / self.registry.bandwidth)
+
+    def send_json(self, status: int, content: dict, headers: dict[str, str] = {}):
+        headers = {"Content-Type": "application/json", **headers}
+        self.send(status, json.dumps(content).encode(), headers)
+
+    def is_authorized(self) -> bool:
+        if self.registry.username is None:
+            return True
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return False
+        return authorization[len("Bearer ") :] in self.registry.tokens
+
+    def send_token(self):
+        expected = base64.b64encode(
+            f"{self.registry.username}:{self.registry.password}".encode()
+        ).decode()
+        if self.headers.get("Authorization") != f"Basic {expected}":
+            return self.send_json(401, {"errors": [{"code": "UNAUTHORIZED"}]})
+        token = secrets.token_hex(16)
+        self.registry.tokens.add(token)
+        self.send_json(200, {"token": token, "access_token": token})
+
+    def route(self, method: str):
+        registry = self.registry
+        with registry.lock:
+            registry.requests_count += 1
+            registry.requests_in_flight += 1
+            throttled = (
+                registry.max_concurrent_requests is not None
+                and registry.requests_in_flight > registry.max_concurrent_requests
+            )
+            registry.throttled_requests_count += throttled
+        try:
+            if registry.latency:
+                time.sleep(registry.latency)
+            if throttled:
+                self.read_body()
+                return self.send_json(
+                    429,
+                    {"errors": [{"code": "TOOMANYREQUESTS"}]},
+                    {"Retry-After": str(registry.retry_after)},
+                )
+            self.dispatch(method)
+        finally:
+            with registry.lock:
+                registry.requests_in_flight -= 1
+
+    def dispatch(self, method: str):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path
+        if path == "/token":
+            return self.send_token()
+        if not self.is_authorized():
+            # the body of the request must be consumed to keep the connection usable
+            self.read_body()
+            challenge = (
+                f'Bearer realm="https://{self.registry.host}/token",'
+                f'service="fake-registry"'
+            )
+            return self.send_json(
+                401,
+                {"errors": [{"code": "UNAUTHORIZED"}]},
+                {"WWW-Authenticate": challenge},
+            )
+        if path == "/v2/":
+            return self.send_json(200, {})
+        if path == "/v2/_catalog":
+            repositories = sorted(
+                {repository for repository, _ in self.registry.content.manifests}
+            )
+            return self.send_json(200, {"repositories": repositories})
+        if match := re.match(r"^/v2/(.+)/blobs/uploads/([^/]*)$", path):
+            return self.route_upload(method, query, *match.groups())
+        if match := re.match(r"^/v2/(.+)/blobs/(sha256:[0-9a-f]{64})$", path):
+            return self.route_blob(*match.groups())
+        if match := re.match(r"^/v2/(.+)/manifests/([^/]+)$", path):
+            return self.route_manifest(method, *match.groups())
+        if match := re.match(r"^/v2/(.+)/tags/list$", path):
+            return self.route_tags(query, match.group(1))
+        self.send_json(404, {"errors": [{"code": "NOT_FOUND"}]})
+
+    def route_upload(self, method: str, query: dict, repository: str, upload_id: str):
+        content = self.registry.content
+        body = self.read_body()
+        if method == "POST":
+            if "mount" in query:
+                digest = query["mount"][0]
+                source_repository = query.get("from", [""])[0]
+                if content.has_blob(source_repository, digest):
+                    with content.lock:
+                        content.repositories_blobs.setdefault(repository, set()).add(
+                            digest
+                        )
+                    return self.send(201, headers={"Docker-Content-Digest": digest})
+            if "digest" in query:
+                return self.finish_upload(repository, query["digest"][0], body)
+            upload_id = str(uuid.uuid4())
+            content.uploads[upload_id] = bytearray(body)
+            return self.send(
+                202, headers={"Location": f"/v2/{repository}/blobs/uploads/{upload_id}"}
+            )
+        if upload_id not in content.uploads:
+            return self.send_json(404, {"errors": [{"code": "BLOB_UPLOAD_UNKNOWN"}]})
+        if method == "PATCH":
+            content.uploads[upload_id] += body
+            return self.send(
+                202, headers={"Location": f"/v2/{repository}/blobs/uploads/{upload_id}"}
+            )
+        if method == "PUT":
+            data = bytes(content.uploads.pop(upload_id)) + body
+            return self.finish_upload(repository, query["digest"][0], data)
+        self.send_json(405, {"errors": [{"code": "UNSUPPORTED"}]})
+
+    def finish_upload(self, repository: str, digest: str, data: bytes):
+        if get_digest(data) != digest:
+            return self.send_json(400, {"errors": [{"code": "DIGEST_INVALID"}]})
+        self.registry.content.add_blob(repository, data)
+        self.send(201, headers={"Docker-Content-Digest": digest})
+
+    def route_blob(self, repository: str, digest: str):
+        content = self.registry.content
+        if not content.has_blob(repository, digest):
+            return self.send_json(404, {"errors": [{"code": "BLOB_UNKNOWN"}]})
+        self.send(
+            200,
+            content.blobs[digest],
+            {
+                "Docker-Content-Digest": digest,
+                "Content-Type": "application/octet-stream",
+            },
+        )
+
+    def route_manifest(self, method: str, repository: str, reference: str):
+        content = self.registry.content
+        if method == "PUT":
+            manifest = self.read_body()
+            parsed = json.loads(manifest)
+            for blob in [parsed.get("config")] + parsed.get("layers", []):
+                if blob is not None and not content.has_blob(
+                    repository, blob["digest"]
+                ):
+                    return self.send_json(400, {"errors": [{"code": "BLOB_UNKNOWN"}]})
+            digest = content.set_manifest(
+                repository, reference, manifest, self.headers.get("Content-Type")
+            )
+            return self.send(201, headers={"Docker-Content-Digest": digest})
+        if (repository, reference) not in content.manifests:
+            return self.send_json(404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+        manifest, media_type = content.manifests[repository, reference]
+        self.send(
+            200,
+            manifest,
+            {"Docker-Content-Digest": get_digest(manifest), "Content-Type": media_type},
+        )
+
+    def route_tags(self, query: dict, repository: str):
+        tags = self.registry.content.get_tags(repository)
+        if last := query.get("last", [None])[0]:
+            tags = [tag for tag in tags if tag > last]
+        headers = {}
+        page_size = int(query.get("n", [0])[0] or 0)
+        if page_size and len(tags) > page_size:
+            tags = tags[:page_size]
+            headers["Link"] = (
+                f"</v2/{repository}/tags/list?n={page_size}&last={tags[-1]}>; "
+                f'rel="next"'
+            )
+        self.send_json(200, {"name": repository, "tags": tags}, headers)
+
+
+class FakeRegistry:
+    """A registry served by a thread of the current process.
+
+    Use it as a context manager, `host` is then the address to give to
+    docker-charon, with `secure=False` unless a certificate is given.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        bandwidth: Optional[float] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        certfile: Optional[str] = None,
+        keyfile: Optional[str] = None,
+        max_concurrent_requests: Optional[int] = None,
+        retry_after: float = 1,
+    ):
+        self.content = RegistryContent()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_concurrent_requests = max_concurrent_requests
+        self.retry_after = retry_after
+        self.username = username
+        self.password = password
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.tokens: set[str] = set()
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.requests_in_flight = 0
+        self.throttled_requests_count = 0
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def host(self) -> str:
+        return f"localhost:{self.server.server_address[1]}"
+
+    def __enter__(self) -> FakeRegistry:
+        handler = type("Handler", (RegistryHandler,), {"registry": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        if self.certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self.server.socket = context.wrap_socket(
+                self.server.socket, server_side=True
+            )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,99 @@
+"""Synthetic docker images, written directly in a `FakeRegistry`.
+
+The images of a scenario share a part of their layers, like images built
+from the same base image: with an overlap of 0.5, the first half of the layers
+of each image are the same for all the images.
+
+The layers are real gzipped tar files, with random (incompressible) content,
+so their size in the payload is their size in the registry.
+"""
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import random
+import tarfile
+from dataclasses import dataclass
+
+from fake_registry import RegistryContent
+
+MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+
+
+@dataclass
+class SyntheticImages:
+    images: int
+    layers_per_image: int
+    layer_size: int
+    # the fraction of the layers of each image shared by all the images
+    overlap: float = 0
+    repository: str = "synthetic"
+    seed: int = 0
+
+    def get_docker_images(self) -> list[str]:
+        return [f"{self.repository}:{i}" for i in range(self.images)]
+
+    def get_unique_layers_count(self) -> int:
+        shared_layers = self.get_shared_layers_count()
+        return shared_layers + self.images * (self.layers_per_image - shared_layers)
+
+    def get_shared_layers_count(self) -> int:
+        return round(self.layers_per_image * self.overlap)
+
+    def write_to(self, content: RegistryContent) -> int:
+        """Pushes the images to the registry, returns the size of all the blobs."""
+        generator = random.Random(self.seed)
+        shared_layers = [
+            make_layer(generator, self.layer_size)
+            for _ in range(self.get_shared_layers_count())
+        ]
+        total_size = sum(len(layer) for layer in shared_layers)
+        for docker_image in self.get_docker_images():
+            layers = shared_layers + [
+                make_layer(generator, self.layer_size)
+                for _ in range(self.layers_per_image - len(shared_layers))
+            ]
+            config = json.dumps({"docker_image": docker_image}).encode()
+            total_size += sum(len(layer) for layer in layers[len(shared_layers) :])
+            total_size += len(config)
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": MANIFEST_MEDIA_TYPE,
+                "config": {
+                    "mediaType": CONFIG_MEDIA_TYPE,
+                    "size": len(config),
+                    "digest": content.add_blob(self.repository, config),
+                },
+                "layers": [
+                    {
+                        "mediaType": LAYER_MEDIA_TYPE,
+                        "size": len(layer),
+                        "digest": content.add_blob(self.repository, layer),
+                    }
+                    for layer in layers
+                ],
+            }
+            _, tag = docker_image.split(":")
+            content.set_manifest(
+                self.repository,
+                tag,
+                json.dumps(manifest, indent=3).encode(),
+                MANIFEST_MEDIA_TYPE,
+            )
+        return total_size
+
+
+def make_layer(generator: random.Random, size: int) -> bytes:
+    tar_content = io.BytesIO()
+    with tarfile.open(fileobj=tar_content, mode="w") as archive:
+        tar_info = tarfile.TarInfo("data")
+        tar_info.size = size
+        archive.addfile(
+            tar_info,
+            io.BytesIO(generator.getrandbits(size * 8).to_bytes(size, "little")),
+        )
+    # level 1, random data isn't compressed anyway
+    return gzip.compress(tar_content.getvalue(), compresslevel=1, mtime=0)
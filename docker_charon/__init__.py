@@ -1,2 +1,54 @@
-from docker_charon.decoder import BlobNotFound, ManifestNotFound, push_payload
-from docker_charon.encoder import make_payload
+# The public API is imported on first use, so that the command line starts
+# without importing dxf, pydantic and requests when it doesn't need them.
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # also how PyInstaller finds the modules to bundle
+    from docker_charon.common import Registry
+    from docker_charon.decoder import (
+        BlobNotFound,
+        ManifestNotFound,
+        PushFailed,
+        inspect_payload,
+        iter_push_payload,
+        push_payload,
+        push_payload_to_registries,
+    )
+    from docker_charon.encoder import make_payload
+    from docker_charon.encryption import PayloadDecryptionError
+    from docker_charon.merge import merge_payloads
+    from docker_charon.profiling import profile
+    from docker_charon.registry_sync import sync
+    from docker_charon.watcher import watch
+
+MODULES_OF_PUBLIC_NAMES = {
+    "Registry": "docker_charon.common",
+    "BlobNotFound": "docker_charon.decoder",
+    "ManifestNotFound": "docker_charon.decoder",
+    "PushFailed": "docker_charon.decoder",
+    "inspect_payload": "docker_charon.decoder",
+    "iter_push_payload": "docker_charon.decoder",
+    "push_payload": "docker_charon.decoder",
+    "push_payload_to_registries": "docker_charon.decoder",
+    "make_payload": "docker_charon.encoder",
+    "PayloadDecryptionError": "docker_charon.encryption",
+    "merge_payloads": "docker_charon.merge",
+    "profile": "docker_charon.profiling",
+    "sync": "docker_charon.registry_sync",
+    "watch": "docker_charon.watcher",
+}
+
+__all__ = list(MODULES_OF_PUBLIC_NAMES)
+
+
+def __getattr__(name: str):
+    if name not in MODULES_OF_PUBLIC_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(MODULES_OF_PUBLIC_NAMES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
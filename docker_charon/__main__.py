@@ -2,32 +2,156 @@ import os
 import sys
 import tempfile
 from contextlib import contextmanager
+from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import typer
 
+# the modules of docker_charon, and their dependencies, are imported when a
+# command needs them, --help doesn't
 import docker_charon
 
 DOCKER_CHARON_USERNAME = "DOCKER_CHARON_USERNAME"
 DOCKER_CHARON_PASSWORD = "DOCKER_CHARON_PASSWORD"
+DOCKER_CHARON_SOURCE_USERNAME = "DOCKER_CHARON_SOURCE_USERNAME"
+DOCKER_CHARON_SOURCE_PASSWORD = "DOCKER_CHARON_SOURCE_PASSWORD"
+DOCKER_CHARON_ENCRYPTION_KEY = "DOCKER_CHARON_ENCRYPTION_KEY"
 
 app = typer.Typer()
 
 
+class ImagesOrder(str, Enum):
+    # docker_charon.decoder.IMAGES_ORDERS, not imported so that --help stays fast
+    payload = "payload"
+    smallest = "smallest"
+
+
+def check_max_bandwidth(max_bandwidth: Optional[str]) -> Optional[str]:
+    if max_bandwidth is not None:
+        from docker_charon.bandwidth import BandwidthLimit
+
+        try:
+            BandwidthLimit.parse(max_bandwidth)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return max_bandwidth
+
+
+def check_part(part: Optional[str]) -> Optional[str]:
+    if part is not None:
+        from docker_charon.common import PayloadPart
+
+        try:
+            PayloadPart.parse(part)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return part
+
+
+def check_max_payload_size(max_payload_size: Optional[str]) -> Optional[str]:
+    if max_payload_size is not None:
+        from docker_charon.bandwidth import parse_size
+
+        try:
+            parse_size(max_payload_size)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return max_payload_size
+
+
+def split_docker_images(docker_images: str) -> List[str]:
+    """A commas delimited list, or @FILE for a file with one docker image per line.
+    The empty lines and the lines starting with # are skipped."""
+    if not docker_images.startswith("@"):
+        return docker_images.strip().split(",")
+    path = Path(docker_images[1:])
+    if not path.is_file():
+        raise typer.BadParameter(f"{path} is not a file")
+    lines = [line.strip() for line in path.read_text().splitlines()]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def read_encryption_key(encryption_key_file: Optional[Path]) -> Optional[bytes]:
+    if encryption_key_file is not None:
+        # the editors add a newline at the end of the file
+        return encryption_key_file.read_bytes().rstrip(b"\r\n")
+    encryption_key = os.environ.get(DOCKER_CHARON_ENCRYPTION_KEY)
+    if encryption_key is not None:
+        return encryption_key.encode()
+    return None
+
+
+def manifest_cache_option() -> Optional[Path]:
+    return typer.Option(
+        None,
+        "--manifest-cache",
+        file_okay=False,
+        help="A directory where the manifests are kept between runs. The manifests "
+        "of the tags which didn't change are taken from there after a HEAD request, "
+        "which Docker Hub doesn't count in its pull rate limit.",
+    )
+
+
+def compact_descriptor_option() -> bool:
+    return typer.Option(
+        False,
+        "--compact-descriptor",
+        help="Write the payload descriptor in its compact encoding, smaller and "
+        "faster to read with many blobs. The payload can then only be pushed with "
+        "a version of docker-charon newer than 0.4.3.",
+    )
+
+
+def profile_option() -> Optional[Path]:
+    return typer.Option(
+        None,
+        "--profile",
+        dir_okay=False,
+        help="Profile the command and write the profile to this file, in the folded "
+        "format of flamegraph.pl (also read by speedscope and inferno). The samples "
+        "are split by phase: planning, transfer, zip write or zip read, and finalize.",
+    )
+
+
+@contextmanager
+def profiled(profile: Optional[Path]):
+    if profile is None:
+        yield
+        return
+    from docker_charon.profiling import profile as start_profiling
+
+    with start_profiling(profile):
+        yield
+
+
+def encryption_key_file_option(help: str) -> Optional[Path]:
+    return typer.Option(
+        None,
+        "--encryption-key-file",
+        exists=True,
+        dir_okay=False,
+        help=help + " You can also use the environment variable "
+        f"{DOCKER_CHARON_ENCRYPTION_KEY}.",
+    )
+
+
 @app.command()
 def make_payload(
     docker_images_to_transfer: str = typer.Argument(
         ...,
-        help="docker images to transfer, a commas delimited list of docker image names. "
-        "Do not include the registry name.",
+        help="docker images to transfer, a commas delimited list of docker image names, "
+        "or @FILE for a file with one docker image per line. Do not include the "
+        "registry name. Tags can be selected with patterns like 'python:3.12.*', "
+        "'python:>=3.11 <3.13' or 'nginx:#5' (the 5 highest tags).",
     ),
     already_transferred: Optional[str] = typer.Option(
         None,
         "--already-transferred",
         "-a",
         help="docker images already present in the remote registry, "
-        "a commas delimited list of docker image names. Do not include the registry name.",
+        "a commas delimited list of docker image names, or @FILE. Do not include the "
+        "registry name.",
     ),
     file: Optional[str] = typer.Option(
         None,
@@ -45,8 +169,8 @@ def make_payload(
     ),
     secure: bool = typer.Option(
         True,
-        "--insecure",
-        "-i",
+        " /--insecure",
+        " /-i",
         help="Use --insecure if the registry uses http instead of https",
         show_default=False,
     ),
@@ -66,6 +190,76 @@ def make_payload(
         f"security and don't want your password to appear in your shell "
         f"history, you can also use the environment variable {DOCKER_CHARON_PASSWORD}",
     ),
+    workers: int = typer.Option(
+        4,
+        "--workers",
+        "-w",
+        help="The number of blobs downloaded concurrently at the start, it's then "
+        "adjusted to the registry. Blobs are downloaded one at a time if the payload "
+        "is written to a pipe.",
+    ),
+    max_workers: Optional[int] = typer.Option(
+        None,
+        "--max-workers",
+        help="The maximum number of blobs downloaded concurrently. Defaults to 16. "
+        "Set it to --workers for a fixed number of concurrent downloads.",
+    ),
+    local_oci_layout: Optional[str] = typer.Option(
+        None,
+        "--local-oci-layout",
+        help="An OCI image layout directory, e.g. a previous payload. Blobs found "
+        "there are taken from it instead of being pulled from the registry.",
+    ),
+    docker_archives: Optional[str] = typer.Option(
+        None,
+        "--docker-archives",
+        help="A commas delimited list of uncompressed tar archives made by 'docker save', "
+        "or of OCI archives. The docker images found there are not pulled from the registry.",
+    ),
+    delta: bool = typer.Option(
+        False,
+        "--delta",
+        help="Store the layers which changed as binary patches against the layers of "
+        "the images given with --already-transferred, when possible.",
+    ),
+    dedup_chunks: bool = typer.Option(
+        False,
+        "--dedup-chunks",
+        help="Split the layers in chunks, one for each big file, and store each "
+        "chunk only once in the payload, when possible.",
+    ),
+    max_bandwidth: Optional[str] = typer.Option(
+        None,
+        "--max-bandwidth",
+        callback=check_max_bandwidth,
+        help="The maximum bandwidth of all the downloads together, e.g. '200MB/s'. "
+        "It can depend on the time of day: '09:00-18:00=50MB/s,200MB/s' limits "
+        "the downloads to 50MB/s during business hours and 200MB/s otherwise.",
+    ),
+    encryption_key_file: Optional[Path] = encryption_key_file_option(
+        "A file with a passphrase to encrypt the payload with AES-256-GCM while it's "
+        "written. Not available with --delta, --dedup-chunks or an OCI image layout."
+    ),
+    part: Optional[str] = typer.Option(
+        None,
+        "--part",
+        callback=check_part,
+        help="Build only a part of the payload, e.g. '2/4' on the second host out of "
+        "four. Each host pulls only the blobs of its part, with the same arguments. "
+        "The parts are then merged with merge-payloads.",
+    ),
+    max_payload_size: Optional[str] = typer.Option(
+        None,
+        "--max-payload-size",
+        callback=check_max_payload_size,
+        help="Split the images into several payloads of at most this size, e.g. "
+        "'500GB', each one can be pushed on its own. The images which share layers "
+        "are kept together. The payloads are written next to --file, which is "
+        "required: payload.zip becomes payload-1.zip, payload-2.zip...",
+    ),
+    manifest_cache: Optional[Path] = manifest_cache_option(),
+    compact_descriptor: bool = compact_descriptor_option(),
+    profile: Optional[Path] = profile_option(),
 ):
     """Create a payload (.zip file) with docker images inside. This zip file
     can then be unpacked into a registry in another system.
@@ -75,29 +269,76 @@ def make_payload(
     that were not already transferred.
 
     The payload is written to stdout by default. You can provide a file path to write the payload to
-    by using the --file (or -f) option.
+    by using the --file (or -f) option. If this path is an existing directory, the payload
+    is written there as an OCI image layout.
     """
-    docker_images_to_transfer = docker_images_to_transfer.strip().split(",")
+    docker_images_to_transfer = split_docker_images(docker_images_to_transfer)
     if already_transferred is None:
         already_transferred = []
     else:
-        already_transferred = already_transferred.strip().split(",")
+        already_transferred = split_docker_images(already_transferred)
+    if docker_archives is None:
+        docker_archives = []
+    else:
+        docker_archives = docker_archives.strip().split(",")
 
     # the user may want for security to pass credentials to docker-charon with env
     # variables.
     username = username or os.environ.get(DOCKER_CHARON_USERNAME)
     password = password or os.environ.get(DOCKER_CHARON_PASSWORD)
     if file is None:
+        if max_payload_size is not None:
+            raise typer.BadParameter(
+                "--file is required with --max-payload-size", param_hint="--file"
+            )
         file = sys.stdout.buffer
-    docker_charon.make_payload(
-        file,
-        docker_images_to_transfer,
-        already_transferred,
-        registry,
-        secure,
-        username,
-        password,
-    )
+    with profiled(profile):
+        docker_charon.make_payload(
+            file,
+            docker_images_to_transfer,
+            already_transferred,
+            registry,
+            secure,
+            username,
+            password,
+            workers,
+            local_oci_layout,
+            docker_archives,
+            delta,
+            dedup_chunks,
+            max_workers,
+            max_bandwidth,
+            read_encryption_key(encryption_key_file),
+            part,
+            max_payload_size,
+            manifest_cache,
+            compact_descriptor,
+        )
+
+
+@app.command()
+def merge_payloads(
+    parts: List[Path] = typer.Argument(
+        ...,
+        exists=True,
+        dir_okay=False,
+        help="The parts made with make-payload --part, all of them, in any order.",
+    ),
+    file: Path = typer.Option(
+        ...,
+        "--file",
+        "-f",
+        dir_okay=False,
+        help="The payload to create, a file since it can't be streamed.",
+    ),
+    compact_descriptor: bool = compact_descriptor_option(),
+):
+    """Merge the parts of a payload built on several hosts into a single payload.
+
+    The files in the parts are copied as they are, they are not compressed or hashed
+    again. The result can be pushed with push-payload like any other payload.
+    """
+    docker_charon.merge_payloads(parts, file, compact_descriptor)
 
 
 @contextmanager
@@ -124,7 +365,8 @@ def push_payload(
         None,
         "--file",
         "-f",
-        help="The payload zip file. If this is not provided, the payload will be read from stdin.",
+        help="The payload zip file, or the directory of a payload written as an OCI image layout. "
+        "If this is not provided, the payload will be read from stdin.",
     ),
     strict: bool = typer.Option(
         False,
@@ -133,64 +375,447 @@ def push_payload(
         help="Fails if there is a mismatch between what was given with --already-transferred "
         "and what is in the registry.",
     ),
-    registry: str = typer.Option(
-        "registry-1.docker.io",
+    registries: List[str] = typer.Option(
+        ["registry-1.docker.io"],
         "--registry",
         "-r",
-        help="The registry to push the payload to. It defaults to dockerhub (registry-1.docker.io)",
+        help="The registry to push the payload to. It defaults to dockerhub (registry-1.docker.io). "
+        "Repeat this option to push to several registries at once, the payload is then read only once.",
     ),
     secure: bool = typer.Option(
         True,
-        "--insecure",
-        "-i",
+        " /--insecure",
+        " /-i",
         help="Use --insecure if the registry uses http instead of https",
         show_default=False,
     ),
-    username: Optional[str] = typer.Option(
+    usernames: Optional[List[str]] = typer.Option(
         None,
         "--username",
         "-u",
         help=f"The username to use to connect to the registry. If you want more "
         f"security and don't want your username to appear in your shell "
-        f"history, you can also use the environment variable {DOCKER_CHARON_USERNAME}",
+        f"history, you can also use the environment variable {DOCKER_CHARON_USERNAME}. "
+        f"With several registries, give it once for all of them or once for each one.",
     ),
-    password: Optional[str] = typer.Option(
+    passwords: Optional[List[str]] = typer.Option(
         None,
         "--password",
         "-p",
         help=f"The password to use to connect to the registry. If you want more "
         f"security and don't want your password to appear in your shell "
-        f"history, you can also use the environment variable {DOCKER_CHARON_PASSWORD}",
+        f"history, you can also use the environment variable {DOCKER_CHARON_PASSWORD}. "
+        f"With several registries, give it once for all of them or once for each one.",
+    ),
+    only: Optional[str] = typer.Option(
+        None,
+        "--only",
+        help="Push only those docker images of the payload, in this order. "
+        "A commas delimited list of docker image names, or @FILE.",
+    ),
+    exclude: Optional[str] = typer.Option(
+        None,
+        "--exclude",
+        help="Do not push those docker images of the payload. "
+        "A commas delimited list of docker image names, or @FILE.",
     ),
+    order: ImagesOrder = typer.Option(
+        ImagesOrder.payload,
+        "--order",
+        help="'payload' pushes the images in the order of the payload (or of --only). "
+        "'smallest' pushes first the images which need the fewest bytes of the payload.",
+    ),
+    max_workers: Optional[List[int]] = typer.Option(
+        None,
+        "--max-workers",
+        help="The maximum number of blobs pushed concurrently, 16 by default. The actual "
+        "number adapts to the registry. With several registries, give it once for all of "
+        "them or once for each one.",
+    ),
+    max_bandwidth: Optional[str] = typer.Option(
+        None,
+        "--max-bandwidth",
+        callback=check_max_bandwidth,
+        help="The maximum bandwidth of all the pushes together, to all the registries, "
+        "e.g. '200MB/s'. It can depend on the time of day: "
+        "'09:00-18:00=50MB/s,200MB/s' limits the pushes to 50MB/s during business "
+        "hours and 200MB/s otherwise.",
+    ),
+    encryption_key_file: Optional[Path] = encryption_key_file_option(
+        "A file with the passphrase the payload was encrypted with."
+    ),
+    profile: Optional[Path] = profile_option(),
 ):
-    """Unpack the payload (.zip file) into a docker registry.
+    """Unpack the payload (.zip file) into a docker registry, or into several ones.
 
     The zip file must have been created by 'docker-charon make-payload ...'
 
     This command will output to stdout the list of images that were transferred.
-    One image per line.
+    One image per line, printed as soon as the image is in the registry.
 
     By default, the payload is read from stdin. You can provide a file path to read the payload from
     by using the --file (or -f) option.
     """
     # the user may want for security to pass credentials to docker-charon with env
     # variables.
-    username = username or os.environ.get(DOCKER_CHARON_USERNAME)
-    password = password or os.environ.get(DOCKER_CHARON_PASSWORD)
+    usernames = usernames or [os.environ.get(DOCKER_CHARON_USERNAME)]
+    passwords = passwords or [os.environ.get(DOCKER_CHARON_PASSWORD)]
+    max_workers = max_workers or [None]
+    for options in (usernames, passwords, max_workers):
+        if len(options) == 1:
+            options *= len(registries)
+        elif len(options) != len(registries):
+            raise typer.BadParameter(
+                "--username, --password and --max-workers must be given once, "
+                "or once for each --registry."
+            )
+    if only is not None:
+        only = split_docker_images(only)
+    if exclude is None:
+        exclude = []
+    else:
+        exclude = split_docker_images(exclude)
+    print("List of docker images pushed to the registry:", file=sys.stderr)
+
+    def print_image(docker_image: str) -> None:
+        print(docker_image, flush=True)
+
+    with open_file_or_stdin(file) as f, profiled(profile):
+        if len(registries) == 1:
+            docker_charon.push_payload(
+                f,
+                strict,
+                registries[0],
+                secure,
+                usernames[0],
+                passwords[0],
+                only,
+                exclude,
+                order.value,
+                on_image_pushed=print_image,
+                max_workers=max_workers[0],
+                max_bandwidth=max_bandwidth,
+                encryption_key=read_encryption_key(encryption_key_file),
+            )
+        else:
+            registries = [
+                docker_charon.Registry(
+                    host=registry,
+                    secure=secure,
+                    username=username,
+                    password=password,
+                    max_workers=registry_max_workers,
+                )
+                for registry, username, password, registry_max_workers in zip(
+                    registries, usernames, passwords, max_workers
+                )
+            ]
+            try:
+                docker_charon.push_payload_to_registries(
+                    f,
+                    registries,
+                    strict,
+                    only,
+                    exclude,
+                    order.value,
+                    on_image_pushed=print_image,
+                    max_bandwidth=max_bandwidth,
+                    encryption_key=read_encryption_key(encryption_key_file),
+                )
+            except docker_charon.PushFailed as e:
+                print(e, file=sys.stderr)
+                raise typer.Exit(code=1)
+
+
+@app.command()
+def inspect_payload(
+    file: Optional[str] = typer.Option(
+        None,
+        "--file",
+        "-f",
+        help="The payload zip file, or the directory of a payload written as an OCI image layout. "
+        "If this is not provided, the payload will be read from stdin.",
+    ),
+    encryption_key_file: Optional[Path] = encryption_key_file_option(
+        "A file with the passphrase the payload was encrypted with."
+    ),
+):
+    """List the docker images of a payload, with the number and the size of their blobs.
+
+    The blobs are not read, only the list of the files of the payload, the payload
+    descriptor and the manifests. Blobs shared by several images are counted for each one.
+    """
+    from tqdm import tqdm
+
     with open_file_or_stdin(file) as f:
-        images_pushed = docker_charon.push_payload(
-            f,
-            strict,
-            registry,
-            secure,
-            username,
-            password,
+        images = docker_charon.inspect_payload(
+            f, read_encryption_key(encryption_key_file)
         )
+    print("IMAGE\tBLOBS\tBLOBS IN PAYLOAD\tSIZE\tSIZE IN PAYLOAD")
+    for image in images:
+        if not image.in_payload:
+            print(f"{image.docker_image}\talready transferred")
+            continue
+        print(
+            f"{image.docker_image}\t{image.blobs}\t{image.blobs_in_payload}\t"
+            f"{tqdm.format_sizeof(image.size, 'B')}\t"
+            f"{tqdm.format_sizeof(image.size_in_payload, 'B')}"
+        )
+
+
+@app.command()
+def sync(
+    docker_images_to_transfer: str = typer.Argument(
+        ...,
+        help="docker images to transfer, a commas delimited list of docker image names, "
+        "or @FILE for a file with one docker image per line. Do not include the "
+        "registry name. Tags can be selected with patterns like 'python:3.12.*', "
+        "'python:>=3.11 <3.13' or 'nginx:#5' (the 5 highest tags).",
+    ),
+    already_transferred: Optional[str] = typer.Option(
+        None,
+        "--already-transferred",
+        "-a",
+        help="docker images already present in the destination registry, "
+        "a commas delimited list of docker image names, or @FILE. Do not include the "
+        "registry name.",
+    ),
+    source_registry: str = typer.Option(
+        "registry-1.docker.io",
+        "--source-registry",
+        help="The registry to pull the images from. It defaults to dockerhub (registry-1.docker.io)",
+    ),
+    source_secure: bool = typer.Option(
+        True,
+        " /--source-insecure",
+        help="Use --source-insecure if the source registry uses http instead of https",
+        show_default=False,
+    ),
+    source_username: Optional[str] = typer.Option(
+        None,
+        "--source-username",
+        help=f"The username to use to connect to the source registry. You can also "
+        f"use the environment variable {DOCKER_CHARON_SOURCE_USERNAME}",
+    ),
+    source_password: Optional[str] = typer.Option(
+        None,
+        "--source-password",
+        help=f"The password to use to connect to the source registry. You can also "
+        f"use the environment variable {DOCKER_CHARON_SOURCE_PASSWORD}",
+    ),
+    registry: str = typer.Option(
+        "registry-1.docker.io",
+        "--registry",
+        "-r",
+        help="The registry to push the images to. It defaults to dockerhub (registry-1.docker.io)",
+    ),
+    secure: bool = typer.Option(
+        True,
+        " /--insecure",
+        " /-i",
+        help="Use --insecure if the destination registry uses http instead of https",
+        show_default=False,
+    ),
+    username: Optional[str] = typer.Option(
+        None,
+        "--username",
+        "-u",
+        help=f"The username to use to connect to the destination registry. If you want more "
+        f"security and don't want your username to appear in your shell "
+        f"history, you can also use the environment variable {DOCKER_CHARON_USERNAME}",
+    ),
+    password: Optional[str] = typer.Option(
+        None,
+        "--password",
+        "-p",
+        help=f"The password to use to connect to the destination registry. If you want more "
+        f"security and don't want your password to appear in your shell "
+        f"history, you can also use the environment variable {DOCKER_CHARON_PASSWORD}",
+    ),
+    strict: bool = typer.Option(
+        False,
+        "--strict",
+        "-s",
+        help="Fails if an image given with --already-transferred is not in the "
+        "destination registry.",
+    ),
+    workers: int = typer.Option(
+        4,
+        "--workers",
+        "-w",
+        help="The number of blobs copied concurrently.",
+    ),
+    manifest_cache: Optional[Path] = manifest_cache_option(),
+    max_bandwidth: Optional[str] = typer.Option(
+        None,
+        "--max-bandwidth",
+        callback=check_max_bandwidth,
+        help="The maximum bandwidth of all the copies together, e.g. '200MB/s', "
+        "each blob is pulled and pushed at this rate. It can depend on the time of "
+        "day: '09:00-18:00=50MB/s,200MB/s' limits the copies to 50MB/s during "
+        "business hours and 200MB/s otherwise.",
+    ),
+):
+    """Copy docker images directly from a registry to another one.
+
+    No payload is written, the blobs are streamed from the source registry to
+    the destination registry. Use this when both registries are reachable
+    from the same machine.
+
+    This command will output to stdout the list of images that were transferred.
+    One image per line.
+    """
+    docker_images_to_transfer = split_docker_images(docker_images_to_transfer)
+    if already_transferred is None:
+        already_transferred = []
+    else:
+        already_transferred = split_docker_images(already_transferred)
+
+    source_username = source_username or os.environ.get(DOCKER_CHARON_SOURCE_USERNAME)
+    source_password = source_password or os.environ.get(DOCKER_CHARON_SOURCE_PASSWORD)
+    username = username or os.environ.get(DOCKER_CHARON_USERNAME)
+    password = password or os.environ.get(DOCKER_CHARON_PASSWORD)
+    images_pushed = docker_charon.sync(
+        docker_images_to_transfer,
+        already_transferred,
+        source_registry,
+        registry,
+        source_secure,
+        secure,
+        source_username,
+        source_password,
+        username,
+        password,
+        strict,
+        workers,
+        manifest_cache,
+        max_bandwidth,
+    )
     print("List of docker images pushed to the registry:", file=sys.stderr)
     for image in images_pushed:
         print(image)
 
 
+def check_duration(duration: Optional[str]) -> Optional[str]:
+    if duration is not None:
+        from docker_charon.watcher import parse_duration
+
+        try:
+            parse_duration(duration)
+        except ValueError as e:
+            raise typer.BadParameter(str(e))
+    return duration
+
+
+@app.command()
+def watch(
+    docker_images: str = typer.Argument(
+        ...,
+        help="docker images to watch, a commas delimited list of docker image names, "
+        "or @FILE for a file with one docker image per line. Do not include the "
+        "registry name.",
+    ),
+    store: Path = typer.Option(
+        ...,
+        "--store",
+        file_okay=False,
+        help="A directory where the new blobs are kept until they are in a payload, "
+        "with the state of the watch. Use the same one after a restart.",
+    ),
+    output_directory: Path = typer.Option(
+        ...,
+        "--output-dir",
+        "-o",
+        file_okay=False,
+        help="Where the payloads are written: payload-000001.zip, payload-000002.zip... "
+        "They must be pushed in this order.",
+    ),
+    registry: str = typer.Option(
+        "registry-1.docker.io",
+        "--registry",
+        "-r",
+        show_default=False,
+        help="The registry to watch. It defaults to dockerhub (registry-1.docker.io)",
+    ),
+    secure: bool = typer.Option(
+        True,
+        " /--insecure",
+        " /-i",
+        help="Use --insecure if the registry uses http instead of https",
+        show_default=False,
+    ),
+    username: Optional[str] = typer.Option(
+        None,
+        "--username",
+        "-u",
+        help=f"The username to use to connect to the registry. You can also use the "
+        f"environment variable {DOCKER_CHARON_USERNAME}",
+    ),
+    password: Optional[str] = typer.Option(
+        None,
+        "--password",
+        "-p",
+        help=f"The password to use to connect to the registry. You can also use the "
+        f"environment variable {DOCKER_CHARON_PASSWORD}",
+    ),
+    interval: str = typer.Option(
+        "5m",
+        "--interval",
+        callback=check_duration,
+        help="How often the tags are checked, e.g. '90s', '5m' or '1h'.",
+    ),
+    emit_every: Optional[str] = typer.Option(
+        None,
+        "--emit-every",
+        callback=check_duration,
+        help="Write a payload of the changes at most this often, e.g. '24h'.",
+    ),
+    emit_size: Optional[str] = typer.Option(
+        None,
+        "--emit-size",
+        callback=check_max_payload_size,
+        help="Write a payload as soon as the new blobs reach this size, e.g. '10GB'. "
+        "Without --emit-every and --emit-size, a payload is written as soon as "
+        "a tag changes.",
+    ),
+    workers: int = typer.Option(
+        4,
+        "--workers",
+        "-w",
+        help="The number of tags checked and of blobs downloaded concurrently.",
+    ),
+    max_bandwidth: Optional[str] = typer.Option(
+        None,
+        "--max-bandwidth",
+        callback=check_max_bandwidth,
+        help="The maximum bandwidth of all the downloads together, e.g. '200MB/s'.",
+    ),
+):
+    """Watch docker images, and write incremental payloads when their tags change.
+
+    The tags are checked with HEAD requests, which don't count in the rate limit of
+    Docker Hub. The new blobs are pulled as soon as a tag changes, and each payload
+    only has what changed since the previous one. The path of each payload is written
+    to stdout once it's complete.
+    """
+    from docker_charon.watcher import parse_duration
+
+    docker_charon.watch(
+        split_docker_images(docker_images),
+        store,
+        output_directory,
+        registry,
+        secure,
+        username or os.environ.get(DOCKER_CHARON_USERNAME),
+        password or os.environ.get(DOCKER_CHARON_PASSWORD),
+        parse_duration(interval),
+        None if emit_every is None else parse_duration(emit_every),
+        emit_size,
+        workers,
+        max_bandwidth=max_bandwidth,
+    )
+
+
 def main():
     app()
 
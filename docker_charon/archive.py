@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from dxf import DXFBase
+
+from docker_charon.common import (
+    CHUNK_SIZE,
+    Blob,
+    Manifest,
+    PayloadSide,
+    get_blob_path_in_oci_layout,
+)
+
+DOCKER_MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+DOCKER_CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+DOCKER_LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar"
+DOCKER_GZIP_LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+DOCKER_MANIFEST_LIST_MEDIA_TYPE = (
+    "application/vnd.docker.distribution.manifest.list.v2+json"
+)
+
+CONTENT_ADDRESSED_PATH = re.compile(r"^(?:\./)?blobs/(\w+)/([0-9a-f]+)$")
+
+
+class ArchiveMember:
+    """The position of a file inside an uncompressed tar archive."""
+
+    def __init__(self, archive_path: Path, offset: int, size: int):
+        self.archive_path = archive_path
+        self.offset = offset
+        self.size = size
+
+    def read(self, size: Optional[int] = None) -> bytes:
+        with open(self.archive_path, "rb") as archive:
+            archive.seek(self.offset)
+            return archive.read(self.size if size is None else min(size, self.size))
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        with open(self.archive_path, "rb") as archive:
+            archive.seek(self.offset)
+            remaining = self.size
+            while remaining:
+                chunk = archive.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise EOFError(f"{self.archive_path} is truncated")
+                remaining -= len(chunk)
+                yield chunk
+
+
+def compute_digest(archive_path: Path, offset: int, size: int) -> str:
+    """Runs in a worker process, it must stay a module-level function."""
+    sha256 = hashlib.sha256()
+    for chunk in ArchiveMember(archive_path, offset, size).iter_chunks():
+        sha256.update(chunk)
+    return f"sha256:{sha256.hexdigest()}"
+
+
+class ArchiveBlob(Blob):
+    """A blob which is read from a local archive instead of a registry."""
+
+    def __init__(
+        self, dxf_base: DXFBase, digest: str, repository: str, member: ArchiveMember
+    ):
+        super().__init__(dxf_base, digest, repository, member.size)
+        self.member = member
+
+    def pull_chunks(self) -> Iterator[bytes]:
+        return self.member.iter_chunks()
+
+
+class ArchiveManifest(Manifest):
+    def __init__(
+        self,
+        dxf_base: DXFBase,
+        docker_image_name: str,
+        content: str,
+        members: dict[str, ArchiveMember],
+    ):
+        super().__init__(
+            dxf_base, docker_image_name, PayloadSide.ENCODER, content=content
+        )
+        # digest -> location of the blob in the archive
+        self.members = members
+
+    def get_list_of_blobs(self) -> list[Blob]:
+        return [
+            ArchiveBlob(
+                self.dxf_base, blob.digest, self.repository, self.members[blob.digest]
+            )
+            for blob in super().get_list_of_blobs()
+        ]
+
+
+class DockerArchive:
+    """An uncompressed tar archive made by `docker save` or an OCI archive
+    (a tar of an OCI image layout).
+
+    The manifests are rebuilt as docker image manifests (schema 2), so that the
+    payload is the same as if the images were pulled from a registry. The layers of
+    `docker save` are not compressed, they are transferred as such.
+    """
+
+    def __init__(self, archive_path: Union[Path, str]):
+        self.archive_path = Path(archive_path)
+        self.members: dict[str, ArchiveMember] = {}
+        with tarfile.open(self.archive_path, "r:") as archive:
+            for tar_info in archive:
+                if tar_info.isfile():
+                    name = (
+                        tar_info.name[2:]
+                        if tar_info.name.startswith("./")
+                        else tar_info.name
+                    )
+                    self.members[name] = ArchiveMember(
+                        self.archive_path, tar_info.offset_data, tar_info.size
+                    )
+
+    def read_json(self, name: str):
+        return json.loads(self.members[name].read())
+
+    def get_layer_media_type(self, name: str) -> str:
+        magic_number = self.members[name].read(4)
+        if magic_number.startswith(b"\x1f\x8b"):
+            return DOCKER_GZIP_LAYER_MEDIA_TYPE
+        if magic_number == b"\x28\xb5\x2f\xfd":
+            raise ValueError(
+                f"The layer {name} of {self.archive_path} is compressed with zstd, "
+                f"which can't be described in a docker image manifest."
+            )
+        return DOCKER_LAYER_MEDIA_TYPE
+
+    def get_images(self) -> dict[str, tuple[str, list[str]]]:
+        """Returns, for each image name, the path of its config and of its layers."""
+        images = {}
+        if "manifest.json" in self.members:
+            # docker save
+            for image in self.read_json("manifest.json"):
+                for docker_image in image.get("RepoTags") or []:
+                    images[docker_image] = (image["Config"], image["Layers"])
+        elif "index.json" in self.members:
+            for descriptor in self.read_json("index.json")["manifests"]:
+                annotations = descriptor.get("annotations", {})
+                docker_image = annotations.get(
+                    "io.containerd.image.name"
+                ) or annotations.get("org.opencontainers.image.ref.name")
+                if docker_image is None:
+                    continue
+                if descriptor["mediaType"] in (
+                    OCI_INDEX_MEDIA_TYPE,
+                    DOCKER_MANIFEST_LIST_MEDIA_TYPE,
+                ):
+                    raise ValueError(
+                        f"{docker_image} in {self.archive_path} is a multi-platform "
+                        f"image, only single platform images are supported."
+                    )
+                manifest = self.read_json(
+                    get_blob_path_in_oci_layout(descriptor["digest"])
+                )
+                images[docker_image] = (
+                    get_blob_path_in_oci_layout(manifest["config"]["digest"]),
+                    [
+                        get_blob_path_in_oci_layout(layer["digest"])
+                        for layer in manifest["layers"]
+                    ],
+                )
+        else:
+            raise ValueError(
+                f"{self.archive_path} is neither a docker save archive nor an OCI archive."
+            )
+        return images
+
+
+def load_docker_archives(
+    dxf_base: DXFBase,
+    archives_paths: list[Union[Path, str]],
+    docker_images: list[str],
+    workers: int = 4,
+) -> dict[str, ArchiveManifest]:
+    """Reads the manifests of the docker images found in the archives.
+
+    The digests are taken from the paths of the files when the archive is content
+    addressed (OCI archives, recent versions of `docker save`). Otherwise, e.g.
+    the `<id>/layer.tar` files of older versions of `docker save`, they are computed
+    in a pool of processes.
+    """
+    images_found: dict[str, tuple[DockerArchive, str, list[str]]] = {}
+    for archive_path in archives_paths:
+        archive = DockerArchive(archive_path)
+        for docker_image, (config, layers) in archive.get_images().items():
+            if docker_image in docker_images and docker_image not in images_found:
+                images_found[docker_image] = (archive, config, layers)
+
+    paths_to_hash = {}
+    for archive, config, layers in images_found.values():
+        for path in [config] + layers:
+            if not CONTENT_ADDRESSED_PATH.match(path):
+                paths_to_hash[(archive.archive_path, path)] = archive.members[path]
+    digests = {}
+    if paths_to_hash:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                key: executor.submit(
+                    compute_digest, member.archive_path, member.offset, member.size
+                )
+                for key, member in paths_to_hash.items()
+            }
+            digests = {key: future.result() for key, future in futures.items()}
+
+    def get_digest(archive: DockerArchive, path: str) -> str:
+        if match := CONTENT_ADDRESSED_PATH.match(path):
+            return f"{match.group(1)}:{match.group(2)}"
+        return digests[(archive.archive_path, path)]
+
+    manifests = {}
+    for docker_image, (archive, config, layers) in images_found.items():
+        config_digest = get_digest(archive, config)
+        members = {config_digest: archive.members[config]}
+        layers_descriptors = []
+        for layer in layers:
+            layer_digest = get_digest(archive, layer)
+            members[layer_digest] = archive.members[layer]
+            layers_descriptors.append(
+                {
+                    "mediaType": archive.get_layer_media_type(layer),
+                    "size": archive.members[layer].size,
+                    "digest": layer_digest,
+                }
+            )
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": DOCKER_MANIFEST_MEDIA_TYPE,
+            "config": {
+                "mediaType": DOCKER_CONFIG_MEDIA_TYPE,
+                "size": archive.members[config].size,
+                "digest": config_digest,
+            },
+            "layers": layers_descriptors,
+        }
+        manifests[docker_image] = ArchiveManifest(
+            dxf_base, docker_image, json.dumps(manifest, indent=3), members
+        )
+    return manifests
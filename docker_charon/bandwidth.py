@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import datetime
+import re
+import threading
+import time
+from typing import Iterable, Iterator, Optional, Union
+
+from docker_charon.common import CHUNK_SIZE
+
+BANDWIDTH_UNITS = {
+    "": 1,
+    "k": 10**3,
+    "m": 10**6,
+    "g": 10**9,
+    "t": 10**12,
+    "ki": 2**10,
+    "mi": 2**20,
+    "gi": 2**30,
+    "ti": 2**40,
+}
+# the bucket holds at most this many seconds of transfer, the bursts above the
+# limit are that short
+BURST_DURATION = 0.25
+
+
+def parse_rate(rate: str) -> Optional[float]:
+    """'200MB/s', '1.5GiB/s' or '500k' to bytes per second. 'unlimited' gives None."""
+    rate = rate.strip().lower()
+    if rate == "unlimited":
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmg]i?)?b?(?:/s)?", rate)
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(
+            f"Invalid bandwidth {rate!r}, expected something like '200MB/s', "
+            f"'1.5GiB/s' or 'unlimited'."
+        )
+    return float(match.group(1)) * BANDWIDTH_UNITS[match.group(2) or ""]
+
+
+def parse_size(size: str) -> int:
+    """'500GB', '1.5TiB' or '1024' to bytes."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]i?)?b?", size.strip().lower())
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(
+            f"Invalid size {size!r}, expected something like '500GB' or '1.5TiB'."
+        )
+    return int(float(match.group(1)) * BANDWIDTH_UNITS[match.group(2) or ""])
+
+
+def parse_time_of_day(text: str) -> datetime.time:
+    try:
+        return datetime.datetime.strptime(text.strip(), "%H:%M").time()
+    except ValueError:
+        raise ValueError(f"Invalid time of day {text!r}, expected HH:MM.")
+
+
+class BandwidthLimit:
+    """A token bucket shared by all the transfers of a payload.
+
+    The limit can depend on the time of day, e.g. lower during business hours.
+    A transfer which takes more than the bucket holds waits for the tokens it
+    took in advance, so the concurrent transfers share the bandwidth fairly.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float],
+        schedule: list[tuple[datetime.time, datetime.time, Optional[float]]] = [],
+    ):
+        # bytes per second, None if unlimited
+        self.rate = rate
+        # (start, end, rate), the first range containing the current time wins.
+        # A range can go over midnight, like 18:00-08:00.
+        self.schedule = schedule
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, text: str) -> BandwidthLimit:
+        """'200MB/s', or with a schedule: '09:00-18:00=50MB/s,200MB/s'.
+
+        The rate without time range applies outside of the ranges, it's unlimited
+        if it's not given.
+        """
+        rate = None
+        schedule = []
+        for entry in text.split(","):
+            if "=" not in entry:
+                rate = parse_rate(entry)
+                continue
+            time_range, range_rate = entry.split("=", 1)
+            if "-" not in time_range:
+                raise ValueError(
+                    f"Invalid time range {time_range!r}, expected HH:MM-HH:MM."
+                )
+            start, end = time_range.split("-", 1)
+            schedule.append(
+                (
+                    parse_time_of_day(start),
+                    parse_time_of_day(end),
+                    parse_rate(range_rate),
+                )
+            )
+        return cls(rate, schedule)
+
+    def get_rate(self, now: Optional[datetime.datetime] = None) -> Optional[float]:
+        time_of_day = (now or datetime.datetime.now()).time()
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= time_of_day < end:
+                    return rate
+            elif time_of_day >= start or time_of_day < end:
+                return rate
+        return self.rate
+
+    def consume(self, size: int) -> None:
+        """Waits until `size` bytes can be transferred."""
+        rate = self.get_rate()
+        if rate is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated) * rate, rate * BURST_DURATION
+            )
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(
+        self, data: Union[bytes, memoryview, Iterable[bytes]]
+    ) -> Iterator[bytes]:
+        if isinstance(data, (bytes, memoryview)):
+            chunks = (
+                bytes(data[start : start + CHUNK_SIZE])
+                for start in range(0, len(data), CHUNK_SIZE)
+            )
+        else:
+            chunks = data
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+
+
+def limit_bandwidth(
+    data: Union[bytes, memoryview, Iterable[bytes]],
+    bandwidth: Optional[BandwidthLimit],
+) -> Union[bytes, memoryview, Iterable[bytes]]:
+    if bandwidth is None:
+        return data
+    return bandwidth.throttle(data)
+
+
+def get_bandwidth_limit(
+    max_bandwidth: Union[str, float, None]
+) -> Optional[BandwidthLimit]:
+    """The `max_bandwidth` argument of the public functions: a number of bytes per
+    second, or a string for `BandwidthLimit.parse`."""
+    if max_bandwidth is None:
+        return None
+    if isinstance(max_bandwidth, str):
+        return BandwidthLimit.parse(max_bandwidth)
+    return BandwidthLimit(max_bandwidth)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import sys
+import time
+from typing import IO, Iterator, Optional
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from docker_charon.common import Blob, BlobChunksInZip, file_to_generator
+from docker_charon.delta import (
+    GZIP_MAGIC_NUMBER,
+    decompress_chunks,
+    find_gzip_parameters,
+    get_files_in_tar,
+    hash_range,
+    read_range,
+    spool,
+)
+
+# blobs smaller than this are always stored in full
+CHUNKED_BLOB_MIN_SIZE = 2**20
+# files of the layers which are at least this big get a chunk of their own
+FILE_CHUNK_MIN_SIZE = 2**16
+
+
+def get_chunk_path_in_zip(digest: str) -> str:
+    return f"chunks/{digest}"
+
+
+def split_tar(tar_file: IO) -> Iterator[tuple[int, int]]:
+    """Yields the (start, end) of the chunks of an uncompressed layer.
+
+    The boundaries are the ones of the big files in the tar, so the same file
+    gives the same chunk whatever the layer it's in. What is between two big
+    files, tar headers and small files, is a chunk too.
+    """
+    position = 0
+    for member in get_files_in_tar(tar_file):
+        if member.size < FILE_CHUNK_MIN_SIZE:
+            continue
+        if position < member.offset_data:
+            yield position, member.offset_data
+        yield member.offset_data, member.offset_data + member.size
+        position = member.offset_data + member.size
+    tar_file.seek(0, 2)
+    if position < tar_file.tell():
+        yield position, tar_file.tell()
+
+
+def write_chunk_to_zip(
+    tar_file: IO, start: int, end: int, zip_file: ZipFile, digest: str
+) -> None:
+    # the chunks are uncompressed content, unlike the blobs
+    zip_info = ZipInfo(
+        get_chunk_path_in_zip(digest), date_time=time.localtime(time.time())[:6]
+    )
+    zip_info.compress_type = ZIP_DEFLATED
+    zip_info.external_attr = 0o600 << 16
+    tar_file.seek(start)
+    with zip_file.open(zip_info, "w", force_zip64=True) as chunk_in_zip:
+        for data in read_range(tar_file, end - start):
+            chunk_in_zip.write(data)
+
+
+def add_chunks_to_zip(
+    blob: Blob, compressed_blob: IO, zip_file: ZipFile, chunks_in_zip: set[str]
+) -> Optional[BlobChunksInZip]:
+    """Writes the chunks of the blob which are not in `chunks_in_zip` yet.
+
+    Returns None if the blob can't be rebuilt byte for byte from its
+    uncompressed content, in which case it must be stored in full.
+    """
+    compressed_blob.seek(0)
+    is_gzip = compressed_blob.read(2) == GZIP_MAGIC_NUMBER
+    compressed_blob.seek(0)
+    with spool(decompress_chunks(file_to_generator(compressed_blob))) as tar_file:
+        gzip_parameters = None
+        if is_gzip:
+            gzip_parameters = find_gzip_parameters(compressed_blob, tar_file)
+            if gzip_parameters is None:
+                print(
+                    f"{blob} can't be compressed again identically, "
+                    f"it's not possible to split it in chunks",
+                    file=sys.stderr,
+                )
+                return None
+        chunks = []
+        for start, end in split_tar(tar_file):
+            digest = f"sha256:{hash_range(tar_file, start, end - start)}"
+            chunks.append(digest)
+            if digest not in chunks_in_zip:
+                write_chunk_to_zip(tar_file, start, end, zip_file, digest)
+                chunks_in_zip.add(digest)
+    return BlobChunksInZip(chunks=chunks, gzip=gzip_parameters)
+
+
+def read_chunks_from_zip(
+    zip_file: ZipFile, blob_chunks: BlobChunksInZip
+) -> Iterator[bytes]:
+    """Yields the uncompressed content of the blob."""
+    for digest in blob_chunks.chunks:
+        with zip_file.open(get_chunk_path_in_zip(digest)) as chunk_in_zip:
+            yield from file_to_generator(chunk_in_zip)
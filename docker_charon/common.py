@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import os
+import uuid
 from enum import Enum
 from importlib.metadata import version
 from pathlib import Path
-from typing import IO, Dict, Iterator, Optional, Union
+from typing import IO, Dict, Iterator, List, Mapping, Optional, Union
 
 import requests
 from dxf import DXF, DXFBase
@@ -12,6 +15,8 @@ from pydantic import BaseModel
 
 PYDANTIC_V2 = version("pydantic").startswith("2.")
 
+CHUNK_SIZE = 2**15
+
 
 class PayloadSide(Enum):
     ENCODER = "ENCODER"
@@ -19,10 +24,18 @@ class PayloadSide(Enum):
 
 
 class Blob:
-    def __init__(self, dxf_base: DXFBase, digest: str, repository: str):
+    def __init__(
+        self,
+        dxf_base: DXFBase,
+        digest: str,
+        repository: str,
+        size: Optional[int] = None,
+    ):
         self.dxf_base = dxf_base
         self.digest = digest
         self.repository = repository
+        # the size declared in the manifest, if known
+        self.size = size
 
     def __repr__(self):
         return f"{self.repository}/{self.digest}"
@@ -30,6 +43,10 @@ class Blob:
     def __eq__(self, other: Blob):
         return self.digest == other.digest and self.repository == other.repository
 
+    def pull_chunks(self) -> Iterator[bytes]:
+        dxf = DXF.from_base(self.dxf_base, self.repository)
+        yield from dxf.pull_blob(self.digest, chunk_size=CHUNK_SIZE)
+
 
 class Manifest:
     def __init__(
@@ -66,14 +83,32 @@ class Manifest:
 
     def get_list_of_blobs(self) -> list[Blob]:
         manifest_dict = json.loads(self.content)
-        result: list[Blob] = [
-            Blob(self.dxf_base, manifest_dict["config"]["digest"], self.repository)
-        ]
-        for layer in manifest_dict["layers"]:
-            result.append(Blob(self.dxf_base, layer["digest"], self.repository))
+        result: list[Blob] = []
+        for blob_dict in [manifest_dict["config"]] + manifest_dict["layers"]:
+            result.append(
+                Blob(
+                    self.dxf_base,
+                    blob_dict["digest"],
+                    self.repository,
+                    blob_dict.get("size"),
+                )
+            )
         return result
 
 
+def get_manifest_digest(dxf_base: DXFBase, docker_image: str) -> Optional[str]:
+    """The digest of the manifest of a docker image, with a HEAD request, which
+    Docker Hub doesn't count in its pull rate limit. None if the registry doesn't
+    send it.
+    """
+    repository, tag = get_repo_and_tag(docker_image)
+    return DXF.from_base(dxf_base, repository)._get_dcd(tag)
+
+
+def get_manifest_content_digest(manifest_content: str) -> str:
+    return "sha256:" + hashlib.sha256(manifest_content.encode()).hexdigest()
+
+
 class BlobPathInZip(BaseModel):
     zip_path: str
 
@@ -82,9 +117,166 @@ class BlobLocationInRegistry(BaseModel):
     repository: str
 
 
+class GzipParameters(BaseModel):
+    # the gzip header of the original blob, hex encoded
+    header: str
+    level: int
+    mem_level: int
+
+
+class BlobDeltaInZip(BaseModel):
+    """A patch which rebuilds the blob from a base blob of the destination registry."""
+
+    zip_path: str
+    base_digest: str
+    base_repository: str
+    # None if the blob is an uncompressed tar
+    gzip: Optional[GzipParameters]
+
+
+class BlobChunksInZip(BaseModel):
+    """The blob is the concatenation of chunks, which are shared between blobs."""
+
+    # digests of the chunks of the uncompressed content, in order
+    chunks: List[str]
+    # None if the blob is an uncompressed tar
+    gzip: Optional[GzipParameters]
+
+
+BlobPath = Union[BlobDeltaInZip, BlobChunksInZip, BlobPathInZip, BlobLocationInRegistry]
+
+# the version of the compact encoding of the payload descriptor. The first
+# version is the json dump of the pydantic model, without any "version" key.
+PAYLOAD_DESCRIPTOR_VERSION = 2
+
+
+def model_to_dict(model: BaseModel) -> dict:
+    if PYDANTIC_V2:
+        return model.model_dump()
+    else:
+        return model.dict()
+
+
+def format_blob_path(blob_path_template: str, digest: str) -> str:
+    algorithm, encoded = digest.split(":", 1)
+    return blob_path_template.format(
+        digest=digest, algorithm=algorithm, encoded=encoded
+    )
+
+
+class CompactBlobsPaths(Mapping):
+    """The blobs paths of a compact payload descriptor, digest -> blob path.
+
+    Each value of the json is only turned into a pydantic model when it's
+    accessed, payloads can have tens of thousands of blobs:
+    - `null`: a `BlobPathInZip` at the path given by the template.
+    - an int: a `BlobLocationInRegistry`, the index of its repository.
+    - a string: a `BlobPathInZip` at this path.
+    - `{"delta": ...}` or `{"chunks": ...}`: a `BlobDeltaInZip` or a `BlobChunksInZip`.
+    """
+
+    def __init__(
+        self,
+        encoded_blobs_paths: dict[str, Union[None, int, str, dict]],
+        repositories: list[str],
+        blob_path_template: str,
+    ):
+        self.encoded_blobs_paths = encoded_blobs_paths
+        self.repositories = repositories
+        self.blob_path_template = blob_path_template
+
+    def __getitem__(self, digest: str) -> BlobPath:
+        encoded_blob_path = self.encoded_blobs_paths[digest]
+        if encoded_blob_path is None:
+            return BlobPathInZip(
+                zip_path=format_blob_path(self.blob_path_template, digest)
+            )
+        if isinstance(encoded_blob_path, int):
+            return BlobLocationInRegistry(
+                repository=self.repositories[encoded_blob_path]
+            )
+        if isinstance(encoded_blob_path, str):
+            return BlobPathInZip(zip_path=encoded_blob_path)
+        if "delta" in encoded_blob_path:
+            return BlobDeltaInZip(**encoded_blob_path["delta"])
+        return BlobChunksInZip(**encoded_blob_path["chunks"])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.encoded_blobs_paths)
+
+    def __len__(self) -> int:
+        return len(self.encoded_blobs_paths)
+
+
+def encode_blobs_paths(
+    blobs_paths: Mapping[str, BlobPath], blob_path_template: str
+) -> tuple[dict[str, Union[None, int, str, dict]], list[str]]:
+    """The opposite of `CompactBlobsPaths`, returns the encoded blobs paths and the
+    list of repositories.
+    """
+    repositories: dict[str, int] = {}
+    encoded_blobs_paths = {}
+    for digest, blob_path in blobs_paths.items():
+        if isinstance(blob_path, BlobLocationInRegistry):
+            encoded_blob_path = repositories.setdefault(
+                blob_path.repository, len(repositories)
+            )
+        elif isinstance(blob_path, BlobPathInZip):
+            encoded_blob_path = blob_path.zip_path
+            if encoded_blob_path == format_blob_path(blob_path_template, digest):
+                encoded_blob_path = None
+        elif isinstance(blob_path, BlobDeltaInZip):
+            encoded_blob_path = {"delta": model_to_dict(blob_path)}
+        else:
+            encoded_blob_path = {"chunks": model_to_dict(blob_path)}
+        encoded_blobs_paths[digest] = encoded_blob_path
+    return encoded_blobs_paths, list(repositories)
+
+
+class PayloadPart(BaseModel):
+    """One of the partial payloads built on several hosts, `index` out of `count`.
+
+    Each blob belongs to a single part, chosen from its digest, so the parts can be
+    made independently with the same list of images, and no blob is pulled twice.
+    """
+
+    # from 1 to count
+    index: int
+    count: int
+
+    @classmethod
+    def parse(cls, text: str) -> PayloadPart:
+        """'2/4' is the second part out of four."""
+        try:
+            index, count = (int(number) for number in text.split("/"))
+        except ValueError:
+            raise ValueError(f"Invalid part {text!r}, expected something like '2/4'.")
+        if not 1 <= index <= count:
+            raise ValueError(
+                f"Invalid part {text!r}, the index must be between 1 and {count}."
+            )
+        return cls(index=index, count=count)
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def get_part_of_blob(self, digest: str) -> int:
+        hashed_digest = hashlib.sha256(digest.encode()).digest()
+        return int.from_bytes(hashed_digest[:8], "big") % self.count + 1
+
+    def has_blob(self, digest: str) -> bool:
+        return self.get_part_of_blob(digest) == self.index
+
+
 class PayloadDescriptor(BaseModel):
     manifests_paths: Dict[str, Optional[str]]
-    blobs_paths: Dict[str, Union[BlobPathInZip, BlobLocationInRegistry]]
+    # BlobDeltaInZip comes first, otherwise a delta could be parsed as a BlobPathInZip
+    blobs_paths: Dict[
+        str,
+        Union[BlobDeltaInZip, BlobChunksInZip, BlobPathInZip, BlobLocationInRegistry],
+    ]
+    # not None if the payload must be merged with its other parts to be pushed
+    part: Optional[PayloadPart] = None
 
     @classmethod
     def from_images(
@@ -103,6 +295,75 @@ class PayloadDescriptor(BaseModel):
                 ] = f"manifests/{normalize_name(docker_image)}"
         return cls(manifests_paths=manifests_paths, blobs_paths={})
 
+    @classmethod
+    def from_json(cls, content: Union[str, bytes]) -> PayloadDescriptor:
+        """Reads the compact encoding as well as the first version."""
+        descriptor = json.loads(content)
+        version = descriptor.get("version", 1)
+        if version == 1:
+            if PYDANTIC_V2:
+                return cls.model_validate(descriptor)
+            else:
+                return cls.parse_obj(descriptor)
+        if version > PAYLOAD_DESCRIPTOR_VERSION:
+            raise ValueError(
+                f"The payload descriptor has the version {version}, this version of "
+                f"docker-charon can only read up to the version "
+                f"{PAYLOAD_DESCRIPTOR_VERSION}. Please upgrade docker-charon."
+            )
+        blobs_paths = CompactBlobsPaths(
+            descriptor["blobs_paths"],
+            descriptor["repositories"],
+            descriptor["blob_path_template"],
+        )
+        part = None
+        if descriptor.get("part") is not None:
+            part = PayloadPart.parse(descriptor["part"])
+        # no validation, the blobs paths are parsed lazily
+        if PYDANTIC_V2:
+            return cls.model_construct(
+                manifests_paths=descriptor["manifests_paths"],
+                blobs_paths=blobs_paths,
+                part=part,
+            )
+        else:
+            return cls.construct(
+                manifests_paths=descriptor["manifests_paths"],
+                blobs_paths=blobs_paths,
+                part=part,
+            )
+
+    def to_json(self, blob_path_template: str, compact: bool = False) -> str:
+        """The first version by default, which every version of docker-charon can
+        read. With `compact`, the compact encoding, in which the paths of the blobs
+        which follow `blob_path_template` are not written. It needs a version of
+        docker-charon newer than 0.4.3 to be read.
+        """
+        if not compact:
+            descriptor = {
+                "manifests_paths": self.manifests_paths,
+                "blobs_paths": {
+                    digest: model_to_dict(blob_path)
+                    for digest, blob_path in self.blobs_paths.items()
+                },
+            }
+            if self.part is not None:
+                descriptor["part"] = model_to_dict(self.part)
+            return json.dumps(descriptor, indent=4)
+        encoded_blobs_paths, repositories = encode_blobs_paths(
+            self.blobs_paths, blob_path_template
+        )
+        descriptor = {
+            "version": PAYLOAD_DESCRIPTOR_VERSION,
+            "manifests_paths": self.manifests_paths,
+            "repositories": repositories,
+            "blob_path_template": blob_path_template,
+            "blobs_paths": encoded_blobs_paths,
+        }
+        if self.part is not None:
+            descriptor["part"] = str(self.part)
+        return json.dumps(descriptor, separators=(",", ":"))
+
     def get_images_not_transferred_yet(self) -> Iterator[str]:
         for docker_image, manifest_path in self.manifests_paths.items():
             if manifest_path is not None:
@@ -113,18 +374,39 @@ def normalize_name(docker_image: str) -> str:
     return docker_image.replace("/", "_")
 
 
+OCI_LAYOUT_BLOB_PATH_TEMPLATE = "blobs/{algorithm}/{encoded}"
+
+
+def get_blob_path_in_oci_layout(digest: str) -> str:
+    return format_blob_path(OCI_LAYOUT_BLOB_PATH_TEMPLATE, digest)
+
+
 def progress_as_string(index: int, container: list) -> str:
     return f"[{index+1}/{len(container)}]"
 
 
 def file_to_generator(file_like: IO) -> Iterator[bytes]:
     while True:
-        chunk = file_like.read(2**15)
+        chunk = file_like.read(CHUNK_SIZE)
         if not chunk:
             break
         yield chunk
 
 
+def write_file_atomically(path: Path, content: bytes) -> None:
+    """Safe when several threads write the same path, each one writes to a temporary
+    file of its own."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temporary_path, "xb") as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
 PROJECT_ROOT = Path(__file__).parents[1]
 
 
@@ -132,6 +414,17 @@ def get_repo_and_tag(docker_image_name: str) -> (str, str):
     return docker_image_name.split(":", 1)
 
 
+class Registry(BaseModel):
+    host: str = "registry-1.docker.io"
+    # False if the registry uses http instead of https
+    secure: bool = True
+    username: Optional[str] = None
+    password: Optional[str] = None
+    # the maximum number of blobs pushed concurrently, the actual number adapts
+    # to the registry
+    max_workers: Optional[int] = None
+
+
 class Authenticator:
     def __init__(self, username: str, password: str):
         self.username = username
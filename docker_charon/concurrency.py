@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import email.utils
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, TypeVar
+
+import requests
+
+# the upper bound of the concurrency when it's not given
+DEFAULT_MAX_WORKERS = 16
+# the registry asks us to slow down with those
+THROTTLING_STATUS_CODES = (429, 503)
+# a throttled transfer is given up after this number of retries
+MAX_THROTTLED_RETRIES = 6
+# seconds to wait after a throttling response without Retry-After, doubled each time
+DEFAULT_RETRY_DELAY = 1.0
+# the concurrency grows only if a round of transfers is this much faster than the
+# previous one
+THROUGHPUT_GAIN = 1.05
+
+T = TypeVar("T")
+
+
+def is_throttling(error: Exception) -> bool:
+    return (
+        isinstance(error, requests.HTTPError)
+        and error.response is not None
+        and error.response.status_code in THROTTLING_STATUS_CODES
+    )
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """The delay asked by the registry, in seconds, if any."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class AdaptiveConcurrency:
+    """Limits the number of concurrent transfers with a registry, and adjusts
+    the limit to the registry with AIMD (additive increase, multiplicative decrease).
+
+    Each time `limit` transfers complete, the throughput of this round is compared
+    to the one of the previous round. If it's better, the limit is increased by one,
+    there is room for more transfers. When the registry throttles us (429 or 503),
+    the limit is halved and no transfer starts before the delay in `Retry-After`.
+
+    The transfers waiting for a slot get it by order of priority, the lowest first,
+    then in the order in which they asked for it.
+    """
+
+    def __init__(self, initial: int = 4, maximum: Optional[int] = None):
+        if maximum is None:
+            maximum = max(initial, DEFAULT_MAX_WORKERS)
+        self.maximum = max(maximum, 1)
+        self.limit = min(max(initial, 1), self.maximum)
+        self.active = 0
+        # (priority, arrival) of the transfers waiting for a slot
+        self.waiting: list[tuple[float, int]] = []
+        self.arrivals = itertools.count()
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.previous_throughput: Optional[float] = None
+        self.start_round()
+
+    def start_round(self) -> None:
+        self.round_start = time.monotonic()
+        self.round_bytes = 0
+        self.round_transfers = 0
+
+    def acquire(self, priority: float = 0) -> None:
+        with self.condition:
+            waiting = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, waiting)
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if (
+                    pause <= 0
+                    and self.active < self.limit
+                    and self.waiting[0] == waiting
+                ):
+                    break
+                self.condition.wait(timeout=pause if pause > 0 else None)
+            heapq.heappop(self.waiting)
+            self.active += 1
+            # the next one may be able to start too
+            self.condition.notify_all()
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority: float = 0) -> Iterator[None]:
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def on_success(self, size: int) -> None:
+        with self.condition:
+            self.round_bytes += size
+            self.round_transfers += 1
+            if self.round_transfers < self.limit:
+                return
+            throughput = self.round_bytes / max(
+                time.monotonic() - self.round_start, 1e-6
+            )
+            if (
+                self.previous_throughput is None
+                or throughput > self.previous_throughput * THROUGHPUT_GAIN
+            ):
+                self.limit = min(self.limit + 1, self.maximum)
+                self.condition.notify_all()
+            self.previous_throughput = throughput
+            self.start_round()
+
+    def on_throttled(self, retry_after: float) -> None:
+        with self.condition:
+            self.limit = max(self.limit // 2, 1)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.previous_throughput = None
+            self.start_round()
+
+    def wait_if_throttled(self, error: Exception, attempt: int) -> None:
+        """Re-raises `error` if it's not a throttling we can retry after.
+        Otherwise, waits until the transfer can be retried.
+        """
+        if not is_throttling(error) or attempt >= MAX_THROTTLED_RETRIES:
+            raise error
+        retry_after = get_retry_after(error.response)
+        if retry_after is None:
+            retry_after = DEFAULT_RETRY_DELAY * 2**attempt
+        self.on_throttled(retry_after)
+        time.sleep(retry_after)
+
+    def run(
+        self, function: Callable[..., T], *args, size: int = 0, priority: float = 0
+    ) -> T:
+        """Calls `function(*args)` when there is room for one more transfer, and
+        calls it again if the registry throttles it. `function` must be safe to call
+        again after a failure.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.slot(priority):
+                    result = function(*args)
+            except Exception as error:
+                self.wait_if_throttled(error, attempt)
+                attempt += 1
+                continue
+            self.on_success(size)
+            return result
@@ -1,27 +1,50 @@
 from __future__ import annotations
 
+import hashlib
+import inspect
+import mmap
+import os
+import queue
+import struct
 import sys
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
 from pathlib import Path
-from typing import IO, Iterator, Optional, Union
-from zipfile import ZipFile
+from typing import IO, Callable, ContextManager, Iterator, Mapping, Optional, Union
+from zipfile import ZIP_STORED, ZipFile
 
 import requests
 from dxf import DXF, DXFBase
+from pydantic import BaseModel
 
+from docker_charon.bandwidth import BandwidthLimit, get_bandwidth_limit, limit_bandwidth
+from docker_charon.chunks import get_chunk_path_in_zip, read_chunks_from_zip
 from docker_charon.common import (
-    PYDANTIC_V2,
     Authenticator,
     Blob,
+    BlobChunksInZip,
+    BlobDeltaInZip,
     BlobLocationInRegistry,
+    BlobPath,
     BlobPathInZip,
+    GzipParameters,
     Manifest,
     PayloadDescriptor,
     PayloadSide,
+    Registry,
     file_to_generator,
-    get_repo_and_tag,
+    get_manifest_content_digest,
+    get_manifest_digest,
     progress_as_string,
 )
+from docker_charon.concurrency import AdaptiveConcurrency, is_throttling
+from docker_charon.delta import apply_patch, decompress_chunks, recompress_chunks, spool
+from docker_charon.encryption import ENCRYPTION_PARAMETERS_PATH, get_cipher
+from docker_charon.pipeline import prefetch
+from docker_charon.profiling import enter_phase
+from docker_charon.schedule import order_largest_first, print_plan
 
 
 class ManifestNotFound(Exception):
@@ -32,6 +55,211 @@ class BlobNotFound(Exception):
     pass
 
 
+class PushFailed(Exception):
+    """Pushing to some of the registries failed. The other ones are up to date."""
+
+    def __init__(
+        self, errors: dict[str, Exception], images_pushed: dict[str, list[str]]
+    ):
+        super().__init__(
+            "Pushing the payload failed for "
+            + ", ".join(f"{registry} ({error!r})" for registry, error in errors.items())
+        )
+        self.errors = errors
+        self.images_pushed = images_pushed
+
+
+LOCAL_FILE_HEADER = struct.Struct("<4s22xHH")
+# "payload": the order of the payload, or the one of the `images` argument.
+# "smallest": the images which need the fewest bytes of the payload first.
+IMAGES_ORDERS = ("payload", "smallest")
+# how many chunks a registry can be behind the others when pushing to several ones
+FAN_OUT_QUEUE_SIZE = 64
+
+
+class PayloadZipFile(ZipFile):
+    """A read-only `ZipFile` which can hand out the blobs without copying them.
+
+    The payloads are written without compression, so the bytes of each blob are
+    contiguous in the zip file. The offsets of the members are computed once from
+    the central directory and the blobs are then served as slices of a memory map
+    of the file. Nothing is copied or checked at the Python level, the registry
+    verifies the digest anyway.
+
+    If the zip file can't be memory mapped (e.g. it's an `io.BytesIO`), we fall back
+    to `ZipFile.open`. The members of an encrypted payload are decrypted as they are
+    read, in memory.
+    """
+
+    def __init__(
+        self, file: Union[IO, Path, str], encryption_key: Union[str, bytes, None] = None
+    ):
+        self._members_offsets = {}
+        self._mmap = None
+        self.cipher = None
+        super().__init__(file, "r")
+        encryption_parameters = None
+        if ENCRYPTION_PARAMETERS_PATH in self.NameToInfo:
+            encryption_parameters = super().read(ENCRYPTION_PARAMETERS_PATH)
+        self.cipher = get_cipher(encryption_key, encryption_parameters)
+        if self.cipher is not None:
+            # the chunks are decrypted into new buffers anyway
+            return
+        try:
+            self._mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            return
+        for zip_info in self.infolist():
+            if zip_info.compress_type == ZIP_STORED and not zip_info.flag_bits & 0x1:
+                self._members_offsets[zip_info.filename] = (
+                    self._get_data_offset(zip_info.header_offset),
+                    zip_info.file_size,
+                )
+
+    def _get_data_offset(self, header_offset: int) -> int:
+        # the local header can have a different extra field than the central directory
+        signature, name_length, extra_length = LOCAL_FILE_HEADER.unpack_from(
+            self._mmap, header_offset
+        )
+        if signature != b"PK\x03\x04":
+            raise ValueError(f"Bad local file header at offset {header_offset}")
+        return header_offset + LOCAL_FILE_HEADER.size + name_length + extra_length
+
+    def read(self, name: str) -> bytes:
+        content = super().read(name)
+        if self.cipher is None:
+            return content
+        return self.cipher.decrypt_bytes(name, content)
+
+    @contextmanager
+    def open_blob(self, name: str) -> Iterator[Union[memoryview, Iterator[bytes]]]:
+        """Yields the content of the member, ready to be given to `DXF.push_blob`."""
+        if name not in self._members_offsets:
+            with self.open(name, "r") as member:
+                # the CRC32 of the member is checked by the thread which reads it
+                chunks = prefetch(file_to_generator(member))
+                if self.cipher is None:
+                    yield chunks
+                else:
+                    yield self.cipher.decrypt(name, chunks)
+            return
+        offset, size = self._members_offsets[name]
+        with memoryview(self._mmap) as whole_file:
+            with whole_file[offset : offset + size] as member:
+                yield member
+
+    def get_size(self, name: str) -> int:
+        """The number of bytes the member takes in the zip file."""
+        return self.getinfo(name).compress_size
+
+    def close(self) -> None:
+        super().close()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class OCILayoutPayload:
+    """A payload written as an OCI image layout directory.
+
+    It has the same interface as `PayloadZipFile`, the paths in the payload
+    descriptor are relative to the directory.
+    """
+
+    def __init__(self, directory: Union[Path, str]):
+        self.directory = Path(directory)
+
+    def read(self, name: str) -> bytes:
+        return (self.directory / name).read_bytes()
+
+    @contextmanager
+    def open_blob(self, name: str) -> Iterator[Union[bytes, memoryview]]:
+        with open(self.directory / name, "rb") as blob_file:
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                # empty files can't be memory mapped
+                yield b""
+                return
+            with mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as blob:
+                    yield blob
+
+    def get_size(self, name: str) -> int:
+        return (self.directory / name).stat().st_size
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> OCILayoutPayload:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+Payload = Union[PayloadZipFile, OCILayoutPayload]
+
+
+def open_payload(
+    zip_file: Union[IO, Path, str], encryption_key: Union[str, bytes, None] = None
+) -> Payload:
+    if isinstance(zip_file, (str, Path)) and Path(zip_file).is_dir():
+        # the OCI image layouts are never encrypted
+        get_cipher(encryption_key, None)
+        return OCILayoutPayload(zip_file)
+    return PayloadZipFile(zip_file, encryption_key)
+
+
+class Destination:
+    """A registry to which the payload is pushed.
+
+    When the payload is pushed to several registries, an error with one of them
+    doesn't stop the others. This registry is then skipped until the end.
+    """
+
+    def __init__(
+        self,
+        registry: str,
+        dxf_base: DXFBase,
+        raise_errors: bool = True,
+        concurrency: Optional[AdaptiveConcurrency] = None,
+        bandwidth: Optional[BandwidthLimit] = None,
+    ):
+        self.registry = registry
+        self.dxf_base = dxf_base
+        self.raise_errors = raise_errors
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        # shared by all the destinations
+        self.bandwidth = bandwidth
+        self.error: Optional[Exception] = None
+
+    def __repr__(self):
+        return self.registry
+
+    def fail(self, error: Exception) -> None:
+        if self.raise_errors:
+            raise error
+        print(
+            f"Pushing to {self.registry} failed, this registry is skipped from "
+            f"now on: {error!r}",
+            file=sys.stderr,
+        )
+        self.error = error
+
+    def run(self, function: Callable, *args) -> None:
+        """Calls `function(self, *args)`, again if the registry throttles it."""
+        attempt = 0
+        while self.error is None:
+            try:
+                function(self, *args)
+                return
+            except Exception as error:
+                try:
+                    self.concurrency.wait_if_throttled(error, attempt)
+                except Exception as final_error:
+                    self.fail(final_error)
+                attempt += 1
+
+
 def push_payload(
     zip_file: Union[IO, Path, str],
     strict: bool = False,
@@ -39,14 +267,23 @@ def push_payload(
     secure: bool = True,
     username: Optional[str] = None,
     password: Optional[str] = None,
+    images: Optional[list[str]] = None,
+    exclude: list[str] = [],
+    order: str = "payload",
+    on_image_pushed: Optional[Callable[[str], None]] = None,
+    max_workers: Optional[int] = None,
+    max_bandwidth: Union[str, float, None] = None,
+    encryption_key: Union[str, bytes, None] = None,
 ) -> list[str]:
     """Push the payload to the registry.
 
     It will iterate over the docker images and push the blobs and the manifests.
+    Only the blobs of the images pushed are read from the payload.
 
     # Arguments
         zip_file: the zip file containing the payload. It can be a `pathlib.Path`, a `str`
-            or a file-like object.
+            or a file-like object. It can also be the path of a directory if the payload
+            was written as an OCI image layout.
         strict: `False` by default. If True, it will raise an error if the
             some blobs/images are missing.
             That can happen if the user
@@ -59,79 +296,587 @@ def push_payload(
             if the registry does not require authentication.
         password: the password to use to connect to the registry. Optional
             if the registry does not require authentication.
+        images: the docker images of the payload to push, in this order. By
+            default, all the images of the payload are pushed.
+        exclude: docker images of the payload which must not be pushed.
+        order: `"payload"` by default, the images are pushed in the order of the payload,
+            or in the order of `images`. With `"smallest"`, the images which need the
+            fewest bytes of the payload are pushed first, so most of the images are
+            usable early.
+        on_image_pushed: called with the name of each docker image as soon as its
+            manifest is in the registry, while the other images are still being pushed.
+        max_workers: the maximum number of blobs pushed concurrently. The blobs of an
+            image are pushed 4 at a time at the start, then more while the throughput
+            improves. It's halved when the registry answers 429 or 503. Default is 16.
+        max_bandwidth: the maximum bandwidth used by all the pushes together, in bytes
+            per second, or a string like `"200MB/s"`. It can follow a schedule in local
+            time, like `"09:00-18:00=50MB/s,200MB/s"`. Unlimited by default.
+        encryption_key: the passphrase the payload was encrypted with, if it was. The
+            payload is decrypted in memory while it's pushed.
 
     # Returns
         The list of docker images loaded in the registry
         It also includes the list of docker images that were already present
         in the registry and were not included in the payload to optimize the size.
         In other words, it's the argument `docker_images_to_transfer` that you passed
-        to the function `docker_charon.make_payload(...)`.
+        to the function `docker_charon.make_payload(...)`, or the images selected
+        with `images` and `exclude`.
     """
-    authenticator = Authenticator(username, password)
+    images_pushed = []
+    for docker_image in iter_push_payload(
+        zip_file,
+        strict,
+        registry,
+        secure,
+        username,
+        password,
+        images,
+        exclude,
+        order,
+        max_workers,
+        max_bandwidth,
+        encryption_key,
+    ):
+        images_pushed.append(docker_image)
+        if on_image_pushed is not None:
+            on_image_pushed(docker_image)
+    return images_pushed
 
-    with DXFBase(
-        host=registry, auth=authenticator.auth, insecure=not secure
-    ) as dxf_base:
-        with ZipFile(zip_file, "r") as zip_file:
-            return list(load_zip_images_in_registry(dxf_base, zip_file, strict))
 
+def iter_push_payload(
+    zip_file: Union[IO, Path, str],
+    strict: bool = False,
+    registry: str = "registry-1.docker.io",
+    secure: bool = True,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    images: Optional[list[str]] = None,
+    exclude: list[str] = [],
+    order: str = "payload",
+    max_workers: Optional[int] = None,
+    max_bandwidth: Union[str, float, None] = None,
+    encryption_key: Union[str, bytes, None] = None,
+) -> Iterator[str]:
+    """Push the payload to the registry, yielding each docker image as soon as
+    its manifest is in the registry.
 
-def push_all_blobs_from_manifest(
-    dxf_base: DXFBase,
-    zip_file: ZipFile,
-    manifest: Manifest,
-    blobs_paths: dict,
+    The arguments are the ones of `push_payload`. The payload is pushed as
+    the iterator is consumed.
+    """
+    registry = Registry(
+        host=registry,
+        secure=secure,
+        username=username,
+        password=password,
+        max_workers=max_workers,
+    )
+    bandwidth = get_bandwidth_limit(max_bandwidth)
+    with open_payload(zip_file, encryption_key) as zip_file:
+        with open_destinations([registry], True, bandwidth) as destinations:
+            yield from load_zip_images_in_registries(
+                destinations, zip_file, strict, images, exclude, order
+            )
+
+
+def push_payload_to_registries(
+    zip_file: Union[IO, Path, str],
+    registries: list[Registry],
+    strict: bool = False,
+    images: Optional[list[str]] = None,
+    exclude: list[str] = [],
+    order: str = "payload",
+    on_image_pushed: Optional[Callable[[str], None]] = None,
+    max_bandwidth: Union[str, float, None] = None,
+    encryption_key: Union[str, bytes, None] = None,
+) -> dict[str, list[str]]:
+    """Push the payload to several registries at once.
+
+    Each blob is read once from the payload and pushed concurrently to all the
+    registries which don't have it yet. If something goes wrong with a registry,
+    the payload is still pushed to the other ones, then `PushFailed` is raised.
+
+    # Arguments
+        zip_file: the payload, see `push_payload`.
+        registries: the registries to push to, each one with its own credentials.
+        strict: see `push_payload`.
+        images: see `push_payload`.
+        exclude: see `push_payload`.
+        order: see `push_payload`.
+        on_image_pushed: called with the name of each docker image as soon as its
+            manifest is in all the registries which didn't fail.
+        max_bandwidth: see `push_payload`. The limit is for all the registries
+            together.
+        encryption_key: see `push_payload`.
+
+    # Returns
+        For each registry (its host), the list of docker images loaded in it.
+    """
+    bandwidth = get_bandwidth_limit(max_bandwidth)
+    with open_payload(zip_file, encryption_key) as zip_file:
+        with open_destinations(registries, False, bandwidth) as destinations:
+            images_pushed = []
+            for docker_image in load_zip_images_in_registries(
+                destinations, zip_file, strict, images, exclude, order
+            ):
+                images_pushed.append(docker_image)
+                if on_image_pushed is not None:
+                    on_image_pushed(docker_image)
+    images_pushed_by_registry = {
+        destination.registry: images_pushed
+        for destination in destinations
+        if destination.error is None
+    }
+    errors = {
+        destination.registry: destination.error
+        for destination in destinations
+        if destination.error is not None
+    }
+    if errors:
+        raise PushFailed(errors, images_pushed_by_registry)
+    return images_pushed_by_registry
+
+
+@contextmanager
+def open_destinations(
+    registries: list[Registry],
+    raise_errors: bool,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Iterator[list[Destination]]:
+    with ExitStack() as stack:
+        destinations = []
+        for registry in registries:
+            authenticator = Authenticator(registry.username, registry.password)
+            dxf_base = stack.enter_context(
+                DXFBase(
+                    host=registry.host,
+                    auth=authenticator.auth,
+                    insecure=not registry.secure,
+                )
+            )
+            concurrency = AdaptiveConcurrency(maximum=registry.max_workers)
+            destinations.append(
+                Destination(
+                    registry.host, dxf_base, raise_errors, concurrency, bandwidth
+                )
+            )
+        yield destinations
+
+
+def run_on_destinations(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    function: Callable,
+    *args,
+) -> None:
+    """Calls `function(destination, *args)` concurrently for each destination
+    which didn't fail yet.
+    """
+    runs = [
+        executor.submit(destination.run, function, *args)
+        for destination in destinations
+        if destination.error is None
+    ]
+    for run in runs:
+        run.result()
+
+
+def plan_blobs_pushes(
+    zip_file: Payload,
+    manifests: list[Manifest],
+    blobs_paths: Mapping[str, BlobPath],
+) -> list[Blob]:
+    """The blobs of all the images, image by image, the largest first in each image.
+
+    The blobs of the next image start as soon as workers are free, while the
+    last blobs of an image are pushed, but never before the blobs of this image.
+    A blob shared by several images is pushed with the first one.
+    """
+    planned_blobs = []
+    seen = set()
+    for manifest in manifests:
+        blobs = []
+        for blob in manifest.get_list_of_blobs():
+            if (blob.repository, blob.digest) not in seen:
+                seen.add((blob.repository, blob.digest))
+                blobs.append(blob)
+        planned_blobs += order_largest_first(
+            blobs,
+            lambda blob: get_blob_size_in_payload(zip_file, blobs_paths[blob.digest]),
+        )
+    return planned_blobs
+
+
+def push_blob_from_payload(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    zip_file: Payload,
+    blob: Blob,
+    blob_path: BlobPath,
+    progress: str,
+    priority: int = 0,
+) -> None:
+    with ExitStack() as stack:
+        # the slots are always taken in the same order, so that two blobs
+        # waiting for each other's slot can't happen
+        destinations = [
+            destination for destination in destinations if destination.error is None
+        ]
+        for destination in destinations:
+            stack.enter_context(destination.concurrency.slot(priority))
+
+        if isinstance(blob_path, BlobLocationInRegistry):
+            print(f"{progress} mounting blob {blob}", file=sys.stderr)
+            run_on_destinations(
+                executor,
+                destinations,
+                lambda destination: mount_blob_from_registry(
+                    destination.dxf_base, blob, blob_path
+                ),
+            )
+        elif not (
+            destinations_missing_blob := get_destinations_missing_blob(
+                executor, destinations, blob
+            )
+        ):
+            print(f"{progress} blob {blob} is already in the registry", file=sys.stderr)
+        elif isinstance(blob_path, BlobPathInZip):
+            print(f"{progress} pushing blob {blob}", file=sys.stderr)
+            push_blob_to_destinations(
+                executor,
+                destinations_missing_blob,
+                blob,
+                lambda: zip_file.open_blob(blob_path.zip_path),
+            )
+        else:
+            print(progress, end=" ", file=sys.stderr)
+            push_rebuilt_blob_to_destinations(
+                executor, destinations_missing_blob, zip_file, blob, blob_path
+            )
+    for destination in destinations:
+        if destination.error is None:
+            destination.concurrency.on_success(blob.size or 0)
+
+
+def get_destinations_missing_blob(
+    executor: ThreadPoolExecutor, destinations: list[Destination], blob: Blob
+) -> list[Destination]:
+    destinations_having_blob = set()
+
+    def check(destination: Destination) -> None:
+        dxf = DXF.from_base(destination.dxf_base, blob.repository)
+        if is_blob_in_repository(dxf, blob.digest):
+            destinations_having_blob.add(destination.registry)
+
+    run_on_destinations(executor, destinations, check)
+    return [
+        destination
+        for destination in destinations
+        if destination.error is None
+        and destination.registry not in destinations_having_blob
+    ]
+
+
+def push_blob_to_destinations(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    blob: Blob,
+    open_data: Callable[[], ContextManager],
 ) -> None:
-    list_of_blobs = manifest.get_list_of_blobs()
-    for blob_index, blob in enumerate(list_of_blobs):
-        print(progress_as_string(blob_index, list_of_blobs), end=" ", file=sys.stderr)
-
-        blob_path = blobs_paths[blob.digest]
-
-        if isinstance(blob_path, BlobPathInZip):
-            print(f"pushing blob {blob}", file=sys.stderr)
-            dxf = DXF.from_base(dxf_base, blob.repository)
-            # we try to open the file in the zip and push it. If the file doesn't
-            # exists in the zip, it means that it's already been pushed.
-            with zip_file.open(blob_path.zip_path, "r") as blob_in_zip:
-                dxf.push_blob(data=file_to_generator(blob_in_zip), digest=blob.digest)
-        elif isinstance(blob_path, BlobLocationInRegistry):
-            blob_in_registry = Blob(dxf_base, blob.digest, blob_path.repository)
-            dxf = DXF.from_base(dxf_base, blob.repository)
-            print(f"Mounting {blob_in_registry} to {blob.repository}", file=sys.stderr)
-            dxf.mount_blob(blob_in_registry.repository, blob_in_registry.digest)
-
-
-def load_single_image_from_zip_in_registry(
+    """The data is read only once, whatever the number of destinations. It's read
+    again only for the registries which throttled the push while it was streamed.
+    """
+    attempt = 0
+    while destinations:
+        with open_data() as data:
+            destinations = push_blob_data_to_destinations(
+                executor, destinations, blob, data, attempt
+            )
+        attempt += 1
+
+
+def push_blob_data_to_destinations(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    blob: Blob,
+    data: Union[bytes, memoryview, IO, Iterator[bytes]],
+    attempt: int,
+) -> list[Destination]:
+    """Returns the destinations to which the data must be pushed again."""
+    if hasattr(data, "read"):
+        data = file_to_generator(data)
+    fan_out = None
+    if isinstance(data, (bytes, memoryview)) or len(destinations) == 1:
+        # a memory map is shared by all the destinations
+        datas = [data] * len(destinations)
+    else:
+        fan_out = ChunksFanOut(data, len(destinations))
+        datas = fan_out.consumers
+
+    throttled_destinations = []
+
+    def push(destination: Destination, data) -> None:
+        dxf = DXF.from_base(destination.dxf_base, blob.repository)
+        try:
+            dxf.push_blob(
+                data=limit_bandwidth(data, destination.bandwidth),
+                digest=blob.digest,
+                check_exists=False,
+            )
+        except Exception as error:
+            if not (inspect.isgenerator(data) and is_throttling(error)):
+                raise
+            # the chunks already read can't be sent again
+            destination.concurrency.wait_if_throttled(error, attempt)
+            throttled_destinations.append(destination)
+
+    try:
+        pushes = [
+            executor.submit(destination.run, push, data)
+            for destination, data in zip(destinations, datas)
+        ]
+        for push_done in pushes:
+            push_done.result()
+    finally:
+        if fan_out is not None:
+            fan_out.close()
+    return throttled_destinations
+
+
+class ChunksFanOut:
+    """Reads the chunks in a thread and hands each one to several consumers.
+
+    The consumers can be up to `FAN_OUT_QUEUE_SIZE` chunks apart. A consumer which
+    stops reading (e.g. its registry failed) doesn't block the other ones.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], number_of_consumers: int):
+        self.queues = [
+            queue.Queue(maxsize=FAN_OUT_QUEUE_SIZE) for _ in range(number_of_consumers)
+        ]
+        self.abandoned = [threading.Event() for _ in range(number_of_consumers)]
+        self.consumers = [
+            self.consume(chunks_queue, abandoned)
+            for chunks_queue, abandoned in zip(self.queues, self.abandoned)
+        ]
+        self.producer = threading.Thread(target=self.produce, args=(chunks,))
+        self.producer.start()
+
+    def put(self, item: Union[bytes, Exception, None]) -> None:
+        for chunks_queue, abandoned in zip(self.queues, self.abandoned):
+            while not abandoned.is_set():
+                try:
+                    chunks_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def produce(self, chunks: Iterator[bytes]) -> None:
+        try:
+            for chunk in chunks:
+                self.put(chunk)
+        except Exception as error:
+            self.put(error)
+        else:
+            self.put(None)
+
+    def consume(
+        self, chunks_queue: queue.Queue, abandoned: threading.Event
+    ) -> Iterator[bytes]:
+        try:
+            while (chunk := chunks_queue.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            abandoned.set()
+
+    def close(self) -> None:
+        for abandoned in self.abandoned:
+            abandoned.set()
+        self.producer.join()
+
+
+def push_rebuilt_blob_to_destinations(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    zip_file: Payload,
+    blob: Blob,
+    blob_path: Union[BlobDeltaInZip, BlobChunksInZip],
+) -> None:
+    """The blob is rebuilt once, the base of a delta is pulled from the first
+    registry which has it.
+    """
+    for destination in destinations:
+        try:
+            with rebuild_blob(
+                destination.dxf_base, zip_file, blob, blob_path, destination.bandwidth
+            ) as data:
+
+                def rewind_data() -> ContextManager[IO]:
+                    data.seek(0)
+                    return nullcontext(data)
+
+                push_blob_to_destinations(executor, destinations, blob, rewind_data)
+            return
+        except BlobNotFound as error:
+            destination.fail(error)
+
+
+@contextmanager
+def rebuild_blob(
     dxf_base: DXFBase,
-    zip_file: ZipFile,
-    docker_image: str,
-    manifest_path_in_zip: str,
-    blobs_paths: dict[str, Union[BlobPathInZip, BlobLocationInRegistry]],
+    zip_file: Payload,
+    blob: Blob,
+    blob_path: Union[BlobDeltaInZip, BlobChunksInZip],
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Iterator[IO]:
+    if isinstance(blob_path, BlobChunksInZip):
+        print(
+            f"rebuilding blob {blob} from {len(blob_path.chunks)} chunks",
+            file=sys.stderr,
+        )
+        with spool_rebuilt_blob(
+            blob, read_chunks_from_zip(zip_file, blob_path), blob_path.gzip
+        ) as rebuilt_blob:
+            yield rebuilt_blob
+        return
+
+    base = Blob(dxf_base, blob_path.base_digest, blob_path.base_repository)
+    print(f"rebuilding blob {blob} from {base}", file=sys.stderr)
+    with ExitStack() as stack:
+        try:
+            base_chunks = limit_bandwidth(base.pull_chunks(), bandwidth)
+            base_tar = stack.enter_context(
+                spool(decompress_chunks(prefetch(base_chunks)))
+            )
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            raise BlobNotFound(
+                f"The blob {base} is needed to rebuild {blob}, but it's not in the "
+                f"registry. It was in the images given in "
+                f"`docker_images_already_transferred` when making the payload."
+            )
+        patch_file = stack.enter_context(zip_file.open(blob_path.zip_path))
+        yield stack.enter_context(
+            spool_rebuilt_blob(blob, apply_patch(patch_file, base_tar), blob_path.gzip)
+        )
+
+
+@contextmanager
+def spool_rebuilt_blob(
+    blob: Blob,
+    uncompressed_chunks: Iterator[bytes],
+    gzip_parameters: Optional[GzipParameters],
+) -> Iterator[IO]:
+    """Compresses the blob again and checks its digest."""
+    # the chunks are decompressed or patched on another core than the one compressing
+    with spool(
+        recompress_chunks(prefetch(uncompressed_chunks), gzip_parameters)
+    ) as rebuilt_blob:
+        sha256 = hashlib.sha256()
+        for chunk in file_to_generator(rebuilt_blob):
+            sha256.update(chunk)
+        if f"sha256:{sha256.hexdigest()}" != blob.digest:
+            raise ValueError(
+                f"The blob {blob} was rebuilt with the digest "
+                f"sha256:{sha256.hexdigest()}. The payload is corrupted."
+            )
+        rebuilt_blob.seek(0)
+        yield rebuilt_blob
+
+
+def is_blob_in_repository(dxf: DXF, digest: str) -> bool:
+    try:
+        dxf.blob_size(digest)
+    except requests.HTTPError as e:
+        if e.response.status_code != 404:
+            raise
+        return False
+    return True
+
+
+def mount_blob_from_registry(
+    dxf_base: DXFBase, blob: Blob, blob_location: BlobLocationInRegistry
 ) -> None:
-    print(f"Loading image {docker_image}", file=sys.stderr)
-    manifest_content = zip_file.read(manifest_path_in_zip).decode()
-    manifest = Manifest(
-        dxf_base, docker_image, PayloadSide.DECODER, content=manifest_content
+    blob_in_registry = Blob(dxf_base, blob.digest, blob_location.repository)
+    dxf = DXF.from_base(dxf_base, blob.repository)
+    print(f"Mounting {blob_in_registry} to {blob.repository}", file=sys.stderr)
+    dxf.mount_blob(blob_in_registry.repository, blob_in_registry.digest)
+
+
+def get_manifest_digest_in_registry(
+    dxf_base: DXFBase, docker_image: str
+) -> tuple[bool, Optional[str]]:
+    """Whether the tag is in the registry, and the digest of its manifest if the
+    registry gives it. A HEAD request, the manifest isn't downloaded.
+    """
+    try:
+        return True, get_manifest_digest(dxf_base, docker_image)
+    except requests.HTTPError as e:
+        if e.response.status_code != 404:
+            raise
+        return False, None
+
+
+def get_manifests_in_registries(
+    destinations: list[Destination], docker_images: list[str]
+) -> dict[tuple[str, str], Optional[str]]:
+    """(registry, docker image) -> the digest of the manifest of the tag, for the
+    tags which are in the registries. The registries and the images are all checked
+    concurrently, with HEAD requests.
+    """
+    manifests_in_registries = {}
+
+    def check(destination: Destination, docker_image: str) -> None:
+        in_registry, digest = get_manifest_digest_in_registry(
+            destination.dxf_base, docker_image
+        )
+        if in_registry:
+            manifests_in_registries[destination.registry, docker_image] = digest
+
+    max_checks = sum(destination.concurrency.maximum for destination in destinations)
+    with ThreadPoolExecutor(max_workers=max_checks) as executor:
+        checks = [
+            executor.submit(destination.run, check, docker_image)
+            for docker_image in docker_images
+            for destination in destinations
+            if destination.error is None
+        ]
+        for check_done in checks:
+            check_done.result()
+    return manifests_in_registries
+
+
+def is_manifest_in_registries(
+    manifests_in_registries: dict[tuple[str, str], Optional[str]],
+    destinations: list[Destination],
+    manifest: Manifest,
+) -> bool:
+    """Whether the tag already points to this manifest in all the registries."""
+    digest = get_manifest_content_digest(manifest.content)
+    return all(
+        manifests_in_registries.get((destination.registry, manifest.docker_image_name))
+        == digest
+        for destination in destinations
+        if destination.error is None
     )
-    push_all_blobs_from_manifest(dxf_base, zip_file, manifest, blobs_paths)
-    dxf = DXF.from_base(dxf_base, manifest.repository)
-    dxf.set_manifest(manifest.tag, manifest.content)
 
 
 def check_if_the_docker_image_is_in_the_registry(
     dxf_base: DXFBase, docker_image: str, strict: bool
 ):
+    in_registry, _ = get_manifest_digest_in_registry(dxf_base, docker_image)
+    report_docker_image_already_transferred(docker_image, in_registry, strict)
+
+
+def report_docker_image_already_transferred(
+    docker_image: str, in_registry: bool, strict: bool
+) -> None:
     """we skipped this image because the user said it was in the registry. Let's
     check if it's true. Raise an warning/error if not.
     """
-    repo, tag = get_repo_and_tag(docker_image)
-    dxf = DXF.from_base(dxf_base, repo)
-    try:
-        dxf.get_manifest(tag)
-    except requests.HTTPError as e:
-        if e.response.status_code != 404:
-            raise
+    if not in_registry:
         error_message = (
             f"The docker image {docker_image} is not present in the "
             f"registry. But when making the payload, it was specified in "
@@ -148,33 +893,293 @@ def check_if_the_docker_image_is_in_the_registry(
     print(f"Skipping {docker_image} as its already in the registry", file=sys.stderr)
 
 
-def load_zip_images_in_registry(
-    dxf_base: DXFBase, zip_file: ZipFile, strict: bool
+def select_images(
+    payload_descriptor: PayloadDescriptor,
+    images: Optional[list[str]],
+    exclude: list[str],
+) -> list[str]:
+    all_images = list(payload_descriptor.manifests_paths)
+    for docker_image in (images or []) + exclude:
+        if docker_image not in payload_descriptor.manifests_paths:
+            raise ValueError(
+                f"The docker image {docker_image} is not in the payload. "
+                f"The payload contains {all_images}."
+            )
+    if images is None:
+        images = all_images
+    return [docker_image for docker_image in images if docker_image not in exclude]
+
+
+def read_manifest_from_zip(
+    zip_file: Payload, docker_image: str, manifest_path_in_zip: str
+) -> Manifest:
+    return Manifest(
+        None,
+        docker_image,
+        PayloadSide.DECODER,
+        content=zip_file.read(manifest_path_in_zip).decode(),
+    )
+
+
+def get_blobs_sizes_in_payload(
+    zip_file: Payload, payload_descriptor: PayloadDescriptor, docker_image: str
+) -> dict[str, int]:
+    """The blobs of the image which are in the payload, with what they take in it."""
+    manifest_path_in_zip = payload_descriptor.manifests_paths[docker_image]
+    if manifest_path_in_zip is None:
+        return {}
+    manifest = read_manifest_from_zip(zip_file, docker_image, manifest_path_in_zip)
+    blobs_sizes = {}
+    for blob in manifest.get_list_of_blobs():
+        blob_path = payload_descriptor.blobs_paths[blob.digest]
+        if not isinstance(blob_path, BlobLocationInRegistry):
+            blobs_sizes[blob.digest] = get_blob_size_in_payload(zip_file, blob_path)
+    return blobs_sizes
+
+
+def order_images(
+    zip_file: Payload,
+    payload_descriptor: PayloadDescriptor,
+    docker_images: list[str],
+    order: str,
+) -> list[str]:
+    if order not in IMAGES_ORDERS:
+        raise ValueError(f"order must be one of {IMAGES_ORDERS}, got {order!r}")
+    if order == "payload":
+        return docker_images
+
+    # the blobs shared with an image already pushed are not pushed again, so the
+    # next image is always the one with the fewest bytes left to push.
+    blobs_sizes = {
+        docker_image: get_blobs_sizes_in_payload(
+            zip_file, payload_descriptor, docker_image
+        )
+        for docker_image in docker_images
+    }
+    blobs_pushed = set()
+    ordered_images = []
+    while blobs_sizes:
+        next_image = min(
+            blobs_sizes,
+            key=lambda docker_image: sum(
+                size
+                for digest, size in blobs_sizes[docker_image].items()
+                if digest not in blobs_pushed
+            ),
+        )
+        blobs_pushed.update(blobs_sizes.pop(next_image))
+        ordered_images.append(next_image)
+    return ordered_images
+
+
+def set_manifest_in_registries(
+    executor: ThreadPoolExecutor,
+    destinations: list[Destination],
+    manifest: Manifest,
+) -> None:
+    def set_manifest(destination: Destination) -> None:
+        dxf = DXF.from_base(destination.dxf_base, manifest.repository)
+        dxf.set_manifest(manifest.tag, manifest.content)
+
+    run_on_destinations(executor, destinations, set_manifest)
+
+
+def load_zip_images_in_registries(
+    destinations: list[Destination],
+    zip_file: Payload,
+    strict: bool,
+    images: Optional[list[str]] = None,
+    exclude: list[str] = [],
+    order: str = "payload",
 ) -> Iterator[str]:
+    enter_phase("planning")
     payload_descriptor = get_payload_descriptor(zip_file)
-    for (
-        docker_image,
-        manifest_path_in_zip,
-    ) in payload_descriptor.manifests_paths.items():
-        if manifest_path_in_zip is None:
-            check_if_the_docker_image_is_in_the_registry(dxf_base, docker_image, strict)
-        else:
-            load_single_image_from_zip_in_registry(
-                dxf_base,
+    docker_images = order_images(
+        zip_file,
+        payload_descriptor,
+        select_images(payload_descriptor, images, exclude),
+        order,
+    )
+    manifests = {
+        docker_image: read_manifest_from_zip(zip_file, docker_image, manifest_path)
+        for docker_image in docker_images
+        if (manifest_path := payload_descriptor.manifests_paths[docker_image])
+        is not None
+    }
+    # the images whose tag already points to the same manifest are skipped, and
+    # the images already transferred are checked, all at once
+    manifests_in_registries = get_manifests_in_registries(destinations, docker_images)
+    images_up_to_date = {
+        docker_image
+        for docker_image, manifest in manifests.items()
+        if is_manifest_in_registries(manifests_in_registries, destinations, manifest)
+    }
+    planned_blobs = plan_blobs_pushes(
+        zip_file,
+        [
+            manifest
+            for docker_image, manifest in manifests.items()
+            if docker_image not in images_up_to_date
+        ],
+        payload_descriptor.blobs_paths,
+    )
+    print_plan_of_pushes(zip_file, destinations, planned_blobs, payload_descriptor)
+
+    enter_phase("transfer", zip_phase="zip read")
+    max_blobs = max(destination.concurrency.maximum for destination in destinations)
+    # each blob pushed needs a thread for each registry, waiting for a free thread
+    # while holding the slots of the registries could block the other blobs.
+    # The manifests have threads of their own, they don't wait for the blobs of
+    # the next images.
+    with ThreadPoolExecutor(
+        max_workers=len(destinations) * (max_blobs + 1)
+    ) as executor, ThreadPoolExecutor(max_workers=max_blobs) as blobs_executor:
+        pushes = {
+            (blob.repository, blob.digest): blobs_executor.submit(
+                push_blob_from_payload,
+                executor,
+                destinations,
                 zip_file,
-                docker_image,
-                manifest_path_in_zip,
-                payload_descriptor.blobs_paths,
+                blob,
+                payload_descriptor.blobs_paths[blob.digest],
+                progress_as_string(rank, planned_blobs),
+                rank,
             )
-        yield docker_image
+            for rank, blob in enumerate(planned_blobs)
+        }
+        try:
+            for docker_image in docker_images:
+                if docker_image in images_up_to_date:
+                    print(
+                        f"Skipping {docker_image}, the registry already has the "
+                        f"same manifest",
+                        file=sys.stderr,
+                    )
+                    yield docker_image
+                    continue
+                if docker_image not in manifests:
+                    run_on_destinations(
+                        executor,
+                        destinations,
+                        lambda destination: report_docker_image_already_transferred(
+                            docker_image,
+                            (destination.registry, docker_image)
+                            in manifests_in_registries,
+                            strict,
+                        ),
+                    )
+                    yield docker_image
+                    continue
+                print(f"Loading image {docker_image}", file=sys.stderr)
+                manifest = manifests[docker_image]
+                # all the blobs must be in the registry before the manifest
+                for blob in manifest.get_list_of_blobs():
+                    pushes[blob.repository, blob.digest].result()
+                set_manifest_in_registries(executor, destinations, manifest)
+                yield docker_image
+        finally:
+            # if an image failed, or if the caller stopped iterating
+            for push in pushes.values():
+                push.cancel()
+            enter_phase("finalize")
 
 
-def get_payload_descriptor(zip_file: ZipFile) -> PayloadDescriptor:
-    if PYDANTIC_V2:
-        return PayloadDescriptor.model_validate_json(
-            zip_file.read("payload_descriptor.json").decode()
+def print_plan_of_pushes(
+    zip_file: Payload,
+    destinations: list[Destination],
+    planned_blobs: list[Blob],
+    payload_descriptor: PayloadDescriptor,
+) -> None:
+    bandwidth = destinations[0].bandwidth
+    rate = None if bandwidth is None else bandwidth.get_rate()
+    print_plan(
+        "Pushing",
+        [
+            get_blob_size_in_payload(
+                zip_file, payload_descriptor.blobs_paths[blob.digest]
+            )
+            for blob in planned_blobs
+        ],
+        min(destination.concurrency.limit for destination in destinations),
+        # each blob is pushed to all the registries with the same bandwidth
+        None if rate is None else rate / len(destinations),
+    )
+
+
+def get_payload_descriptor(zip_file: Payload) -> PayloadDescriptor:
+    payload_descriptor = PayloadDescriptor.from_json(
+        zip_file.read("payload_descriptor.json")
+    )
+    if payload_descriptor.part is not None:
+        raise ValueError(
+            f"This payload is only the part {payload_descriptor.part}, the blobs of "
+            f"the other parts are missing. Merge the parts with `merge-payloads` "
+            f"first."
         )
-    else:
-        return PayloadDescriptor.parse_raw(
-            zip_file.read("payload_descriptor.json").decode()
+    return payload_descriptor
+
+
+class ImageInPayload(BaseModel):
+    docker_image: str
+    # False if the image was already transferred when the payload was made
+    in_payload: bool
+    blobs: int = 0
+    blobs_in_payload: int = 0
+    # the sizes of the blobs, as declared in the manifest
+    size: int = 0
+    # what the blobs of the image take in the payload, shared blobs are counted
+    # for each image
+    size_in_payload: int = 0
+
+
+def get_blob_size_in_payload(zip_file: Payload, blob_path: BlobPath) -> int:
+    if isinstance(blob_path, (BlobPathInZip, BlobDeltaInZip)):
+        return zip_file.get_size(blob_path.zip_path)
+    if isinstance(blob_path, BlobChunksInZip):
+        return sum(
+            zip_file.get_size(get_chunk_path_in_zip(digest))
+            for digest in set(blob_path.chunks)
         )
+    return 0
+
+
+def inspect_payload(
+    zip_file: Union[IO, Path, str], encryption_key: Union[str, bytes, None] = None
+) -> list[ImageInPayload]:
+    """Lists the docker images of a payload, with the number and the size of their blobs.
+
+    Only the payload descriptor, the manifests and the list of the files of the
+    payload (the central directory of the zip file) are read.
+
+    # Arguments
+        zip_file: the zip file containing the payload. It can be a `pathlib.Path`, a `str`
+            or a file-like object. It can also be the path of a directory if the payload
+            was written as an OCI image layout.
+        encryption_key: the passphrase the payload was encrypted with, if it was.
+
+    # Returns
+        One `ImageInPayload` for each docker image, in the order in which they are
+        pushed.
+    """
+    images = []
+    with open_payload(zip_file, encryption_key) as zip_file:
+        payload_descriptor = get_payload_descriptor(zip_file)
+        for docker_image, manifest_path in payload_descriptor.manifests_paths.items():
+            if manifest_path is None:
+                images.append(
+                    ImageInPayload(docker_image=docker_image, in_payload=False)
+                )
+                continue
+            manifest = read_manifest_from_zip(zip_file, docker_image, manifest_path)
+            image = ImageInPayload(docker_image=docker_image, in_payload=True)
+            for blob in manifest.get_list_of_blobs():
+                blob_path = payload_descriptor.blobs_paths[blob.digest]
+                image.blobs += 1
+                image.size += blob.size or 0
+                if not isinstance(blob_path, BlobLocationInRegistry):
+                    image.blobs_in_payload += 1
+                    image.size_in_payload += get_blob_size_in_payload(
+                        zip_file, blob_path
+                    )
+            images.append(image)
+    return images
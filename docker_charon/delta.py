@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import hashlib
+import lzma
+import struct
+import sys
+import tarfile
+import tempfile
+import zlib
+from contextlib import contextmanager
+from typing import IO, Iterable, Iterator, Optional
+
+from docker_charon.bandwidth import BandwidthLimit, limit_bandwidth
+from docker_charon.common import (
+    CHUNK_SIZE,
+    Blob,
+    BlobDeltaInZip,
+    GzipParameters,
+    Manifest,
+    file_to_generator,
+)
+from docker_charon.pipeline import prefetch
+
+# layers smaller than this are always stored in full
+DELTA_MIN_SIZE = 2**20
+# files smaller than this are stored in the patch, a copy would not save anything
+COPY_MIN_SIZE = 512
+# the layers are kept in memory up to this size, and written to a temporary file above
+SPOOL_MAX_SIZE = 2**26
+
+GZIP_MAGIC_NUMBER = b"\x1f\x8b"
+GZIP_FLAGS = {"FHCRC": 2, "FEXTRA": 4, "FNAME": 8, "FCOMMENT": 16}
+# the default parameters of zlib and gzip come first
+GZIP_CANDIDATES = [
+    (level, mem_level) for level in (6, 9, 1, 2, 3, 4, 5, 7, 8) for mem_level in (8, 9)
+]
+
+# the patch is a lzma stream of operations. Each one is a byte followed by its
+# arguments: "C" copies a range of the base, "I" inserts the bytes that follow.
+COPY_OPERATION = struct.Struct("<QQ")
+INSERT_OPERATION = struct.Struct("<Q")
+
+
+def choose_delta_bases(
+    manifests: list[Manifest], manifests_already_transferred: list[Manifest]
+) -> dict[str, Blob]:
+    """For each layer, finds a layer at the same position in an image of the
+    same repository which is already in the destination registry.
+
+    Returns a dict digest of the layer -> base layer.
+    """
+    bases_candidates = {}
+    for manifest in manifests_already_transferred:
+        for position, layer in enumerate(manifest.get_list_of_blobs()[1:]):
+            bases_candidates.setdefault((manifest.repository, position), layer)
+
+    delta_bases = {}
+    for manifest in manifests:
+        for position, layer in enumerate(manifest.get_list_of_blobs()[1:]):
+            base = bases_candidates.get((manifest.repository, position))
+            if (
+                base is not None
+                and base.digest != layer.digest
+                and layer.size is not None
+                and layer.size >= DELTA_MIN_SIZE
+            ):
+                delta_bases.setdefault(layer.digest, base)
+    return delta_bases
+
+
+def get_delta_path_in_zip(blob: Blob) -> str:
+    return f"deltas/{blob.digest}"
+
+
+def decompress_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yields the content of a gzip layer, or the content as is if it's not gzip."""
+    chunks = iter(chunks)
+    decompressor = None
+    for chunk in chunks:
+        if decompressor is None:
+            if not chunk.startswith(GZIP_MAGIC_NUMBER):
+                yield chunk
+                yield from chunks
+                return
+            decompressor = zlib.decompressobj(wbits=31)
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = b""
+            if decompressor.eof and decompressor.unused_data:
+                # a gzip file can have several members
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+
+
+def recompress_chunks(
+    chunks: Iterable[bytes], gzip_parameters: Optional[GzipParameters]
+) -> Iterator[bytes]:
+    """Compresses exactly like the original layer, if the parameters are the ones
+    given by `find_gzip_parameters`.
+    """
+    if gzip_parameters is None:
+        yield from chunks
+        return
+    yield bytes.fromhex(gzip_parameters.header)
+    compressor = zlib.compressobj(
+        gzip_parameters.level, zlib.DEFLATED, -zlib.MAX_WBITS, gzip_parameters.mem_level
+    )
+    crc = 0
+    size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+    yield struct.pack("<II", crc, size & 0xFFFFFFFF)
+
+
+def read_gzip_header(compressed: IO) -> bytes:
+    compressed.seek(0)
+    header = compressed.read(10)
+    flags = header[3]
+    if flags & GZIP_FLAGS["FEXTRA"]:
+        extra_length = compressed.read(2)
+        header += extra_length + compressed.read(struct.unpack("<H", extra_length)[0])
+    for flag in ("FNAME", "FCOMMENT"):
+        if flags & GZIP_FLAGS[flag]:
+            while (byte := compressed.read(1)) not in (b"\x00", b""):
+                header += byte
+            header += byte
+    if flags & GZIP_FLAGS["FHCRC"]:
+        header += compressed.read(2)
+    return header
+
+
+def is_reproduced_by(compressed: IO, chunks: Iterable[bytes]) -> bool:
+    """Compares as it goes, so that wrong parameters are discarded after the
+    first few kilobytes.
+    """
+    compressed.seek(0)
+    for chunk in chunks:
+        if compressed.read(len(chunk)) != chunk:
+            return False
+    return compressed.read(1) == b""
+
+
+def find_gzip_parameters(compressed: IO, uncompressed: IO) -> Optional[GzipParameters]:
+    """Finds the zlib parameters which give back the compressed layer byte for byte.
+
+    Returns None if there are none, e.g. if the layer was compressed with another
+    implementation of deflate than zlib.
+    """
+    header = read_gzip_header(compressed)
+    for level, mem_level in GZIP_CANDIDATES:
+        gzip_parameters = GzipParameters(
+            header=header.hex(), level=level, mem_level=mem_level
+        )
+        uncompressed.seek(0)
+        if is_reproduced_by(
+            compressed,
+            recompress_chunks(file_to_generator(uncompressed), gzip_parameters),
+        ):
+            return gzip_parameters
+    return None
+
+
+@contextmanager
+def spool(chunks: Iterable[bytes]) -> Iterator[IO]:
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spooled_file:
+        for chunk in chunks:
+            spooled_file.write(chunk)
+        spooled_file.seek(0)
+        yield spooled_file
+
+
+def read_range(file: IO, size: int) -> Iterator[bytes]:
+    while size:
+        chunk = file.read(min(CHUNK_SIZE, size))
+        if not chunk:
+            raise EOFError(f"{size} bytes are missing")
+        size -= len(chunk)
+        yield chunk
+
+
+def get_files_in_tar(tar_file: IO) -> list[tarfile.TarInfo]:
+    tar_file.seek(0)
+    with tarfile.open(fileobj=tar_file, mode="r:") as archive:
+        members = archive.getmembers()
+    return [
+        member
+        for member in members
+        if member.isfile() and not member.issparse() and member.size >= COPY_MIN_SIZE
+    ]
+
+
+def hash_range(file: IO, offset: int, size: int) -> str:
+    sha256 = hashlib.sha256()
+    file.seek(offset)
+    for chunk in read_range(file, size):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def index_tar_files(tar_file: IO) -> dict[tuple[str, int], int]:
+    """Returns a dict (sha256, size) of the content of a file -> its offset in the tar."""
+    index = {}
+    for member in get_files_in_tar(tar_file):
+        key = (hash_range(tar_file, member.offset_data, member.size), member.size)
+        index.setdefault(key, member.offset_data)
+    return index
+
+
+def write_patch(
+    base_index: dict[tuple[str, int], int], target_tar: IO, patch_file: IO
+) -> None:
+    """The files of the target which are in the base are copied from it, everything
+    else, including the tar headers, is inserted.
+    """
+    compressor = lzma.LZMACompressor()
+
+    def insert(start: int, end: int) -> None:
+        if start == end:
+            return
+        patch_file.write(compressor.compress(b"I" + INSERT_OPERATION.pack(end - start)))
+        target_tar.seek(start)
+        for chunk in read_range(target_tar, end - start):
+            patch_file.write(compressor.compress(chunk))
+
+    position = 0
+    for member in get_files_in_tar(target_tar):
+        key = (hash_range(target_tar, member.offset_data, member.size), member.size)
+        if key in base_index:
+            insert(position, member.offset_data)
+            patch_file.write(
+                compressor.compress(
+                    b"C" + COPY_OPERATION.pack(base_index[key], member.size)
+                )
+            )
+            position = member.offset_data + member.size
+    target_tar.seek(0, 2)
+    insert(position, target_tar.tell())
+    patch_file.write(compressor.flush())
+
+
+def apply_patch(patch_file: IO, base_tar: IO) -> Iterator[bytes]:
+    """Yields the uncompressed content of the target layer."""
+    with lzma.open(patch_file) as operations:
+        while operation := operations.read(1):
+            if operation == b"C":
+                offset, size = COPY_OPERATION.unpack(
+                    operations.read(COPY_OPERATION.size)
+                )
+                base_tar.seek(offset)
+                yield from read_range(base_tar, size)
+            elif operation == b"I":
+                (size,) = INSERT_OPERATION.unpack(
+                    operations.read(INSERT_OPERATION.size)
+                )
+                yield from read_range(operations, size)
+            else:
+                raise ValueError(f"Unknown operation {operation} in the patch.")
+
+
+def make_delta(
+    base: Blob,
+    target: Blob,
+    compressed_target: IO,
+    patch_file: IO,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Optional[BlobDeltaInZip]:
+    """Writes in `patch_file` a patch which rebuilds `target` from `base`.
+
+    Returns None if the target can't be rebuilt byte for byte from its
+    uncompressed content, in which case it must be stored in full.
+    """
+    compressed_target.seek(0)
+    is_gzip = compressed_target.read(2) == GZIP_MAGIC_NUMBER
+    compressed_target.seek(0)
+    with spool(decompress_chunks(file_to_generator(compressed_target))) as target_tar:
+        gzip_parameters = None
+        if is_gzip:
+            gzip_parameters = find_gzip_parameters(compressed_target, target_tar)
+            if gzip_parameters is None:
+                print(
+                    f"{target} can't be compressed again identically, "
+                    f"it's not possible to store it as a delta",
+                    file=sys.stderr,
+                )
+                return None
+        base_chunks = limit_bandwidth(base.pull_chunks(), bandwidth)
+        with spool(decompress_chunks(prefetch(base_chunks))) as base_tar:
+            base_index = index_tar_files(base_tar)
+        write_patch(base_index, target_tar, patch_file)
+    return BlobDeltaInZip(
+        zip_path=get_delta_path_in_zip(target),
+        base_digest=base.digest,
+        base_repository=base.repository,
+        gzip=gzip_parameters,
+    )
@@ -1,33 +1,154 @@
 from __future__ import annotations
 
+import json
+import os
+import shutil
 import sys
+import tarfile
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import IO, Iterator, Optional, Union
-from zipfile import ZipFile
+from typing import IO, Iterable, Iterator, Optional, Union
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
-from dxf import DXF, DXFBase
+from dxf import DXFBase
 from tqdm import tqdm
 
+from docker_charon.archive import OCI_MANIFEST_MEDIA_TYPE, load_docker_archives
+from docker_charon.bandwidth import (
+    BandwidthLimit,
+    get_bandwidth_limit,
+    limit_bandwidth,
+    parse_size,
+)
+from docker_charon.chunks import CHUNKED_BLOB_MIN_SIZE, add_chunks_to_zip
 from docker_charon.common import (
-    PYDANTIC_V2,
+    CHUNK_SIZE,
+    OCI_LAYOUT_BLOB_PATH_TEMPLATE,
     Authenticator,
     Blob,
+    BlobChunksInZip,
+    BlobDeltaInZip,
     BlobLocationInRegistry,
     BlobPathInZip,
     Manifest,
     PayloadDescriptor,
+    PayloadPart,
     PayloadSide,
+    file_to_generator,
+    format_blob_path,
+    get_blob_path_in_oci_layout,
+    get_manifest_content_digest,
     progress_as_string,
+    write_file_atomically,
+)
+from docker_charon.concurrency import AdaptiveConcurrency
+from docker_charon.delta import choose_delta_bases, make_delta, spool
+from docker_charon.encryption import (
+    ENCRYPTION_PARAMETERS_PATH,
+    PayloadCipher,
+    encrypt_member,
 )
+from docker_charon.manifest_cache import get_cached_manifests
+from docker_charon.pipeline import prefetch
+from docker_charon.profiling import enter_phase
+from docker_charon.schedule import order_largest_first, print_plan
+from docker_charon.shards import get_shard_path, plan_shards, print_plan_of_shards
+from docker_charon.tag_selectors import expand_docker_images
 
+ZIP_BLOB_PATH_TEMPLATE = "blobs/{digest}"
+# a delta is only stored if it's smaller than this fraction of the blob
+MAX_DELTA_RATIO = 0.8
 
-def add_blobs_to_zip(
-    dxf_base: DXFBase,
-    zip_file: ZipFile,
+
+class PreallocatedZipFile(ZipFile):
+    """A `ZipFile` in which members of known size can be written concurrently.
+
+    The local headers and data regions of those members are laid out in advance
+    with `reserve`. Each one is then filled with `os.pwrite` by `write_reserved`,
+    from any thread. The other members are written normally after the reserved
+    regions, and `close` writes the central directory, so the result is a
+    standard zip64 file.
+    """
+
+    def __init__(self, file: Union[IO, Path, str]):
+        super().__init__(file, "w")
+        self._fd = self.fp.fileno()
+
+    @staticmethod
+    def can_preallocate(file: Union[IO, Path, str]) -> bool:
+        if not hasattr(os, "pwrite"):
+            return False
+        if isinstance(file, (str, Path)):
+            return True
+        try:
+            file.fileno()
+            return file.seekable()
+        except (AttributeError, OSError, ValueError):
+            return False
+
+    def reserve(self, name: str, size: int) -> ZipInfo:
+        """Reserves the space for a member. Must be called before writing other members."""
+        zip_info = ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zip_info.compress_type = ZIP_STORED
+        zip_info.external_attr = 0o600 << 16
+        zip_info.file_size = zip_info.compress_size = size
+        zip_info.CRC = 0
+        zip_info.header_offset = self.start_dir
+        # the members written with ZipFile.open/writestr and the central
+        # directory go after all the reserved regions
+        self.start_dir += len(zip_info.FileHeader(zip64=True)) + size
+        self.filelist.append(zip_info)
+        self.NameToInfo[name] = zip_info
+        return zip_info
+
+    def write_reserved(self, zip_info: ZipInfo, chunks: Iterable[bytes]) -> None:
+        offset = zip_info.header_offset + len(zip_info.FileHeader(zip64=True))
+        end_of_member = offset + zip_info.file_size
+        crc = 0
+        for chunk in chunks:
+            if offset + len(chunk) > end_of_member:
+                raise ValueError(
+                    f"{zip_info.filename} is bigger than the "
+                    f"{zip_info.file_size} bytes reserved for it."
+                )
+            pwrite_all(self._fd, chunk, offset)
+            offset += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+        if offset != end_of_member:
+            raise ValueError(
+                f"{zip_info.filename} is smaller than the "
+                f"{zip_info.file_size} bytes reserved for it."
+            )
+        # the CRC is only known now, we can write the local header
+        zip_info.CRC = crc
+        pwrite_all(self._fd, zip_info.FileHeader(zip64=True), zip_info.header_offset)
+
+
+def pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    data = memoryview(data)
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+def iter_blobs_to_transfer(
     blobs_to_pull: list[Blob],
     blobs_already_transferred: list[Blob],
-) -> dict[str, Union[BlobPathInZip, BlobLocationInRegistry]]:
-    blobs_paths = {}
+    blobs_paths: dict[str, Union[BlobPathInZip, BlobLocationInRegistry]],
+    part: Optional[PayloadPart] = None,
+) -> Iterator[Blob]:
+    """Yields the blobs that must be transferred to the destination registry.
+
+    The blobs that were already yielded or that are already in the destination
+    registry are skipped. For the latter, their location in the destination
+    registry is written to `blobs_paths`. The caller must add the yielded blobs to
+    `blobs_paths` before asking for the next one. With `part`, the blobs of the
+    other parts are skipped as well.
+    """
     for blob_index, blob in enumerate(blobs_to_pull):
         print(progress_as_string(blob_index, blobs_to_pull), end=" ", file=sys.stderr)
         if blob.digest in blobs_paths:
@@ -50,27 +171,405 @@ def add_blobs_to_zip(
             )
             continue
 
+        if part is not None and not part.has_blob(blob.digest):
+            print(
+                f"Skipping {blob} because it's in the part "
+                f"{part.get_part_of_blob(blob.digest)}/{part.count}",
+                file=sys.stderr,
+            )
+            continue
+
+        yield blob
+
+
+def add_blobs_to_zip(
+    dxf_base: DXFBase,
+    zip_file: ZipFile,
+    blobs_to_pull: list[Blob],
+    blobs_already_transferred: list[Blob],
+    workers: int = 1,
+    local_oci_layout: Optional[Path] = None,
+    delta_bases: dict[str, Blob] = {},
+    dedup_chunks: bool = False,
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+    part: Optional[PayloadPart] = None,
+) -> dict[
+    str, Union[BlobDeltaInZip, BlobChunksInZip, BlobPathInZip, BlobLocationInRegistry]
+]:
+    blobs_paths = {}
+    blobs_to_download = []
+    blobs_to_diff = []
+    blobs_to_split = []
+    for blob in iter_blobs_to_transfer(
+        blobs_to_pull, blobs_already_transferred, blobs_paths, part
+    ):
+        if blob.digest in delta_bases:
+            print(
+                f"Pulling blob {blob} to compute a delta with "
+                f"{delta_bases[blob.digest]}",
+                file=sys.stderr,
+            )
+            # replaced by the delta, if any, once it's computed
+            blobs_paths[blob.digest] = BlobPathInZip(
+                zip_path=get_blob_path_in_zip(blob)
+            )
+            blobs_to_diff.append(blob)
+            continue
+        if (
+            dedup_chunks
+            and blob.size is not None
+            and blob.size >= CHUNKED_BLOB_MIN_SIZE
+        ):
+            print(f"Pulling blob {blob} to split it in chunks", file=sys.stderr)
+            # replaced by the chunks, if any, once they are written
+            blobs_paths[blob.digest] = BlobPathInZip(
+                zip_path=get_blob_path_in_zip(blob)
+            )
+            blobs_to_split.append(blob)
+            continue
         # nominal case
         print(f"Pulling blob {blob} and storing it in the zip", file=sys.stderr)
-        blob_path_in_zip = download_blob_to_zip(dxf_base, blob, zip_file)
-        blobs_paths[blob.digest] = BlobPathInZip(zip_path=blob_path_in_zip)
+        blobs_paths[blob.digest] = BlobPathInZip(zip_path=get_blob_path_in_zip(blob))
+        blobs_to_download.append(blob)
+
+    if isinstance(zip_file, PreallocatedZipFile) and all(
+        blob.size is not None for blob in blobs_to_download
+    ):
+        download_blobs_to_reserved_regions(
+            dxf_base,
+            zip_file,
+            blobs_to_download,
+            workers,
+            local_oci_layout,
+            max_workers,
+            bandwidth,
+            cipher,
+        )
+    else:
+        for blob in blobs_to_download:
+            download_blob_to_zip(
+                dxf_base, blob, zip_file, local_oci_layout, bandwidth, cipher
+            )
+    for blob in blobs_to_diff:
+        blobs_paths[blob.digest] = add_delta_or_blob_to_zip(
+            blob, delta_bases[blob.digest], zip_file, local_oci_layout, bandwidth
+        )
+    chunks_in_zip = set()
+    for blob in blobs_to_split:
+        blobs_paths[blob.digest] = add_chunks_or_blob_to_zip(
+            blob, zip_file, chunks_in_zip, local_oci_layout, bandwidth
+        )
     return blobs_paths
 
 
-def download_blob_to_zip(dxf_base: DXFBase, blob: Blob, zip_file: ZipFile):
-    repository_dxf = DXF.from_base(dxf_base, blob.repository)
-    bytes_iterator, total_size = repository_dxf.pull_blob(blob.digest, size=True)
+def get_blob_path_in_zip(blob: Blob) -> str:
+    return format_blob_path(ZIP_BLOB_PATH_TEMPLATE, blob.digest)
+
+
+def is_blob_in_oci_layout(oci_layout: Optional[Path], blob: Blob) -> bool:
+    if oci_layout is None:
+        return False
+    blob_path = oci_layout / get_blob_path_in_oci_layout(blob.digest)
+    # the blobs are written atomically, checking the size is enough
+    return blob_path.is_file() and blob.size in (None, blob_path.stat().st_size)
+
+
+def pull_blob_chunks(
+    blob: Blob,
+    local_oci_layout: Optional[Path] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Iterator[bytes]:
+    """Yields the content of the blob. It's read from `local_oci_layout` if the blob
+    is there, otherwise it's pulled from where the blob comes from, within `bandwidth`.
+    """
+    if is_blob_in_oci_layout(local_oci_layout, blob):
+        blob_path = local_oci_layout / get_blob_path_in_oci_layout(blob.digest)
+        with open(blob_path, "rb") as blob_file:
+            yield from file_to_generator(blob_file)
+    else:
+        # the sha256 of the blob is checked by the thread which pulls it
+        yield from prefetch(limit_bandwidth(blob.pull_chunks(), bandwidth))
+
 
+def download_blob_to_zip(
+    dxf_base: DXFBase,
+    blob: Blob,
+    zip_file: ZipFile,
+    local_oci_layout: Optional[Path] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+):
     # we write the blob directly to the zip file
-    with tqdm(total=total_size, unit="B", unit_scale=True) as pbar:
-        blob_path_in_zip = f"blobs/{blob.digest}"
+    with tqdm(total=blob.size, unit="B", unit_scale=True) as pbar:
+        blob_path_in_zip = get_blob_path_in_zip(blob)
+
+        def chunks_with_progress() -> Iterator[bytes]:
+            for chunk in pull_blob_chunks(blob, local_oci_layout, bandwidth):
+                pbar.update(len(chunk))
+                yield chunk
+
         with zip_file.open(blob_path_in_zip, "w", force_zip64=True) as blob_in_zip:
-            for chunk in bytes_iterator:
+            for chunk in encrypt_member(
+                cipher, blob_path_in_zip, chunks_with_progress()
+            ):
                 blob_in_zip.write(chunk)
-                pbar.update(len(chunk))
     return blob_path_in_zip
 
 
+def add_delta_or_blob_to_zip(
+    blob: Blob,
+    base: Blob,
+    zip_file: ZipFile,
+    local_oci_layout: Optional[Path] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Union[BlobDeltaInZip, BlobPathInZip]:
+    """Stores a patch rebuilding the blob from `base` if it's possible and
+    worth it, otherwise the blob itself.
+    """
+    with spool(pull_blob_chunks(blob, local_oci_layout, bandwidth)) as compressed_blob:
+        with tempfile.TemporaryFile() as patch_file:
+            try:
+                blob_path = make_delta(
+                    base, blob, compressed_blob, patch_file, bandwidth
+                )
+            except tarfile.TarError:
+                print(
+                    f"{blob} is not a tar file, no delta is possible", file=sys.stderr
+                )
+                blob_path = None
+            if (
+                blob_path is not None
+                and patch_file.tell() < blob.size * MAX_DELTA_RATIO
+            ):
+                print(
+                    f"Storing {blob} as a delta of {patch_file.tell()} bytes "
+                    f"instead of {blob.size} bytes",
+                    file=sys.stderr,
+                )
+                patch_file.seek(0)
+                copy_file_to_zip(patch_file, zip_file, blob_path.zip_path)
+                return blob_path
+        compressed_blob.seek(0)
+        blob_path_in_zip = get_blob_path_in_zip(blob)
+        copy_file_to_zip(compressed_blob, zip_file, blob_path_in_zip)
+        return BlobPathInZip(zip_path=blob_path_in_zip)
+
+
+def add_chunks_or_blob_to_zip(
+    blob: Blob,
+    zip_file: ZipFile,
+    chunks_in_zip: set[str],
+    local_oci_layout: Optional[Path] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Union[BlobChunksInZip, BlobPathInZip]:
+    """Stores the chunks of the blob which are not in the zip yet if possible,
+    otherwise the blob itself.
+    """
+    with spool(pull_blob_chunks(blob, local_oci_layout, bandwidth)) as compressed_blob:
+        try:
+            blob_path = add_chunks_to_zip(
+                blob, compressed_blob, zip_file, chunks_in_zip
+            )
+        except tarfile.TarError:
+            print(f"{blob} is not a tar file, it can't be split", file=sys.stderr)
+            blob_path = None
+        if blob_path is not None:
+            print(f"Stored {blob} as {len(blob_path.chunks)} chunks", file=sys.stderr)
+            return blob_path
+        compressed_blob.seek(0)
+        blob_path_in_zip = get_blob_path_in_zip(blob)
+        copy_file_to_zip(compressed_blob, zip_file, blob_path_in_zip)
+        return BlobPathInZip(zip_path=blob_path_in_zip)
+
+
+def copy_file_to_zip(file: IO, zip_file: ZipFile, path_in_zip: str) -> None:
+    with zip_file.open(path_in_zip, "w", force_zip64=True) as file_in_zip:
+        shutil.copyfileobj(file, file_in_zip, CHUNK_SIZE)
+
+
+def download_blobs_to_reserved_regions(
+    dxf_base: DXFBase,
+    zip_file: PreallocatedZipFile,
+    blobs: list[Blob],
+    workers: int,
+    local_oci_layout: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+) -> None:
+    # the blobs stay in the order of the manifests in the zip file
+    zip_infos = {
+        blob.digest: zip_file.reserve(
+            get_blob_path_in_zip(blob),
+            blob.size if cipher is None else cipher.get_encrypted_size(blob.size),
+        )
+        for blob in blobs
+    }
+    blobs = order_largest_first(blobs, lambda blob: blob.size)
+    print_plan_of_downloads(blobs, workers, bandwidth)
+    total_size = sum(blob.size for blob in blobs)
+    concurrency = AdaptiveConcurrency(workers, max_workers)
+    with tqdm(total=total_size, unit="B", unit_scale=True) as pbar:
+        with ThreadPoolExecutor(max_workers=concurrency.maximum) as executor:
+            downloads = [
+                executor.submit(
+                    concurrency.run,
+                    download_blob_to_reserved_region,
+                    dxf_base,
+                    blob,
+                    zip_file,
+                    zip_infos[blob.digest],
+                    pbar,
+                    local_oci_layout,
+                    bandwidth,
+                    cipher,
+                    size=blob.size,
+                    priority=rank,
+                )
+                for rank, blob in enumerate(blobs)
+            ]
+            for download in downloads:
+                download.result()
+
+
+def print_plan_of_downloads(
+    blobs: list[Blob], workers: int, bandwidth: Optional[BandwidthLimit]
+) -> None:
+    print_plan(
+        "Pulling",
+        [blob.size or 0 for blob in blobs],
+        workers,
+        None if bandwidth is None else bandwidth.get_rate(),
+    )
+
+
+def download_blob_to_reserved_region(
+    dxf_base: DXFBase,
+    blob: Blob,
+    zip_file: PreallocatedZipFile,
+    zip_info: ZipInfo,
+    pbar: tqdm,
+    local_oci_layout: Optional[Path] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+) -> None:
+    downloaded = 0
+
+    def chunks_with_progress() -> Iterator[bytes]:
+        nonlocal downloaded
+        for chunk in pull_blob_chunks(blob, local_oci_layout, bandwidth):
+            pbar.update(len(chunk))
+            downloaded += len(chunk)
+            yield chunk
+
+    try:
+        zip_file.write_reserved(
+            zip_info,
+            encrypt_member(cipher, zip_info.filename, chunks_with_progress()),
+        )
+    except Exception:
+        # the download may be retried from the start
+        pbar.update(-downloaded)
+        raise
+
+
+def add_blobs_to_oci_layout(
+    dxf_base: DXFBase,
+    oci_layout: Path,
+    blobs_to_pull: list[Blob],
+    blobs_already_transferred: list[Blob],
+    workers: int = 1,
+    local_oci_layout: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> dict[str, Union[BlobPathInZip, BlobLocationInRegistry]]:
+    blobs_paths = {}
+    blobs_to_download = []
+    for blob in iter_blobs_to_transfer(
+        blobs_to_pull, blobs_already_transferred, blobs_paths
+    ):
+        blob_path = get_blob_path_in_oci_layout(blob.digest)
+        blobs_paths[blob.digest] = BlobPathInZip(zip_path=blob_path)
+        if is_blob_in_oci_layout(oci_layout, blob):
+            print(f"Reusing blob {blob} already in {oci_layout}", file=sys.stderr)
+        elif is_blob_in_oci_layout(local_oci_layout, blob):
+            print(f"Linking blob {blob} from {local_oci_layout}", file=sys.stderr)
+            link_or_copy(local_oci_layout / blob_path, oci_layout / blob_path)
+        else:
+            print(
+                f"Pulling blob {blob} and storing it in {oci_layout}", file=sys.stderr
+            )
+            blobs_to_download.append(blob)
+
+    blobs_to_download = order_largest_first(
+        blobs_to_download, lambda blob: blob.size or 0
+    )
+    print_plan_of_downloads(blobs_to_download, workers, bandwidth)
+    total_size = sum(blob.size or 0 for blob in blobs_to_download)
+    concurrency = AdaptiveConcurrency(workers, max_workers)
+    with tqdm(total=total_size, unit="B", unit_scale=True) as pbar:
+        with ThreadPoolExecutor(max_workers=concurrency.maximum) as executor:
+            downloads = [
+                executor.submit(
+                    concurrency.run,
+                    download_blob_to_oci_layout,
+                    dxf_base,
+                    blob,
+                    oci_layout,
+                    pbar,
+                    bandwidth,
+                    size=blob.size or 0,
+                    priority=rank,
+                )
+                for rank, blob in enumerate(blobs_to_download)
+            ]
+            for download in downloads:
+                download.result()
+    return blobs_paths
+
+
+def download_blob_to_oci_layout(
+    dxf_base: DXFBase,
+    blob: Blob,
+    oci_layout: Path,
+    pbar: tqdm,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> None:
+    blob_path = oci_layout / get_blob_path_in_oci_layout(blob.digest)
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    # written under another name and renamed once complete, so that an interrupted
+    # run never leaves a truncated blob that the next run would reuse
+    temporary_path = blob_path.with_name(blob_path.name + ".tmp")
+    downloaded = 0
+    try:
+        with open(temporary_path, "wb") as blob_file:
+            for chunk in pull_blob_chunks(blob, bandwidth=bandwidth):
+                blob_file.write(chunk)
+                pbar.update(len(chunk))
+                downloaded += len(chunk)
+    except Exception:
+        # the download may be retried from the start
+        pbar.update(-downloaded)
+        raise
+    os.replace(temporary_path, blob_path)
+
+
+def link_or_copy(source: Path, destination: Path) -> None:
+    """Blobs are immutable, so they can be shared between OCI layouts with hardlinks."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = destination.with_name(destination.name + ".tmp")
+    if temporary_path.exists():
+        temporary_path.unlink()
+    try:
+        os.link(source, temporary_path)
+    except OSError:
+        # not on the same filesystem, or links are not supported
+        shutil.copyfile(source, temporary_path)
+    os.replace(temporary_path, destination)
+
+
 def get_blob_with_same_digest(list_of_blobs: list[Blob], digest: str) -> Optional[Blob]:
     for blob in list_of_blobs:
         if blob.digest == digest:
@@ -78,19 +577,28 @@ def get_blob_with_same_digest(list_of_blobs: list[Blob], digest: str) -> Optiona
 
 
 def get_manifest_and_list_of_blobs_to_pull(
-    dxf_base: DXFBase, docker_image: str
+    dxf_base: DXFBase,
+    docker_image: str,
+    archived_manifests: dict[str, Manifest] = {},
 ) -> tuple[Manifest, list[Blob]]:
-    manifest = Manifest(dxf_base, docker_image, PayloadSide.ENCODER)
+    if docker_image in archived_manifests:
+        manifest = archived_manifests[docker_image]
+    else:
+        manifest = Manifest(dxf_base, docker_image, PayloadSide.ENCODER)
     return manifest, manifest.get_list_of_blobs()
 
 
 def get_manifests_and_list_of_all_blobs(
-    dxf_base: DXFBase, docker_images: Iterator[str]
+    dxf_base: DXFBase,
+    docker_images: Iterator[str],
+    archived_manifests: dict[str, Manifest] = {},
 ) -> tuple[list[Manifest], list[Blob]]:
     manifests = []
     blobs_to_pull = []
     for docker_image in docker_images:
-        manifest, blobs = get_manifest_and_list_of_blobs_to_pull(dxf_base, docker_image)
+        manifest, blobs = get_manifest_and_list_of_blobs_to_pull(
+            dxf_base, docker_image, archived_manifests
+        )
         manifests.append(manifest)
         blobs_to_pull += blobs
     return manifests, blobs_to_pull
@@ -104,6 +612,36 @@ def uniquify_blobs(blobs: list[Blob]) -> list[Blob]:
     return result
 
 
+def get_blobs_of_images(
+    dxf_base: DXFBase,
+    docker_images_to_transfer: list[str],
+    docker_images_already_transferred: list[str],
+    archived_manifests: dict[str, Manifest],
+) -> dict[str, dict[str, int]]:
+    """The blobs each image needs in a payload, digest -> size. The manifests are
+    added to `archived_manifests`, so that they are fetched only once.
+    """
+    manifests, blobs_already_transferred = get_manifests_and_list_of_all_blobs(
+        dxf_base, docker_images_already_transferred, archived_manifests
+    )
+    digests_already_transferred = {blob.digest for blob in blobs_already_transferred}
+    for manifest in manifests:
+        archived_manifests[manifest.docker_image_name] = manifest
+    blobs_of_images = {}
+    for docker_image in docker_images_to_transfer:
+        blobs_of_images[docker_image] = {}
+        if docker_image in docker_images_already_transferred:
+            continue
+        manifest, blobs = get_manifest_and_list_of_blobs_to_pull(
+            dxf_base, docker_image, archived_manifests
+        )
+        archived_manifests[docker_image] = manifest
+        for blob in blobs:
+            if blob.digest not in digests_already_transferred:
+                blobs_of_images[docker_image][blob.digest] = blob.size or 0
+    return blobs_of_images
+
+
 def separate_images_to_transfer_and_images_to_skip(
     docker_images_to_transfer: list[str], docker_images_already_transferred: list[str]
 ) -> tuple[list[str], list[str]]:
@@ -126,28 +664,193 @@ def create_zip_from_docker_images(
     docker_images_to_transfer: list[str],
     docker_images_already_transferred: list[str],
     zip_file: ZipFile,
+    workers: int = 1,
+    local_oci_layout: Optional[Path] = None,
+    archived_manifests: dict[str, Manifest] = {},
+    delta: bool = False,
+    dedup_chunks: bool = False,
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+    part: Optional[PayloadPart] = None,
+    compact_descriptor: bool = False,
 ) -> None:
+    enter_phase("planning")
     payload_descriptor = PayloadDescriptor.from_images(
         docker_images_to_transfer, docker_images_already_transferred
     )
+    payload_descriptor.part = part
 
     manifests, blobs_to_pull = get_manifests_and_list_of_all_blobs(
-        dxf_base, payload_descriptor.get_images_not_transferred_yet()
+        dxf_base,
+        payload_descriptor.get_images_not_transferred_yet(),
+        archived_manifests,
     )
-    _, blobs_already_transferred = get_manifests_and_list_of_all_blobs(
-        dxf_base, docker_images_already_transferred
+    (
+        manifests_already_transferred,
+        blobs_already_transferred,
+    ) = get_manifests_and_list_of_all_blobs(
+        dxf_base, docker_images_already_transferred, archived_manifests
     )
+    delta_bases = {}
+    if delta:
+        delta_bases = choose_delta_bases(manifests, manifests_already_transferred)
+    enter_phase("transfer", zip_phase="zip write")
     payload_descriptor.blobs_paths = add_blobs_to_zip(
-        dxf_base, zip_file, blobs_to_pull, blobs_already_transferred
+        dxf_base,
+        zip_file,
+        blobs_to_pull,
+        blobs_already_transferred,
+        workers,
+        local_oci_layout,
+        delta_bases,
+        dedup_chunks,
+        max_workers,
+        bandwidth,
+        cipher,
+        part,
     )
+    # the central directory is written when the zip file is closed, after this
+    enter_phase("finalize")
     for manifest in manifests:
         dest = payload_descriptor.manifests_paths[manifest.docker_image_name]
-        zip_file.writestr(dest, manifest.content)
-    if PYDANTIC_V2:
-        payload_descriptor_json = payload_descriptor.model_dump_json(indent=4)
+        write_member(zip_file, dest, manifest.content, cipher)
+    write_member(
+        zip_file,
+        "payload_descriptor.json",
+        payload_descriptor.to_json(ZIP_BLOB_PATH_TEMPLATE, compact_descriptor),
+        cipher,
+    )
+    if cipher is not None:
+        zip_file.writestr(ENCRYPTION_PARAMETERS_PATH, cipher.parameters.to_json())
+
+
+def write_member(
+    zip_file: ZipFile, name: str, content: str, cipher: Optional[PayloadCipher]
+) -> None:
+    if cipher is None:
+        zip_file.writestr(name, content)
+    else:
+        zip_file.writestr(name, cipher.encrypt_bytes(name, content))
+
+
+def get_manifest_media_type(manifest_content: str) -> str:
+    """The `mediaType` is optional in OCI image manifests."""
+    return json.loads(manifest_content).get("mediaType", OCI_MANIFEST_MEDIA_TYPE)
+
+
+def create_oci_layout_from_docker_images(
+    dxf_base: DXFBase,
+    docker_images_to_transfer: list[str],
+    docker_images_already_transferred: list[str],
+    oci_layout: Path,
+    workers: int = 1,
+    local_oci_layout: Optional[Path] = None,
+    archived_manifests: dict[str, Manifest] = {},
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    compact_descriptor: bool = False,
+) -> None:
+    """Writes the payload as an OCI image layout, with the payload descriptor
+    at its root.
+
+    Blobs already present in the directory, e.g. from a previous run, are kept
+    as they are. So an incremental transfer is only a copy (or rsync) of the new
+    files in `blobs/sha256/`.
+    """
+    enter_phase("planning")
+    payload_descriptor = PayloadDescriptor.from_images(
+        docker_images_to_transfer, docker_images_already_transferred
+    )
+
+    manifests, blobs_to_pull = get_manifests_and_list_of_all_blobs(
+        dxf_base,
+        payload_descriptor.get_images_not_transferred_yet(),
+        archived_manifests,
+    )
+    _, blobs_already_transferred = get_manifests_and_list_of_all_blobs(
+        dxf_base, docker_images_already_transferred, archived_manifests
+    )
+    enter_phase("transfer")
+    payload_descriptor.blobs_paths = add_blobs_to_oci_layout(
+        dxf_base,
+        oci_layout,
+        blobs_to_pull,
+        blobs_already_transferred,
+        workers,
+        local_oci_layout,
+        max_workers,
+        bandwidth,
+    )
+
+    enter_phase("finalize")
+    index = {"schemaVersion": 2, "manifests": []}
+    for manifest in manifests:
+        manifest_content = manifest.content.encode()
+        manifest_digest = get_manifest_content_digest(manifest.content)
+        manifest_path = get_blob_path_in_oci_layout(manifest_digest)
+        write_file_atomically(oci_layout / manifest_path, manifest_content)
+        payload_descriptor.manifests_paths[manifest.docker_image_name] = manifest_path
+        index["manifests"].append(
+            {
+                "mediaType": get_manifest_media_type(manifest.content),
+                "digest": manifest_digest,
+                "size": len(manifest_content),
+                "annotations": {
+                    "io.containerd.image.name": manifest.docker_image_name,
+                    "org.opencontainers.image.ref.name": manifest.tag,
+                },
+            }
+        )
+    write_file_atomically(
+        oci_layout / "oci-layout", json.dumps({"imageLayoutVersion": "1.0.0"}).encode()
+    )
+    write_file_atomically(oci_layout / "index.json", json.dumps(index).encode())
+    write_file_atomically(
+        oci_layout / "payload_descriptor.json",
+        payload_descriptor.to_json(
+            OCI_LAYOUT_BLOB_PATH_TEMPLATE, compact_descriptor
+        ).encode(),
+    )
+
+
+def write_payload_zip(
+    dxf_base: DXFBase,
+    docker_images_to_transfer: list[str],
+    docker_images_already_transferred: list[str],
+    zip_file: Union[IO, Path, str],
+    workers: int = 1,
+    local_oci_layout: Optional[Path] = None,
+    archived_manifests: dict[str, Manifest] = {},
+    delta: bool = False,
+    dedup_chunks: bool = False,
+    max_workers: Optional[int] = None,
+    bandwidth: Optional[BandwidthLimit] = None,
+    cipher: Optional[PayloadCipher] = None,
+    part: Optional[PayloadPart] = None,
+    compact_descriptor: bool = False,
+) -> None:
+    if PreallocatedZipFile.can_preallocate(zip_file):
+        zip_file_opened = PreallocatedZipFile(zip_file)
     else:
-        payload_descriptor_json = payload_descriptor.json(indent=4)
-    zip_file.writestr("payload_descriptor.json", payload_descriptor_json)
+        zip_file_opened = ZipFile(zip_file, "w")
+    with zip_file_opened:
+        create_zip_from_docker_images(
+            dxf_base,
+            docker_images_to_transfer,
+            docker_images_already_transferred,
+            zip_file_opened,
+            workers,
+            local_oci_layout,
+            archived_manifests,
+            delta,
+            dedup_chunks,
+            max_workers,
+            bandwidth,
+            cipher,
+            part,
+            compact_descriptor,
+        )
 
 
 def make_payload(
@@ -158,6 +861,18 @@ def make_payload(
     secure: bool = True,
     username: Optional[str] = None,
     password: Optional[str] = None,
+    workers: int = 4,
+    local_oci_layout: Union[Path, str, None] = None,
+    docker_archives: list[Union[Path, str]] = [],
+    delta: bool = False,
+    dedup_chunks: bool = False,
+    max_workers: Optional[int] = None,
+    max_bandwidth: Union[str, float, None] = None,
+    encryption_key: Union[str, bytes, None] = None,
+    part: Union[str, PayloadPart, None] = None,
+    max_payload_size: Union[str, int, None] = None,
+    manifest_cache: Union[Path, str, None] = None,
+    compact_descriptor: bool = False,
 ) -> None:
     """
     Creates a payload from a list of docker images
@@ -169,9 +884,13 @@ def make_payload(
     # Arguments
         zip_file: The path to the zip file to create. It can be a `pathlib.Path` or
             a `str`. It's also possible to pass a file-like object. The payload with
-            all the docker images is a single zip file.
+            all the docker images is a single zip file. If it's the path of an existing
+            directory, the payload is written there as an OCI image layout instead.
+            Blobs already in this directory are not pulled again.
         docker_images_to_transfer: The list of docker images to transfer. Do not include
-            the registry name in the image name.
+            the registry name in the image name. It can have selectors of tags,
+            like `python:3.12.*`, `python:>=3.11 <3.13` or `nginx:#5`, which are
+            replaced by the docker images they select, see "Mirroring tags".
         docker_images_already_transferred: The list of docker images that have already
             been transferred to the air-gapped registry. Do not include the registry
             name in the image name.
@@ -182,16 +901,170 @@ def make_payload(
             the registry doesn't require authentication.
         password: The password to use for authentication to the registry. Optional if
             the registry doesn't require authentication.
+        workers: The number of blobs downloaded concurrently at the start. Default is 4.
+            It's then adjusted to the registry: increased while the throughput improves,
+            halved when the registry answers 429 or 503. Blobs are downloaded one at a
+            time if the zip file is not a regular file (e.g. stdout piped to another
+            program).
+        local_oci_layout: An OCI image layout directory, e.g. a previous payload written
+            as a directory. Blobs found there are read from it instead of being pulled
+            from the registry. When writing an OCI image layout, they are hardlinked.
+        docker_archives: Paths of uncompressed tar archives made by `docker save`, or of
+            OCI archives. The docker images found in those archives are taken from
+            them instead of the registry. Their manifests are rebuilt as docker image
+            manifests, and the layers of `docker save` stay uncompressed.
+        delta: Set to `True` to store a changed layer as a binary patch against the
+            layer at the same position of an image of the same repository in
+            `docker_images_already_transferred`. Only the files which changed are
+            in the patch. A layer is stored in full if the patch doesn't save
+            enough space, or if its compression can't be reproduced identically by
+            zlib. Not available when the payload is written as an OCI image layout.
+        dedup_chunks: Set to `True` to split the layers in chunks, one for each big
+            file, and to store each chunk only once in the payload. The same files
+            in different layers are then stored once. Like with `delta`, a layer
+            is stored in full if its compression can't be reproduced identically
+            by zlib. Not available when the payload is written as an OCI image layout.
+        max_workers: The maximum number of blobs downloaded concurrently. Default is
+            16, or `workers` if it's bigger. Set it to `workers` for a fixed number
+            of concurrent downloads.
+        max_bandwidth: The maximum bandwidth used by all the downloads together, in
+            bytes per second, or a string like `"200MB/s"`. It can follow a schedule
+            in local time, like `"09:00-18:00=50MB/s,200MB/s"`: 50MB/s during
+            business hours, 200MB/s otherwise. Unlimited by default.
+        encryption_key: A passphrase to encrypt the payload with. The blobs, the
+            manifests and the payload descriptor are encrypted with AES-256-GCM while
+            they are written, nothing is written in plaintext, even temporarily.
+            The same passphrase is needed to push the payload. Not available with
+            `delta`, `dedup_chunks` or an OCI image layout.
+        part: To build the payload on several hosts, e.g. `"2/4"` for the second part
+            out of four. Each host makes its part with the same arguments, and only
+            pulls the blobs which belong to its part, chosen from their digests.
+            The parts are then merged with `docker_charon.merge_payloads`. Not
+            available with `encryption_key` or an OCI image layout.
+        max_payload_size: The maximum size of a payload, in bytes or as a string like
+            `"500GB"`. If the images don't fit, they are split into several payloads,
+            each one can be pushed on its own: `payload.zip` becomes `payload-1.zip`,
+            `payload-2.zip`... The images which share layers are kept together,
+            the shared layers of images in different payloads are in each of them.
+            The size is the one of the blobs declared in the manifests. `zip_file`
+            must be a path. Not available with `part`.
+        manifest_cache: A directory where the manifests are kept between runs. The
+            manifests of the tags which didn't change since the previous run are
+            taken from there, after a HEAD request, instead of being downloaded.
+            Docker Hub doesn't count those HEAD requests in its pull rate limit.
+        compact_descriptor: Set to `True` to write the payload descriptor in its
+            compact encoding, about half the size and ten times faster to read with
+            a hundred thousand blobs. The payload can then only be pushed with a
+            version of docker-charon newer than 0.4.3. Default is `False`, the
+            payload can be pushed by any version.
     """
+    if local_oci_layout is not None:
+        local_oci_layout = Path(local_oci_layout)
+    bandwidth = get_bandwidth_limit(max_bandwidth)
+    is_oci_layout = isinstance(zip_file, (str, Path)) and Path(zip_file).is_dir()
+    cipher = None
+    if encryption_key is not None:
+        if delta or dedup_chunks or is_oci_layout:
+            raise ValueError(
+                "An encrypted payload can't have deltas or chunks, they need "
+                "temporary files, and can't be written as an OCI image layout."
+            )
+        cipher = PayloadCipher.new(encryption_key)
+    if isinstance(part, str):
+        part = PayloadPart.parse(part)
+    if part is not None and (cipher is not None or is_oci_layout):
+        raise ValueError(
+            "A payload built in parts can't be encrypted, each part would have "
+            "its own key, and can't be written as an OCI image layout."
+        )
+    if max_payload_size is not None:
+        if not isinstance(zip_file, (str, Path)) or is_oci_layout or part is not None:
+            raise ValueError(
+                "A payload split into several payloads must be written to a path, "
+                "not as an OCI image layout, and can't be built in parts."
+            )
+        if isinstance(max_payload_size, str):
+            max_payload_size = parse_size(max_payload_size)
+    enter_phase("planning")
     authenticator = Authenticator(username, password)
 
     with DXFBase(
         host=registry, auth=authenticator.auth, insecure=not secure
     ) as dxf_base:
-        with ZipFile(zip_file, "w") as zip_file_opened:
-            create_zip_from_docker_images(
+        docker_images_to_transfer = expand_docker_images(
+            dxf_base, docker_images_to_transfer, workers
+        )
+        archived_manifests = load_docker_archives(
+            dxf_base,
+            docker_archives,
+            docker_images_to_transfer + docker_images_already_transferred,
+            workers,
+        )
+        archived_manifests.update(
+            get_cached_manifests(
+                dxf_base,
+                manifest_cache,
+                registry,
+                [
+                    docker_image
+                    for docker_image in docker_images_to_transfer
+                    + docker_images_already_transferred
+                    if docker_image not in archived_manifests
+                ],
+                workers,
+            )
+        )
+        if is_oci_layout:
+            if delta or dedup_chunks:
+                raise ValueError(
+                    "Deltas and chunks can't be stored in a payload written "
+                    "as an OCI image layout."
+                )
+            create_oci_layout_from_docker_images(
                 dxf_base,
                 docker_images_to_transfer,
                 docker_images_already_transferred,
-                zip_file_opened,
+                Path(zip_file),
+                workers,
+                local_oci_layout,
+                archived_manifests,
+                max_workers,
+                bandwidth,
+                compact_descriptor,
+            )
+            return
+        payloads = [(zip_file, docker_images_to_transfer)]
+        if max_payload_size is not None:
+            shards = plan_shards(
+                get_blobs_of_images(
+                    dxf_base,
+                    docker_images_to_transfer,
+                    docker_images_already_transferred,
+                    archived_manifests,
+                ),
+                max_payload_size,
+            )
+            print_plan_of_shards(shards, max_payload_size)
+            payloads = [
+                (get_shard_path(zip_file, index), shard.docker_images)
+                for index, shard in enumerate(shards, start=1)
+            ]
+        for payload_file, docker_images in payloads:
+            if max_payload_size is not None:
+                print(f"Writing {payload_file}", file=sys.stderr)
+            write_payload_zip(
+                dxf_base,
+                docker_images,
+                docker_images_already_transferred,
+                payload_file,
+                workers,
+                local_oci_layout,
+                archived_manifests,
+                delta,
+                dedup_chunks,
+                max_workers,
+                bandwidth,
+                cipher,
+                part,
+                compact_descriptor,
             )
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import json
+import secrets
+import struct
+from typing import Iterable, Iterator, Optional, Union
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from pydantic import BaseModel
+
+from docker_charon.common import PYDANTIC_V2, model_to_dict
+from docker_charon.pipeline import map_in_order
+
+# not encrypted, it's needed to derive the key
+ENCRYPTION_PARAMETERS_PATH = "encryption.json"
+# the plaintext of each chunk, encrypted and authenticated on its own
+ENCRYPTED_CHUNK_SIZE = 2**20
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+
+
+class PayloadDecryptionError(Exception):
+    pass
+
+
+class EncryptionParameters(BaseModel):
+    algorithm: str = "AES-256-GCM"
+    chunk_size: int = ENCRYPTED_CHUNK_SIZE
+    # scrypt, to derive the key from the passphrase
+    salt: str
+    n: int = 2**15
+    r: int = 8
+    p: int = 1
+
+    def to_json(self) -> str:
+        return json.dumps(model_to_dict(self))
+
+    @classmethod
+    def from_json(cls, content: Union[str, bytes]) -> EncryptionParameters:
+        parameters = json.loads(content)
+        if parameters.get("algorithm") != "AES-256-GCM":
+            raise ValueError(
+                f"The payload is encrypted with {parameters.get('algorithm')}, this "
+                f"version of docker-charon only knows AES-256-GCM. Please upgrade "
+                f"docker-charon."
+            )
+        if PYDANTIC_V2:
+            return cls.model_validate(parameters)
+        else:
+            return cls.parse_obj(parameters)
+
+
+class PayloadCipher:
+    """Encrypts the members of a payload with AES-256-GCM, in chunks.
+
+    An encrypted member is a random nonce prefix followed by its chunks, each one
+    with its tag. The nonce of a chunk is the prefix and the index of the chunk.
+    The name of the member, the index of the chunk and whether it's the last one
+    are authenticated, so the members and their chunks can't be swapped, reordered
+    or truncated. Each chunk is independent of the others, so they are encrypted
+    and decrypted in parallel, while the member is streamed.
+    """
+
+    def __init__(
+        self, encryption_key: Union[str, bytes], parameters: EncryptionParameters
+    ):
+        if isinstance(encryption_key, str):
+            encryption_key = encryption_key.encode()
+        if not encryption_key:
+            raise ValueError("The encryption key is empty.")
+        self.parameters = parameters
+        kdf = Scrypt(
+            salt=bytes.fromhex(parameters.salt),
+            length=32,
+            n=parameters.n,
+            r=parameters.r,
+            p=parameters.p,
+        )
+        self.aead = AESGCM(kdf.derive(encryption_key))
+        self.chunk_size = parameters.chunk_size
+
+    @classmethod
+    def new(cls, encryption_key: Union[str, bytes]) -> PayloadCipher:
+        return cls(encryption_key, EncryptionParameters(salt=secrets.token_hex(16)))
+
+    def get_encrypted_size(self, size: int) -> int:
+        number_of_chunks = max(-(-size // self.chunk_size), 1)
+        return NONCE_PREFIX_SIZE + size + number_of_chunks * TAG_SIZE
+
+    def encrypt(self, name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        nonce_prefix = secrets.token_bytes(NONCE_PREFIX_SIZE)
+        yield nonce_prefix
+
+        def encrypt_chunk(indexed_chunk: tuple[int, bool, bytes]) -> bytes:
+            index, is_last, chunk = indexed_chunk
+            return self.aead.encrypt(
+                nonce_prefix + struct.pack(">I", index),
+                chunk,
+                get_associated_data(name, index, is_last),
+            )
+
+        yield from map_in_order(
+            encrypt_chunk, index_chunks(regroup(chunks, self.chunk_size))
+        )
+
+    def decrypt(
+        self, name: str, encrypted_chunks: Union[bytes, memoryview, Iterable[bytes]]
+    ) -> Iterator[bytes]:
+        if isinstance(encrypted_chunks, (bytes, memoryview)):
+            encrypted_chunks = [encrypted_chunks]
+        encrypted_chunks = regroup(encrypted_chunks, NONCE_PREFIX_SIZE, once=True)
+        nonce_prefix = bytes(next(encrypted_chunks, b""))
+        if len(nonce_prefix) != NONCE_PREFIX_SIZE:
+            raise PayloadDecryptionError(f"{name} is truncated.")
+
+        def decrypt_chunk(indexed_chunk: tuple[int, bool, bytes]) -> bytes:
+            index, is_last, chunk = indexed_chunk
+            try:
+                return self.aead.decrypt(
+                    nonce_prefix + struct.pack(">I", index),
+                    chunk,
+                    get_associated_data(name, index, is_last),
+                )
+            except InvalidTag:
+                raise PayloadDecryptionError(
+                    f"{name} can't be decrypted, the encryption key is wrong or "
+                    f"the payload is corrupted."
+                )
+
+        yield from map_in_order(
+            decrypt_chunk,
+            index_chunks(regroup(encrypted_chunks, self.chunk_size + TAG_SIZE)),
+        )
+
+    def encrypt_bytes(self, name: str, content: Union[str, bytes]) -> bytes:
+        if isinstance(content, str):
+            content = content.encode()
+        return b"".join(self.encrypt(name, [content]))
+
+    def decrypt_bytes(self, name: str, content: bytes) -> bytes:
+        return b"".join(self.decrypt(name, content))
+
+
+def get_cipher(
+    encryption_key: Union[str, bytes, None], parameters: Optional[bytes]
+) -> Optional[PayloadCipher]:
+    """The cipher of a payload, from its encryption parameters, if it's encrypted."""
+    if parameters is None:
+        if encryption_key is not None:
+            raise ValueError(
+                "An encryption key is given, but the payload isn't encrypted."
+            )
+        return None
+    if encryption_key is None:
+        raise ValueError("The payload is encrypted, an encryption key is needed.")
+    return PayloadCipher(encryption_key, EncryptionParameters.from_json(parameters))
+
+
+def encrypt_member(
+    cipher: Optional[PayloadCipher], name: str, chunks: Iterable[bytes]
+) -> Iterable[bytes]:
+    if cipher is None:
+        return chunks
+    return cipher.encrypt(name, chunks)
+
+
+def get_associated_data(name: str, index: int, is_last: bool) -> bytes:
+    return struct.pack(">I?", index, is_last) + name.encode()
+
+
+def regroup(
+    chunks: Iterable[Union[bytes, memoryview]], size: int, once: bool = False
+) -> Iterator[Union[bytes, memoryview]]:
+    """Chunks of exactly `size` bytes, except the last one. With `once`, only the
+    first chunk has this size, the rest is yielded as it comes.
+    """
+    buffer = bytearray()
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if not buffer and len(chunk) >= size:
+            # no copy of big chunks, e.g. a memory map
+            view = memoryview(chunk)
+            start = 0
+            while len(view) - start >= size:
+                yield view[start : start + size]
+                start += size
+                if once:
+                    yield view[start:]
+                    yield from chunks
+                    return
+            buffer += view[start:]
+            continue
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+            if once:
+                yield bytes(buffer)
+                yield from chunks
+                return
+    yield bytes(buffer)
+
+
+def index_chunks(
+    chunks: Iterator[Union[bytes, memoryview]]
+) -> Iterator[tuple[int, bool, Union[bytes, memoryview]]]:
+    """(index, is_last, chunk). There is always at least one chunk, maybe empty."""
+    previous = None
+    for index, chunk in enumerate(chunks):
+        if previous is not None:
+            if not chunk:
+                # the last chunk was full
+                yield index - 1, True, previous
+                return
+            yield index - 1, False, previous
+        previous = chunk
+    yield (0 if previous is None else index), True, previous or b""
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+from urllib.parse import quote
+
+from dxf import DXF, DXFBase
+
+from docker_charon.common import (
+    Manifest,
+    PayloadSide,
+    get_blob_path_in_oci_layout,
+    get_manifest_content_digest,
+    get_manifest_digest,
+    get_repo_and_tag,
+    write_file_atomically,
+)
+
+
+class ManifestCache:
+    """Manifests kept on disk between runs, so that an unchanged tag costs a HEAD
+    request instead of a GET. Docker Hub counts the GET of manifests in its pull
+    rate limit, not the HEAD.
+
+    The manifests are stored by the digest of their content, like the blobs of an
+    OCI image layout. Each tag points to the digest the registry gave for it the
+    last time, and to the manifest which was downloaded then.
+    """
+
+    def __init__(self, directory: Union[Path, str], registry: str):
+        self.directory = Path(directory)
+        self.registry = registry
+
+    def get_tag_path(self, docker_image: str) -> Path:
+        return self.directory / "tags" / quote(f"{self.registry}/{docker_image}", "")
+
+    def get_cached_content(
+        self, docker_image: str, digest: Optional[str]
+    ) -> Optional[str]:
+        tag_path = self.get_tag_path(docker_image)
+        if digest is None or not tag_path.exists():
+            return None
+        tag = json.loads(tag_path.read_text())
+        manifest_path = self.directory / get_blob_path_in_oci_layout(
+            tag["content_digest"]
+        )
+        if tag["digest"] != digest or not manifest_path.exists():
+            return None
+        return manifest_path.read_text()
+
+    def download_manifest(self, dxf_base: DXFBase, docker_image: str) -> str:
+        repository, tag = get_repo_and_tag(docker_image)
+        content = DXF.from_base(dxf_base, repository).get_manifest(tag)
+        write_file_atomically(
+            self.directory
+            / get_blob_path_in_oci_layout(get_manifest_content_digest(content)),
+            content.encode(),
+        )
+        return content
+
+    def save_tag(self, docker_image: str, digest: str, content: str) -> None:
+        write_file_atomically(
+            self.get_tag_path(docker_image),
+            json.dumps(
+                {
+                    "digest": digest,
+                    "content_digest": get_manifest_content_digest(content),
+                }
+            ).encode(),
+        )
+
+    def get_manifests(
+        self, dxf_base: DXFBase, docker_images: list[str], workers: int
+    ) -> dict[str, Manifest]:
+        """Revalidates the manifests of the tags with HEAD requests, and downloads
+        only the ones which changed. The tags pointing to the same manifest, like
+        `python:3.12` and `python:3.12.7`, download it once."""
+        docker_images = list(dict.fromkeys(docker_images))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = dict(
+                zip(
+                    docker_images,
+                    executor.map(
+                        lambda docker_image: get_manifest_digest(
+                            dxf_base, docker_image
+                        ),
+                        docker_images,
+                    ),
+                )
+            )
+            contents = {
+                docker_image: self.get_cached_content(docker_image, digest)
+                for docker_image, digest in digests.items()
+            }
+            # digest (or the docker image if the registry gave none) -> the
+            # docker images whose manifest must be downloaded
+            to_download: dict[str, list[str]] = {}
+            unchanged = len(docker_images)
+            for docker_image, content in contents.items():
+                if content is None:
+                    unchanged -= 1
+                    key = digests[docker_image] or docker_image
+                    to_download.setdefault(key, []).append(docker_image)
+            downloaded = executor.map(
+                lambda same_manifest: self.download_manifest(
+                    dxf_base, same_manifest[0]
+                ),
+                to_download.values(),
+            )
+            for same_manifest, content in zip(to_download.values(), downloaded):
+                for docker_image in same_manifest:
+                    contents[docker_image] = content
+                    if digests[docker_image] is not None:
+                        self.save_tag(docker_image, digests[docker_image], content)
+        print(
+            f"{unchanged} manifests unchanged in the cache {self.directory}, "
+            f"{len(to_download)} downloaded",
+            file=sys.stderr,
+        )
+        return {
+            docker_image: Manifest(dxf_base, docker_image, PayloadSide.ENCODER, content)
+            for docker_image, content in contents.items()
+        }
+
+
+def get_cached_manifests(
+    dxf_base: DXFBase,
+    manifest_cache: Union[Path, str, None],
+    registry: str,
+    docker_images: list[str],
+    workers: int,
+) -> dict[str, Manifest]:
+    """The manifests of the docker images, from the cache if they didn't change. Empty
+    if there is no cache."""
+    if manifest_cache is None:
+        return {}
+    return ManifestCache(manifest_cache, registry).get_manifests(
+        dxf_base, docker_images, workers
+    )
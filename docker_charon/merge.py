@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import os
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from typing import IO, Union
+from zipfile import ZipFile, ZipInfo
+
+from tqdm import tqdm
+
+from docker_charon.common import PayloadDescriptor
+from docker_charon.decoder import LOCAL_FILE_HEADER
+from docker_charon.encoder import (
+    ZIP_BLOB_PATH_TEMPLATE,
+    PreallocatedZipFile,
+    pwrite_all,
+)
+from docker_charon.encryption import ENCRYPTION_PARAMETERS_PATH
+
+COPY_SIZE = 2**20
+
+
+def merge_payloads(
+    parts: list[Union[IO, Path, str]],
+    zip_file: Union[IO, Path, str],
+    compact_descriptor: bool = False,
+) -> None:
+    """Merges the parts of a payload built on several hosts into a single payload.
+
+    The members of the parts are copied as they are, without being decompressed,
+    compressed or hashed again. On Linux, the bytes are copied by the kernel, and
+    even shared between the files on filesystems which support it (btrfs, XFS).
+
+    # Arguments
+        parts: the zip files made with `make_payload(..., part=...)`, all the parts
+            of the payload, in any order. They can be `pathlib.Path`, `str` or
+            file-like objects.
+        zip_file: the payload to create. It can be a `pathlib.Path`, a `str` or a
+            seekable file-like object.
+        compact_descriptor: write the payload descriptor in its compact encoding,
+            like with `make_payload`.
+    """
+    if not PreallocatedZipFile.can_preallocate(zip_file):
+        raise ValueError(
+            "The merged payload must be written to a file, it can't be streamed."
+        )
+    with ExitStack() as stack:
+        parts_opened = [stack.enter_context(ZipFile(part, "r")) for part in parts]
+        payload_descriptor = merge_payload_descriptors(
+            [read_part_descriptor(part) for part in parts_opened]
+        )
+        with PreallocatedZipFile(zip_file) as merged_zip_file:
+            copy_members(parts_opened, merged_zip_file)
+            merged_zip_file.writestr(
+                "payload_descriptor.json",
+                payload_descriptor.to_json(ZIP_BLOB_PATH_TEMPLATE, compact_descriptor),
+            )
+
+
+def read_part_descriptor(part: ZipFile) -> PayloadDescriptor:
+    if ENCRYPTION_PARAMETERS_PATH in part.NameToInfo:
+        raise ValueError("Encrypted payloads can't be merged.")
+    payload_descriptor = PayloadDescriptor.from_json(
+        part.read("payload_descriptor.json")
+    )
+    if payload_descriptor.part is None:
+        raise ValueError(
+            f"{part.filename or 'The payload'} is a complete payload, not a part. "
+            f"Use `make-payload --part` to build a payload on several hosts."
+        )
+    return payload_descriptor
+
+
+def merge_payload_descriptors(
+    payload_descriptors: list[PayloadDescriptor],
+) -> PayloadDescriptor:
+    count = payload_descriptors[0].part.count
+    indexes = sorted(descriptor.part.index for descriptor in payload_descriptors)
+    if any(descriptor.part.count != count for descriptor in payload_descriptors):
+        raise ValueError("The parts don't come from the same number of hosts.")
+    if indexes != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indexes))
+        raise ValueError(
+            f"Each part out of {count} must be given once, got the parts "
+            f"{indexes}, the parts {missing} are missing."
+        )
+    manifests_paths = payload_descriptors[0].manifests_paths
+    if any(
+        descriptor.manifests_paths != manifests_paths
+        for descriptor in payload_descriptors
+    ):
+        raise ValueError(
+            "The parts were made with different lists of images, they must be "
+            "made with the same arguments, except `part`."
+        )
+    blobs_paths = {}
+    for descriptor in payload_descriptors:
+        # the blobs already in the destination registry are in all the parts
+        blobs_paths.update(descriptor.blobs_paths)
+    return PayloadDescriptor(manifests_paths=manifests_paths, blobs_paths=blobs_paths)
+
+
+def copy_members(parts: list[ZipFile], merged_zip_file: PreallocatedZipFile) -> None:
+    """The manifests, and the chunks with `dedup_chunks`, can be in several parts.
+    Their paths depend on their content, so they are copied once.
+    """
+    members_to_copy = {}
+    for part in parts:
+        for zip_info in part.infolist():
+            if zip_info.filename == "payload_descriptor.json":
+                continue
+            members_to_copy.setdefault(zip_info.filename, (part, zip_info))
+    total_size = sum(zip_info.compress_size for _, zip_info in members_to_copy.values())
+    print(
+        f"Merging {len(parts)} parts, {len(members_to_copy)} files "
+        f"({tqdm.format_sizeof(total_size, 'B')})",
+        file=sys.stderr,
+    )
+    # the space of all the members is reserved before any other member is written
+    copies = [
+        (part, zip_info, reserve_copy(merged_zip_file, zip_info))
+        for part, zip_info in members_to_copy.values()
+    ]
+    with tqdm(total=total_size, unit="B", unit_scale=True) as pbar:
+        for part, zip_info, merged_zip_info in copies:
+            copy_member(part, zip_info, merged_zip_file, merged_zip_info)
+            pbar.update(zip_info.compress_size)
+
+
+def reserve_copy(merged_zip_file: PreallocatedZipFile, zip_info: ZipInfo) -> ZipInfo:
+    """Reserves the space of a member, compressed or not, with its CRC and sizes."""
+    merged_zip_info = merged_zip_file.reserve(zip_info.filename, zip_info.compress_size)
+    merged_zip_info.compress_type = zip_info.compress_type
+    merged_zip_info.file_size = zip_info.file_size
+    merged_zip_info.CRC = zip_info.CRC
+    merged_zip_info.date_time = zip_info.date_time
+    return merged_zip_info
+
+
+def copy_member(
+    part: ZipFile,
+    zip_info: ZipInfo,
+    merged_zip_file: PreallocatedZipFile,
+    merged_zip_info: ZipInfo,
+) -> None:
+    header = merged_zip_info.FileHeader(zip64=True)
+    pwrite_all(merged_zip_file.fp.fileno(), header, merged_zip_info.header_offset)
+    copy_range(
+        part.fp,
+        get_data_offset(part.fp, zip_info.header_offset),
+        merged_zip_file.fp.fileno(),
+        merged_zip_info.header_offset + len(header),
+        zip_info.compress_size,
+    )
+
+
+def get_data_offset(file: IO, header_offset: int) -> int:
+    # the local header can have a different extra field than the central directory
+    file.seek(header_offset)
+    signature, name_length, extra_length = LOCAL_FILE_HEADER.unpack(
+        file.read(LOCAL_FILE_HEADER.size)
+    )
+    if signature != b"PK\x03\x04":
+        raise ValueError(f"Bad local file header at offset {header_offset}")
+    return header_offset + LOCAL_FILE_HEADER.size + name_length + extra_length
+
+
+def copy_range(
+    source: IO,
+    source_offset: int,
+    destination_fd: int,
+    destination_offset: int,
+    size: int,
+) -> None:
+    copied = 0
+    try:
+        source_fd = source.fileno()
+    except (AttributeError, OSError, ValueError):
+        source_fd = None
+    if source_fd is not None and hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                copied_now = os.copy_file_range(
+                    source_fd,
+                    destination_fd,
+                    size - copied,
+                    source_offset + copied,
+                    destination_offset + copied,
+                )
+                if copied_now == 0:
+                    break
+                copied += copied_now
+        except OSError:
+            # not supported between these filesystems, the rest is copied below
+            pass
+    source.seek(source_offset + copied)
+    while copied < size:
+        chunk = source.read(min(size - copied, COPY_SIZE))
+        if not chunk:
+            raise ValueError("The part is truncated.")
+        pwrite_all(destination_fd, chunk, destination_offset + copied)
+        copied += len(chunk)
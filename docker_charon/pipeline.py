@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar, Union
+
+# the number of chunks processed ahead of the one being consumed
+CHUNKS_IN_FLIGHT = 8
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def has_several_cores() -> bool:
+    return (os.cpu_count() or 1) > 1
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """The threads shared by all the blobs transferred concurrently, one per core."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count(), thread_name_prefix="docker-charon-pipeline"
+            )
+        return _executor
+
+
+def map_in_order(function: Callable[[T], R], items: Iterator[T]) -> Iterator[R]:
+    """`map`, with up to `CHUNKS_IN_FLIGHT` items processed in parallel ahead of the
+    one being consumed. AES-GCM, hashlib and zlib release the GIL, so they run on
+    several cores.
+    """
+    if not has_several_cores():
+        yield from map(function, items)
+        return
+    executor = get_executor()
+    in_flight = []
+    for item in items:
+        in_flight.append(executor.submit(function, item))
+        if len(in_flight) > CHUNKS_IN_FLIGHT:
+            yield in_flight.pop(0).result()
+    for future in in_flight:
+        yield future.result()
+
+
+def prefetch(chunks: Iterable[bytes], depth: int = CHUNKS_IN_FLIGHT) -> Iterator[bytes]:
+    """Iterates over `chunks` in a thread of its own, up to `depth` chunks ahead of
+    the one being consumed.
+
+    The stage which produces the chunks, e.g. reading from the network and checking
+    the sha256 of the blob, then runs on another core than the stage which consumes
+    them, e.g. the CRC32 and the writes to the payload. hashlib and zlib release the
+    GIL on big chunks. The errors of the producer are raised in the consumer, and a
+    consumer which stops reading stops the producer at the next chunk.
+    """
+    if not has_several_cores():
+        yield from chunks
+        return
+    chunks_queue = queue.Queue(maxsize=depth)
+    abandoned = threading.Event()
+
+    def put(item: Union[bytes, Exception, None]) -> None:
+        while not abandoned.is_set():
+            try:
+                chunks_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce() -> None:
+        iterator = iter(chunks)
+        try:
+            for chunk in iterator:
+                put(chunk)
+                if abandoned.is_set():
+                    return
+        except Exception as error:
+            put(error)
+        else:
+            put(None)
+        finally:
+            # e.g. releases the connection of a blob which was partially pulled
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    producer = threading.Thread(
+        target=produce, name="docker-charon-prefetch", daemon=True
+    )
+    producer.start()
+    try:
+        while (chunk := chunks_queue.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        abandoned.set()
+        producer.join()
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Iterator, Optional, Union
+
+# seconds between two samples, a sample takes a few microseconds per thread
+SAMPLING_INTERVAL = 0.005
+# the functions of docker-charon which write to or read from the payload
+ZIP_FUNCTIONS = {"pwrite_all", "write_reserved", "copy_range"}
+
+_profiler: Optional[SamplingProfiler] = None
+
+
+class SamplingProfiler:
+    """Samples the stacks of all the threads at a regular interval, from a thread
+    of its own. Unlike cProfile, it sees the threads which download and push the
+    blobs, and the code being profiled runs at full speed between two samples.
+
+    Each sample is labelled with the current phase, see `enter_phase`. The threads
+    waiting for a lock or for work are not sampled, so the samples are the wall-clock
+    time of the threads which compute, read, write or wait for the network.
+    """
+
+    def __init__(self, interval: float = SAMPLING_INTERVAL):
+        self.interval = interval
+        # before the first phase, mostly the imports
+        self.phase = "startup"
+        self.zip_phase: Optional[str] = None
+        # (phase, code objects from the root of the stack to its leaf) -> samples
+        self.samples: Counter[tuple] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="docker-charon-profiler", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            phase, zip_phase = self.phase, self.zip_phase
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = get_stack(frame)
+                if is_idle(stack[-1]):
+                    continue
+                if zip_phase is not None and is_in_zip(stack):
+                    self.samples[(zip_phase,) + stack] += 1
+                else:
+                    self.samples[(phase,) + stack] += 1
+
+    def get_samples_by_phase(self) -> Counter[str]:
+        samples_by_phase = Counter()
+        for (phase, *_), count in self.samples.items():
+            samples_by_phase[phase] += count
+        return samples_by_phase
+
+    def get_samples_by_function(self) -> Counter[str]:
+        """The samples in which each function is the leaf of the stack."""
+        samples_by_function = Counter()
+        for (_, *stack), count in self.samples.items():
+            samples_by_function[format_code(stack[-1])] += count
+        return samples_by_function
+
+    def write_folded(self, path: Union[Path, str]) -> None:
+        """Writes the stacks in the folded format of flamegraph.pl, one line per
+        stack, `phase;outermost function;...;innermost function samples`. It's read
+        by flamegraph.pl, inferno, speedscope...
+        """
+        with open(path, "w") as file:
+            for (phase, *stack), count in sorted(
+                self.samples.items(), key=lambda item: -item[1]
+            ):
+                frames = ";".join([phase] + [format_code(code) for code in stack])
+                file.write(f"{frames} {count}\n")
+
+    def print_summary(self, top: int = 10) -> None:
+        total = sum(self.samples.values())
+        print(
+            f"{total} samples, one every {self.interval * 1000:g}ms for each busy "
+            f"thread",
+            file=sys.stderr,
+        )
+        if total == 0:
+            return
+        for phase, count in self.get_samples_by_phase().most_common():
+            print(f"  {phase:<10} {count / total:6.1%}", file=sys.stderr)
+        print("Functions running in the most samples:", file=sys.stderr)
+        for function, count in self.get_samples_by_function().most_common(top):
+            print(f"  {count / total:6.1%}  {function}", file=sys.stderr)
+
+
+def get_stack(frame: FrameType) -> tuple[CodeType, ...]:
+    stack = []
+    while frame is not None:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def is_idle(code: CodeType) -> bool:
+    """Whether a thread whose innermost function is `code` waits for a lock, a
+    condition or work to do."""
+    filename = code.co_filename.replace("\\", "/")
+    return (
+        filename.endswith(("/threading.py", "/queue.py"))
+        or filename.endswith("/concurrent/futures/thread.py")
+        and code.co_name == "_worker"
+    )
+
+
+def is_in_zip(stack: tuple[CodeType, ...]) -> bool:
+    """Whether the innermost function of docker-charon or of zipfile in the stack
+    writes to or reads from the payload. A thread pulling a blob which is written
+    to the zip file as it comes has both in its stack, it's in the zip file only
+    when it's not in the network code called by `Blob.pull_chunks`.
+    """
+    for code in reversed(stack):
+        filename = code.co_filename.replace("\\", "/")
+        if filename.endswith(("/zipfile.py", "/zipfile/__init__.py")):
+            return True
+        if "/docker_charon/" in filename:
+            return code.co_name in ZIP_FUNCTIONS
+    return False
+
+
+def format_code(code: CodeType) -> str:
+    # the path from the site-packages or the standard library, not the whole path
+    filename = "/".join(code.co_filename.replace("\\", "/").split("/")[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def enter_phase(phase: str, zip_phase: Optional[str] = None) -> None:
+    """Labels the next samples with `phase`, until the next phase. With `zip_phase`,
+    the samples of threads writing or reading the payload are labelled with it
+    instead. Does nothing if nothing is profiled.
+    """
+    if _profiler is not None:
+        _profiler.phase = phase
+        _profiler.zip_phase = zip_phase
+
+
+@contextmanager
+def profile(
+    path: Union[Path, str], interval: float = SAMPLING_INTERVAL
+) -> Iterator[SamplingProfiler]:
+    """Profiles the code run in the block, in all the threads, and writes the
+    profile in `path`, in the folded format of flamegraph.pl.
+
+    The samples are split by phase: `planning`, `transfer`, `zip write` or
+    `zip read` and `finalize`, they are the first level of the flamegraph. A summary
+    is printed on stderr.
+
+    # Arguments
+        path: where to write the profile, e.g. `profile.folded`. Use
+            `flamegraph.pl profile.folded > profile.svg`, or open it with
+            https://www.speedscope.app.
+        interval: the number of seconds between two samples.
+    """
+    global _profiler
+    if _profiler is not None:
+        raise RuntimeError("Something is already being profiled.")
+    profiler = SamplingProfiler(interval)
+    _profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _profiler = None
+        profiler.write_folded(path)
+        print(f"Profile written to {path}", file=sys.stderr)
+        profiler.print_summary()
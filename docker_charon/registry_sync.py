@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from dxf import DXF, DXFBase
+from dxf.exceptions import DXFMountFailed
+
+from docker_charon.bandwidth import BandwidthLimit, get_bandwidth_limit, limit_bandwidth
+from docker_charon.common import (
+    CHUNK_SIZE,
+    Authenticator,
+    Blob,
+    BlobLocationInRegistry,
+    Manifest,
+)
+from docker_charon.decoder import (
+    check_if_the_docker_image_is_in_the_registry,
+    mount_blob_from_registry,
+)
+from docker_charon.encoder import (
+    get_manifests_and_list_of_all_blobs,
+    iter_blobs_to_transfer,
+    separate_images_to_transfer_and_images_to_skip,
+)
+from docker_charon.manifest_cache import get_cached_manifests
+from docker_charon.pipeline import prefetch
+from docker_charon.tag_selectors import expand_docker_images
+
+
+def copy_blob_between_registries(
+    source_dxf_base: DXFBase,
+    destination_dxf_base: DXFBase,
+    blob: Blob,
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> None:
+    """Streams a blob from the source registry to the destination registry, within
+    `bandwidth`.
+
+    Only a few chunks are held in memory at a time. Nothing is written to disk.
+    """
+    source_dxf = DXF.from_base(source_dxf_base, blob.repository)
+    destination_dxf = DXF.from_base(destination_dxf_base, blob.repository)
+
+    def pull_chunks() -> Iterator[bytes]:
+        # lazy, so that nothing is downloaded if the destination already has the blob
+        yield from source_dxf.pull_blob(blob.digest, chunk_size=CHUNK_SIZE)
+
+    # the chunks pushed are the ones pulled, limiting the pull limits both
+    destination_dxf.push_blob(
+        data=prefetch(limit_bandwidth(pull_chunks(), bandwidth)), digest=blob.digest
+    )
+
+
+def set_manifest_in_destination(
+    source_dxf_base: DXFBase,
+    destination_dxf_base: DXFBase,
+    manifest: Manifest,
+    blobs_paths: dict[str, BlobLocationInRegistry],
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> None:
+    for blob in manifest.get_list_of_blobs():
+        blob_location = blobs_paths[blob.digest]
+        if blob_location.repository == manifest.repository:
+            continue
+        try:
+            mount_blob_from_registry(destination_dxf_base, blob, blob_location)
+        except DXFMountFailed:
+            print(
+                f"Mounting {blob} failed, copying it from the source registry instead",
+                file=sys.stderr,
+            )
+            copy_blob_between_registries(
+                source_dxf_base, destination_dxf_base, blob, bandwidth
+            )
+    dxf = DXF.from_base(destination_dxf_base, manifest.repository)
+    dxf.set_manifest(manifest.tag, manifest.content)
+    print(f"Image {manifest.docker_image_name} is in the registry", file=sys.stderr)
+
+
+def sync_docker_images(
+    source_dxf_base: DXFBase,
+    destination_dxf_base: DXFBase,
+    docker_images_to_transfer: list[str],
+    docker_images_already_transferred: list[str],
+    strict: bool,
+    workers: int,
+    archived_manifests: dict[str, Manifest] = {},
+    bandwidth: Optional[BandwidthLimit] = None,
+) -> Iterator[str]:
+    (
+        docker_images_to_transfer_with_blobs,
+        docker_images_to_skip,
+    ) = separate_images_to_transfer_and_images_to_skip(
+        docker_images_to_transfer, docker_images_already_transferred
+    )
+    for docker_image in docker_images_to_skip:
+        check_if_the_docker_image_is_in_the_registry(
+            destination_dxf_base, docker_image, strict
+        )
+
+    manifests, blobs_to_pull = get_manifests_and_list_of_all_blobs(
+        source_dxf_base, docker_images_to_transfer_with_blobs, archived_manifests
+    )
+    _, blobs_already_transferred = get_manifests_and_list_of_all_blobs(
+        source_dxf_base, docker_images_already_transferred, archived_manifests
+    )
+
+    blobs_paths = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        copies = []
+        for blob in iter_blobs_to_transfer(
+            blobs_to_pull, blobs_already_transferred, blobs_paths
+        ):
+            print(f"Copying blob {blob} to the destination registry", file=sys.stderr)
+            # once copied, the blob can be mounted from its repository
+            blobs_paths[blob.digest] = BlobLocationInRegistry(
+                repository=blob.repository
+            )
+            copies.append(
+                executor.submit(
+                    copy_blob_between_registries,
+                    source_dxf_base,
+                    destination_dxf_base,
+                    blob,
+                    bandwidth,
+                )
+            )
+        for copy in copies:
+            copy.result()
+
+        # all blobs must be in the registry before any manifest is set
+        manifests_set = [
+            executor.submit(
+                set_manifest_in_destination,
+                source_dxf_base,
+                destination_dxf_base,
+                manifest,
+                blobs_paths,
+                bandwidth,
+            )
+            for manifest in manifests
+        ]
+        for manifest_set in manifests_set:
+            manifest_set.result()
+
+    for docker_image in docker_images_to_transfer:
+        yield docker_image
+
+
+def sync(
+    docker_images_to_transfer: list[str],
+    docker_images_already_transferred: list[str] = [],
+    source_registry: str = "registry-1.docker.io",
+    destination_registry: str = "registry-1.docker.io",
+    source_secure: bool = True,
+    destination_secure: bool = True,
+    source_username: Optional[str] = None,
+    source_password: Optional[str] = None,
+    destination_username: Optional[str] = None,
+    destination_password: Optional[str] = None,
+    strict: bool = False,
+    workers: int = 4,
+    manifest_cache: Union[Path, str, None] = None,
+    max_bandwidth: Union[str, float, None] = None,
+) -> list[str]:
+    """Copies docker images from a registry to another one, without any payload.
+
+    The blobs are streamed from the source registry to the destination registry,
+    nothing is written to disk. Blobs are skipped and mounted exactly like
+    `make_payload` and `push_payload` would do.
+
+    # Arguments
+        docker_images_to_transfer: The list of docker images to transfer. Do not include
+            the registry name in the image name. It can have selectors of tags, like
+            `python:3.12.*`, see `make_payload`.
+        docker_images_already_transferred: The list of docker images that are already
+            in the destination registry. Their blobs are not copied again.
+        source_registry: the registry to pull from. It defaults to
+            `registry-1.docker.io` (dockerhub).
+        destination_registry: the registry to push to. It defaults to
+            `registry-1.docker.io` (dockerhub).
+        source_secure: Set to `False` if the source registry doesn't support
+            HTTPS (TLS). Default is `True`.
+        destination_secure: Set to `False` if the destination registry doesn't support
+            HTTPS (TLS). Default is `True`.
+        source_username: The username to use for authentication to the source registry.
+        source_password: The password to use for authentication to the source registry.
+        destination_username: The username to use for authentication to the
+            destination registry.
+        destination_password: The password to use for authentication to the
+            destination registry.
+        strict: `False` by default. If True, it will raise an error if an image of
+            `docker_images_already_transferred` is not in the destination registry.
+        workers: The number of blobs copied concurrently. Default is 4.
+        manifest_cache: A directory where the manifests of the source registry are
+            kept between runs, see `make_payload`.
+        max_bandwidth: The maximum bandwidth used by all the copies together, in
+            bytes per second, or a string like `"200MB/s"`. It can follow a schedule
+            in local time, like `"09:00-18:00=50MB/s,200MB/s"`. Each blob is pulled
+            and pushed at the same rate. Unlimited by default.
+
+    # Returns
+        The list of docker images in the destination registry, in other words,
+        `docker_images_to_transfer`, with the docker images selected by its selectors.
+    """
+    bandwidth = get_bandwidth_limit(max_bandwidth)
+    source_authenticator = Authenticator(source_username, source_password)
+    destination_authenticator = Authenticator(
+        destination_username, destination_password
+    )
+
+    with DXFBase(
+        host=source_registry,
+        auth=source_authenticator.auth,
+        insecure=not source_secure,
+    ) as source_dxf_base:
+        with DXFBase(
+            host=destination_registry,
+            auth=destination_authenticator.auth,
+            insecure=not destination_secure,
+        ) as destination_dxf_base:
+            docker_images_to_transfer = expand_docker_images(
+                source_dxf_base, docker_images_to_transfer, workers
+            )
+            return list(
+                sync_docker_images(
+                    source_dxf_base,
+                    destination_dxf_base,
+                    docker_images_to_transfer,
+                    docker_images_already_transferred,
+                    strict,
+                    workers,
+                    get_cached_manifests(
+                        source_dxf_base,
+                        manifest_cache,
+                        source_registry,
+                        docker_images_to_transfer + docker_images_already_transferred,
+                        workers,
+                    ),
+                    bandwidth,
+                )
+            )
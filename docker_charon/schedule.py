@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import heapq
+import sys
+from typing import Callable, Optional, TypeVar
+
+from tqdm import tqdm
+
+T = TypeVar("T")
+
+
+def order_largest_first(items: list[T], get_size: Callable[[T], int]) -> list[T]:
+    """The longest transfers start first (LPT), so that a big blob doesn't end up
+    alone at the end while the other workers have nothing left to do.
+    Items of the same size keep their order.
+    """
+    return sorted(items, key=lambda item: -get_size(item))
+
+
+def get_makespan(sizes: list[int], workers: int) -> int:
+    """The number of bytes transferred by the busiest worker, if each transfer
+    goes, in this order, to the first worker available.
+    """
+    loads = [0] * max(workers, 1)
+    for size in sizes:
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def print_plan(
+    what: str, sizes: list[int], workers: int, rate: Optional[float] = None
+) -> None:
+    """Prints the number of bytes transferred by the busiest worker, which is when
+    all the transfers are done, and the time it takes if the bandwidth is limited.
+    """
+    if not sizes:
+        return
+    total_size = sum(sizes)
+    makespan = get_makespan(sizes, workers)
+    plan = (
+        f"{what} {len(sizes)} blobs ({tqdm.format_sizeof(total_size, 'B')}), "
+        f"largest first with {workers} workers: the busiest worker transfers "
+        f"{tqdm.format_sizeof(makespan, 'B')}, the largest blob is "
+        f"{tqdm.format_sizeof(max(sizes), 'B')}"
+    )
+    if rate is not None:
+        # the workers share the bandwidth, the ones still running get the
+        # bandwidth of the ones which are done
+        expected_time = total_size / rate
+        plan += f", expected completion in {tqdm.format_interval(expected_time)}"
+    print(plan, file=sys.stderr)
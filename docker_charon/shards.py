@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from typing import Union
+
+from tqdm import tqdm
+
+
+class Shard:
+    """A payload of a sharded payload, with the blobs of its images."""
+
+    def __init__(self):
+        self.docker_images: list[str] = []
+        # digest -> size
+        self.blobs: dict[str, int] = {}
+        self.size = 0
+
+    def get_added_size(self, blobs: dict[str, int]) -> int:
+        return sum(size for digest, size in blobs.items() if digest not in self.blobs)
+
+    def add(self, docker_image: str, blobs: dict[str, int]) -> None:
+        self.size += self.get_added_size(blobs)
+        self.docker_images.append(docker_image)
+        self.blobs.update(blobs)
+
+
+def plan_shards(
+    blobs_of_images: dict[str, dict[str, int]], max_size: int
+) -> list[Shard]:
+    """Packs the images in as few shards of at most `max_size` bytes as possible.
+
+    The biggest images are placed first, each one in the shard to which it adds the
+    fewest bytes, e.g. the shard which already has its base layers. An image is only
+    in one shard, the blobs it shares with images of other shards are duplicated.
+    An image bigger than `max_size` gets a shard of its own.
+
+    # Arguments
+        blobs_of_images: the blobs each image needs in a payload, digest -> size,
+            in the order of the images.
+        max_size: the maximum number of bytes of blobs in a shard.
+    """
+    order_of_images = {
+        docker_image: index for index, docker_image in enumerate(blobs_of_images)
+    }
+    shards: list[Shard] = []
+    for docker_image, blobs in sorted(
+        blobs_of_images.items(), key=lambda item: -sum(item[1].values())
+    ):
+        best_shard = None
+        best_added_size = None
+        for shard in shards:
+            added_size = shard.get_added_size(blobs)
+            if shard.size + added_size > max_size:
+                continue
+            if best_added_size is None or added_size < best_added_size:
+                best_shard, best_added_size = shard, added_size
+        if best_shard is None:
+            best_shard = Shard()
+            shards.append(best_shard)
+            if sum(blobs.values()) > max_size:
+                print(
+                    f"Warning: {docker_image} is bigger than the maximum size of a "
+                    f"payload, {tqdm.format_sizeof(max_size, 'B')}, it gets a "
+                    f"payload of its own",
+                    file=sys.stderr,
+                )
+        best_shard.add(docker_image, blobs)
+    for shard in shards:
+        shard.docker_images.sort(key=order_of_images.__getitem__)
+    # the shard with the first image of the list comes first
+    shards.sort(key=lambda shard: order_of_images[shard.docker_images[0]])
+    return shards
+
+
+def get_duplicated_size(shards: list[Shard]) -> int:
+    """The number of bytes of the blobs which are in several shards, for each copy
+    after the first one."""
+    all_blobs = {}
+    for shard in shards:
+        all_blobs.update(shard.blobs)
+    return sum(shard.size for shard in shards) - sum(all_blobs.values())
+
+
+def print_plan_of_shards(shards: list[Shard], max_size: int) -> None:
+    total_size = sum(shard.size for shard in shards)
+    duplicated_size = get_duplicated_size(shards)
+    print(
+        f"Splitting the payload in {len(shards)} payloads of at most "
+        f"{tqdm.format_sizeof(max_size, 'B')}:",
+        file=sys.stderr,
+    )
+    for index, shard in enumerate(shards, start=1):
+        print(
+            f"  {index}: {len(shard.docker_images)} images, "
+            f"{tqdm.format_sizeof(shard.size, 'B')}",
+            file=sys.stderr,
+        )
+    print(
+        f"Blobs in several payloads: {tqdm.format_sizeof(duplicated_size, 'B')}, "
+        f"{duplicated_size / max(total_size - duplicated_size, 1):.1%} more than "
+        f"a single payload",
+        file=sys.stderr,
+    )
+
+
+def get_shard_path(zip_file: Union[Path, str], index: int) -> Path:
+    """payload.zip -> payload-1.zip"""
+    zip_file = Path(zip_file)
+    return zip_file.with_name(f"{zip_file.stem}-{index}{zip_file.suffix}")
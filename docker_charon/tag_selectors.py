@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import fnmatch
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from dxf import DXF, DXFBase
+
+# the number of tags or repositories asked at a time, the registries may give less
+PAGE_SIZE = 1000
+# none of those characters can be in a tag
+SELECTOR_CHARACTERS = set("*?[/<>=^~# ")
+VERSION = re.compile(r"v?(\d+(?:\.\d+)*)")
+COMPARATOR = re.compile(r"(>=|<=|>|<|=|\^|~)v?(\d+(?:\.\d+)*)")
+
+
+def is_selector(docker_image: str) -> bool:
+    if ":" not in docker_image:
+        return False
+    repository, tag = docker_image.split(":", 1)
+    return is_repository_pattern(repository) or any(
+        character in SELECTOR_CHARACTERS for character in tag
+    )
+
+
+def is_repository_pattern(repository: str) -> bool:
+    return any(character in "*?[" for character in repository)
+
+
+def parse_version(tag: str) -> Optional[tuple[int, ...]]:
+    """'3.12.4' or 'v3.12.4' to (3, 12, 4), None if the tag isn't a version."""
+    match = VERSION.fullmatch(tag)
+    if match is None:
+        return None
+    return tuple(int(number) for number in match.group(1).split("."))
+
+
+def get_version_sort_key(tag: str) -> tuple:
+    """The versions come after the other tags, like `latest`, and are sorted as
+    versions, 3.12.10 after 3.12.9. The numbers in the other tags are compared as
+    numbers too."""
+    version = parse_version(tag)
+    if version is not None:
+        return (1, version)
+    return (
+        0,
+        [
+            int(part) if index % 2 else part
+            for index, part in enumerate(re.split(r"(\d+)", tag))
+        ],
+    )
+
+
+def is_in_version_range(version: tuple[int, ...], version_range: str) -> bool:
+    """`version_range` is a list of comparators separated by spaces, like
+    '>=3.11 <3.13', '^3.11' or '~3.12'. The version is compared with the numbers
+    given in each comparator only: '<=3.12' includes 3.12.4, '=3.12' is any 3.12.x.
+    """
+    for comparator in version_range.split():
+        match = COMPARATOR.fullmatch(comparator)
+        if match is None:
+            raise ValueError(
+                f"Invalid version range {version_range!r}, expected comparators "
+                f"like '>=3.11 <3.13', '^3.11' or '~3.12'."
+            )
+        operator, bound = match.group(1), parse_version(match.group(2))
+        truncated = version[: len(bound)]
+        if operator == ">=" and not truncated >= bound:
+            return False
+        if operator == "<=" and not truncated <= bound:
+            return False
+        if operator == ">" and not truncated > bound:
+            return False
+        if operator == "<" and not truncated < bound:
+            return False
+        if operator == "=" and truncated != bound:
+            return False
+        if operator in "^~":
+            # the same major version, or the same minor version
+            same_prefix = 1 if operator == "^" or len(bound) == 1 else 2
+            if version < bound or version[:same_prefix] != bound[:same_prefix]:
+                return False
+    return True
+
+
+def get_tag_filter(pattern: str) -> Callable[[str], bool]:
+    if pattern == "":
+        return lambda tag: True
+    if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+        regex = re.compile(pattern[1:-1])
+        return lambda tag: regex.fullmatch(tag) is not None
+    if pattern[0] in "<>=^~":
+        # checked now rather than when the tags are listed
+        is_in_version_range((0,), pattern)
+        return lambda tag: (
+            parse_version(tag) is not None
+            and is_in_version_range(parse_version(tag), pattern)
+        )
+    return lambda tag: fnmatch.fnmatchcase(tag, pattern)
+
+
+class TagSelector:
+    """Selects tags of one or several repositories, like `python:3.12.*`.
+
+    The tag can be a glob (`3.12.*`), a regex between slashes (`/3\\.1[12]-slim/`)
+    or a version range (`>=3.11 <3.13`, `^3.11`, `~3.12`), which only selects the
+    tags which are versions. `#N` at the end keeps the N highest tags, compared like
+    version numbers: `python:3.12.*#3`, `nginx:#5`. The repository can be a glob
+    too, `myteam/*:latest`, its repositories are then listed with the catalog of the
+    registry, which Docker Hub doesn't have.
+    """
+
+    def __init__(self, selector: str):
+        self.selector = selector
+        self.repository, pattern = selector.split(":", 1)
+        self.latest = None
+        match = re.fullmatch(r"(.*)#(\d+)", pattern, re.DOTALL)
+        if match is not None and int(match.group(2)) > 0:
+            pattern, self.latest = match.group(1), int(match.group(2))
+        elif "#" in pattern and not pattern.startswith("/"):
+            raise ValueError(
+                f"Invalid selector {selector!r}, '#' must be followed by the "
+                f"number of tags to keep."
+            )
+        try:
+            self.tag_filter = get_tag_filter(pattern)
+        except re.error as e:
+            raise ValueError(f"Invalid regex in the selector {selector!r}: {e}")
+
+    def get_repositories(self, catalog: list[str]) -> list[str]:
+        if not is_repository_pattern(self.repository):
+            return [self.repository]
+        return [
+            repository
+            for repository in catalog
+            if fnmatch.fnmatchcase(repository, self.repository)
+        ]
+
+    def select(self, tags: list[str]) -> list[str]:
+        tags = sorted(filter(self.tag_filter, tags), key=get_version_sort_key)
+        if self.latest is not None:
+            tags = tags[-self.latest :]
+        return tags
+
+
+def list_tags(dxf_base: DXFBase, repository: str) -> list[str]:
+    # the pages of a repository come one after the other, each one gives the next
+    return DXF.from_base(dxf_base, repository).list_aliases(batch_size=PAGE_SIZE)
+
+
+def expand_docker_images(
+    dxf_base: DXFBase, docker_images: list[str], workers: int
+) -> list[str]:
+    """Replaces the selectors of the list, like `python:3.12.*`, with the docker
+    images they select, see `TagSelector`. The other docker images are kept as they
+    are. The tags of the repositories are listed concurrently, `workers` at a time.
+    """
+    selectors = {
+        docker_image: TagSelector(docker_image)
+        for docker_image in docker_images
+        if is_selector(docker_image)
+    }
+    if not selectors:
+        return docker_images
+    catalog = []
+    if any(is_repository_pattern(s.repository) for s in selectors.values()):
+        catalog = dxf_base.list_repos(batch_size=PAGE_SIZE)
+    repositories = list(
+        dict.fromkeys(
+            repository
+            for selector in selectors.values()
+            for repository in selector.get_repositories(catalog)
+        )
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tags_of_repositories = dict(
+            zip(
+                repositories,
+                executor.map(
+                    lambda repository: list_tags(dxf_base, repository), repositories
+                ),
+            )
+        )
+    expanded = []
+    for docker_image in docker_images:
+        if docker_image not in selectors:
+            expanded.append(docker_image)
+            continue
+        selector = selectors[docker_image]
+        selected = [
+            f"{repository}:{tag}"
+            for repository in selector.get_repositories(catalog)
+            for tag in selector.select(tags_of_repositories[repository])
+        ]
+        if not selected:
+            print(f"Warning: {docker_image} selects no docker image", file=sys.stderr)
+        expanded += selected
+    expanded = list(dict.fromkeys(expanded))
+    print(
+        f"{len(selectors)} selectors, {len(expanded)} docker images in total "
+        f"after listing the tags of {len(repositories)} repositories",
+        file=sys.stderr,
+    )
+    return expanded
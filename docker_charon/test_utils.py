@@ -0,0 +1,19 @@
+import io
+import tarfile
+from typing import Iterable, Mapping, Tuple, Union
+
+
+def make_tar(
+    files: Union[Mapping[str, bytes], Iterable[Tuple[str, bytes]]], mtime: int
+) -> bytes:
+    """A tar of `files`, by name, or (name, content) pairs when a name is repeated."""
+    if isinstance(files, Mapping):
+        files = files.items()
+    tar_content = io.BytesIO()
+    with tarfile.open(fileobj=tar_content, mode="w") as archive:
+        for name, content in files:
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(content)
+            tar_info.mtime = mtime
+            archive.addfile(tar_info, io.BytesIO(content))
+    return tar_content.getvalue()
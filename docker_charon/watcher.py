@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from dxf import DXFBase
+from pydantic import BaseModel
+
+from docker_charon.bandwidth import BandwidthLimit, get_bandwidth_limit, parse_size
+from docker_charon.common import (
+    PYDANTIC_V2,
+    Authenticator,
+    Blob,
+    Manifest,
+    PayloadSide,
+    get_blob_path_in_oci_layout,
+    get_manifest_content_digest,
+    get_manifest_digest,
+    model_to_dict,
+    write_file_atomically,
+)
+from docker_charon.encoder import add_blobs_to_oci_layout, write_payload_zip
+
+WATCH_STATE_PATH = "watch_state.json"
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(duration: str) -> float:
+    """'90s', '30m', '24h', '7d' or '300' to seconds."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhd]?)", duration.strip().lower())
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError(
+            f"Invalid duration {duration!r}, expected something like '30m' or '24h'."
+        )
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+class WatchState(BaseModel):
+    """What the store holds and what was already emitted, kept in the store."""
+
+    # docker image -> digest of the manifest of the latest version in the store
+    latest: Dict[str, str] = {}
+    # docker image -> digests of the manifests already in a payload, the last one
+    # is the version in the destination registry
+    emitted: Dict[str, List[str]] = {}
+    payloads_emitted: int = 0
+    # time.time() of the last payload emitted
+    last_emission: float = 0
+
+    @classmethod
+    def load(cls, store: Path) -> WatchState:
+        state_path = store / WATCH_STATE_PATH
+        if not state_path.exists():
+            return cls()
+        if PYDANTIC_V2:
+            return cls.model_validate_json(state_path.read_bytes())
+        else:
+            return cls.parse_raw(state_path.read_bytes())
+
+    def save(self, store: Path) -> None:
+        write_file_atomically(
+            store / WATCH_STATE_PATH, json.dumps(model_to_dict(self)).encode()
+        )
+
+    def get_pending_images(self) -> list[str]:
+        """The docker images which changed since the last payload."""
+        return [
+            docker_image
+            for docker_image, digest in self.latest.items()
+            if self.emitted.get(docker_image, [None])[-1] != digest
+        ]
+
+
+class Watcher:
+    """Polls the tags of some docker images, pulls the new blobs in a local store
+    (an OCI image layout) as soon as a tag changes, and writes a payload of the
+    changes since the previous payload when it's time.
+    """
+
+    def __init__(
+        self,
+        dxf_base: DXFBase,
+        docker_images: list[str],
+        store: Path,
+        output_directory: Path,
+        workers: int = 4,
+        max_workers: Optional[int] = None,
+        bandwidth: Optional[BandwidthLimit] = None,
+    ):
+        self.dxf_base = dxf_base
+        self.docker_images = docker_images
+        self.store = store
+        self.output_directory = output_directory
+        self.workers = workers
+        self.max_workers = max_workers
+        self.bandwidth = bandwidth
+        self.store.mkdir(parents=True, exist_ok=True)
+        self.output_directory.mkdir(parents=True, exist_ok=True)
+        self.state = WatchState.load(store)
+
+    def read_manifest(self, docker_image: str, digest: str) -> Manifest:
+        manifest_path = self.store / get_blob_path_in_oci_layout(digest)
+        return Manifest(
+            self.dxf_base,
+            docker_image,
+            PayloadSide.ENCODER,
+            manifest_path.read_text(),
+        )
+
+    def get_emitted_manifests(self) -> dict[str, Manifest]:
+        """The manifests already in a payload, under names like
+        `ubuntu:22.04@sha256:...`, the tags may point to other manifests now.
+        """
+        manifests = {}
+        for docker_image, digests in self.state.emitted.items():
+            for digest in digests:
+                name = f"{docker_image}@{digest}"
+                manifests[name] = self.read_manifest(name, digest)
+        return manifests
+
+    def get_emitted_blobs(self) -> list[Blob]:
+        blobs = []
+        for manifest in self.get_emitted_manifests().values():
+            blobs += manifest.get_list_of_blobs()
+        return blobs
+
+    def poll(self) -> list[str]:
+        """Pulls the new versions of the docker images in the store. The digests of
+        the manifests are checked concurrently with HEAD requests, only the
+        manifests which changed are downloaded. Returns the images which changed.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = list(
+                executor.map(
+                    lambda docker_image: get_manifest_digest(
+                        self.dxf_base, docker_image
+                    ),
+                    self.docker_images,
+                )
+            )
+        changed_images = []
+        emitted_blobs = None
+        for docker_image, digest in zip(self.docker_images, digests):
+            if digest is not None and digest == self.state.latest.get(docker_image):
+                continue
+            manifest = Manifest(self.dxf_base, docker_image, PayloadSide.ENCODER)
+            # the tag may have changed since the HEAD request
+            digest = get_manifest_content_digest(manifest.content)
+            if digest == self.state.latest.get(docker_image):
+                continue
+            print(f"{docker_image} changed, it's now {digest}", file=sys.stderr)
+            if emitted_blobs is None:
+                emitted_blobs = self.get_emitted_blobs()
+            add_blobs_to_oci_layout(
+                self.dxf_base,
+                self.store,
+                manifest.get_list_of_blobs(),
+                emitted_blobs,
+                self.workers,
+                max_workers=self.max_workers,
+                bandwidth=self.bandwidth,
+            )
+            # written last, so that the store is consistent if we are interrupted
+            write_file_atomically(
+                self.store / get_blob_path_in_oci_layout(digest),
+                manifest.content.encode(),
+            )
+            self.state.latest[docker_image] = digest
+            self.state.save(self.store)
+            changed_images.append(docker_image)
+        return changed_images
+
+    def get_pending_size(self) -> int:
+        """The number of bytes of new blobs the next payload would have."""
+        digests_emitted = {blob.digest for blob in self.get_emitted_blobs()}
+        sizes = {}
+        for docker_image in self.state.get_pending_images():
+            manifest = self.read_manifest(docker_image, self.state.latest[docker_image])
+            for blob in manifest.get_list_of_blobs():
+                if blob.digest not in digests_emitted:
+                    sizes[blob.digest] = blob.size or 0
+        return sum(sizes.values())
+
+    def emit(self) -> Path:
+        """Writes a payload with the versions of the images which changed since the
+        last payload. The blobs of the previous payloads are not in it.
+        """
+        pending_images = self.state.get_pending_images()
+        emitted_manifests = self.get_emitted_manifests()
+        manifests = dict(emitted_manifests)
+        for docker_image in pending_images:
+            manifests[docker_image] = self.read_manifest(
+                docker_image, self.state.latest[docker_image]
+            )
+        payload_path = (
+            self.output_directory / f"payload-{self.state.payloads_emitted + 1:06d}.zip"
+        )
+        # renamed once complete, so that a complete payload can be picked up as
+        # soon as it appears
+        temporary_path = payload_path.with_name(payload_path.name + ".tmp")
+        write_payload_zip(
+            self.dxf_base,
+            pending_images,
+            list(emitted_manifests),
+            temporary_path,
+            self.workers,
+            self.store,
+            manifests,
+            max_workers=self.max_workers,
+            bandwidth=self.bandwidth,
+        )
+        os.replace(temporary_path, payload_path)
+        for docker_image in pending_images:
+            self.state.emitted.setdefault(docker_image, []).append(
+                self.state.latest[docker_image]
+            )
+        self.state.payloads_emitted += 1
+        self.state.last_emission = time.time()
+        self.state.save(self.store)
+        self.prune()
+        return payload_path
+
+    def prune(self) -> None:
+        """Removes the blobs from the store once they are in a payload, and the ones
+        of versions replaced before being in a payload. The manifests are kept to
+        know what is in the destination registry.
+        """
+        manifests_digests = set(self.state.latest.values())
+        for digests in self.state.emitted.values():
+            manifests_digests.update(digests)
+        manifests_paths = {
+            self.store / get_blob_path_in_oci_layout(digest)
+            for digest in manifests_digests
+        }
+        for blob_path in (self.store / "blobs").glob("*/*"):
+            if blob_path not in manifests_paths:
+                blob_path.unlink()
+
+    def is_time_to_emit(
+        self, emit_interval: Optional[float], emit_size: Optional[int]
+    ) -> bool:
+        if not self.state.get_pending_images():
+            return False
+        if emit_interval is None and emit_size is None:
+            return True
+        if (
+            emit_interval is not None
+            and time.time() - self.state.last_emission >= emit_interval
+        ):
+            return True
+        return emit_size is not None and self.get_pending_size() >= emit_size
+
+
+def watch(
+    docker_images: list[str],
+    store: Union[Path, str],
+    output_directory: Union[Path, str],
+    registry: str = "registry-1.docker.io",
+    secure: bool = True,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    interval: float = 300,
+    emit_interval: Optional[float] = None,
+    emit_size: Union[str, int, None] = None,
+    workers: int = 4,
+    max_workers: Optional[int] = None,
+    max_bandwidth: Union[str, float, None] = None,
+    polls: Optional[int] = None,
+) -> None:
+    """Watches the tags of docker images, and writes incremental payloads of their
+    new versions.
+
+    The tags are checked every `interval` seconds with HEAD requests, which are cheap
+    and don't count in the pull rate limit of Docker Hub. When a tag changes, its new
+    blobs are pulled in `store` right away. A payload with the new versions of all the
+    images which changed is written in `output_directory` when it's time, and only has
+    the blobs which were not in a previous payload. The payloads must be pushed in
+    order. The state is kept in `store`, the watch can be stopped and restarted.
+
+    # Arguments
+        docker_images: The docker images to watch, like with `make_payload`.
+        store: A directory where the new blobs are kept until they are in a payload,
+            as an OCI image layout, and the state of the watch.
+        output_directory: Where the payloads are written, `payload-000001.zip`,
+            `payload-000002.zip`... A payload appears there once it's complete.
+        registry, secure, username, password: The registry to watch, like with
+            `make_payload`.
+        interval: The number of seconds between two checks of the tags.
+        emit_interval: The minimum number of seconds between two payloads. With
+            `emit_size`, a payload is written as soon as one of them is reached. If
+            none of them is given, a payload is written as soon as a tag changes.
+        emit_size: A payload is written as soon as the new blobs reach this size, in
+            bytes or as a string like `"10GB"`.
+        workers, max_workers, max_bandwidth: Like with `make_payload`, for the pulls.
+        polls: The number of checks of the tags before returning. Forever by default.
+    """
+    if isinstance(emit_size, str):
+        emit_size = parse_size(emit_size)
+    authenticator = Authenticator(username, password)
+    with DXFBase(
+        host=registry, auth=authenticator.auth, insecure=not secure
+    ) as dxf_base:
+        watcher = Watcher(
+            dxf_base,
+            docker_images,
+            Path(store),
+            Path(output_directory),
+            workers,
+            max_workers,
+            get_bandwidth_limit(max_bandwidth),
+        )
+        poll_index = 0
+        while polls is None or poll_index < polls:
+            if poll_index > 0:
+                time.sleep(interval)
+            poll_index += 1
+            try:
+                watcher.poll()
+                if watcher.is_time_to_emit(emit_interval, emit_size):
+                    # printed on stdout, for the scripts which move the payloads
+                    print(watcher.emit(), flush=True)
+            except Exception as e:
+                # a daemon keeps going, a watch with a limited number of polls
+                # (e.g. from cron) reports the error
+                if polls is not None:
+                    raise
+                print(
+                    f"The watch failed: {e!r}, retrying in {interval} seconds",
+                    file=sys.stderr,
+                )
@@ -35,3 +35,16 @@ def initialize_local_registry():
     )
     yield
     docker.remove(base_registry, force=True, volumes=True)
+
+
+@pytest.fixture
+def add_destination_registry():
+    destination_registry = docker.run(
+        "registry:2",
+        detach=True,
+        publish=[(5001, 5000)],
+        name="docker-charon-test-registry-destination",
+    )
+    yield
+    print(docker.logs(destination_registry))
+    docker.remove(destination_registry, force=True, volumes=True)
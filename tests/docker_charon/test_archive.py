@@ -0,0 +1,35 @@
+import pytest
+from python_on_whales import docker
+
+from docker_charon.decoder import push_payload
+from docker_charon.encoder import make_payload
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_end_to_end_from_docker_save(tmp_path):
+    # this image is only in the archive, never in a registry
+    docker.tag("localhost:5000/ubuntu:augmented", "ubuntu-archived:augmented")
+    archive_path = tmp_path / "archive.tar"
+    docker.image.save("ubuntu-archived:augmented", output=archive_path)
+
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu-archived:augmented", "busybox:1.24.1"],
+        registry="localhost:5000",
+        secure=False,
+        docker_archives=[archive_path],
+    )
+
+    images_pushed = push_payload(payload_path, registry="localhost:5001", secure=False)
+    assert images_pushed == ["ubuntu-archived:augmented", "busybox:1.24.1"]
+
+    docker.image.remove("ubuntu-archived:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu-archived:augmented",
+            ["cat", "/hello-world.txt"],
+            remove=True,
+        )
+        == "hello-world"
+    )
@@ -0,0 +1,60 @@
+import datetime
+import time
+
+import pytest
+
+from docker_charon.bandwidth import BandwidthLimit, parse_rate, parse_size
+
+
+@pytest.mark.parametrize(
+    "rate, expected",
+    [
+        ("200MB/s", 200 * 10**6),
+        ("1.5GiB/s", 1.5 * 2**30),
+        ("500k", 500 * 10**3),
+        ("1024", 1024),
+        ("unlimited", None),
+    ],
+)
+def test_parse_rate(rate: str, expected):
+    assert parse_rate(rate) == expected
+
+
+@pytest.mark.parametrize("rate", ["fast", "0MB/s", "-1MB/s", "12TB/s"])
+def test_parse_invalid_rate(rate: str):
+    with pytest.raises(ValueError):
+        parse_rate(rate)
+
+
+def test_the_rate_follows_the_schedule():
+    bandwidth = BandwidthLimit.parse("09:00-18:00=50MB/s,22:00-06:00=1GB/s,200MB/s")
+
+    def get_rate_at(hour: int, minute: int = 0):
+        return bandwidth.get_rate(datetime.datetime(2024, 1, 1, hour, minute))
+
+    assert get_rate_at(12) == 50 * 10**6
+    assert get_rate_at(18) == 200 * 10**6
+    assert get_rate_at(23, 30) == 10**9
+    assert get_rate_at(2) == 10**9
+    assert get_rate_at(8, 59) == 200 * 10**6
+
+
+def test_no_limit_outside_of_the_schedule():
+    bandwidth = BandwidthLimit.parse("09:00-18:00=50MB/s")
+    assert bandwidth.get_rate(datetime.datetime(2024, 1, 1, 20)) is None
+
+
+def test_the_transfers_are_slowed_down_to_the_rate():
+    bandwidth = BandwidthLimit(400_000)
+    start = time.monotonic()
+    # the bucket starts empty, 400kB take about one second
+    assert b"".join(bandwidth.throttle(b"x" * 400_000)) == b"x" * 400_000
+    assert 0.8 < time.monotonic() - start < 1.5
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [("500GB", 500 * 10**9), ("1.5TiB", int(1.5 * 2**40)), ("1024", 1024)],
+)
+def test_parse_size(size: str, expected: int):
+    assert parse_size(size) == expected
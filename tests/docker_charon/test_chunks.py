@@ -0,0 +1,43 @@
+import gzip
+import io
+import os
+from zipfile import ZipFile
+
+from docker_charon.chunks import add_chunks_to_zip, read_chunks_from_zip
+from docker_charon.common import Blob
+from docker_charon.delta import recompress_chunks
+from docker_charon.test_utils import make_tar
+
+
+def test_same_files_in_different_layers_are_stored_once():
+    big_file = os.urandom(1_000_000)
+    first_layer = gzip.compress(
+        make_tar([("opt/jdk/lib.so", big_file), ("app/a", os.urandom(1000))], 1),
+        mtime=0,
+    )
+    second_layer = make_tar(
+        [("usr/lib/jdk/lib.so", big_file), ("app/b", os.urandom(200_000))], 2
+    )
+
+    payload = io.BytesIO()
+    chunks_in_zip = set()
+    with ZipFile(payload, "w") as zip_file:
+        blobs_chunks = [
+            add_chunks_to_zip(
+                Blob(None, "sha256:abc", "app"),
+                io.BytesIO(layer),
+                zip_file,
+                chunks_in_zip,
+            )
+            for layer in (first_layer, second_layer)
+        ]
+    assert len(payload.getvalue()) < len(big_file) + 300_000
+
+    with ZipFile(payload) as zip_file:
+        for layer, blob_chunks in zip([first_layer, second_layer], blobs_chunks):
+            rebuilt_layer = b"".join(
+                recompress_chunks(
+                    read_chunks_from_zip(zip_file, blob_chunks), blob_chunks.gzip
+                )
+            )
+            assert rebuilt_layer == layer
@@ -0,0 +1,118 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Union
+
+import pytest
+from pydantic import BaseModel
+
+from docker_charon.common import (
+    PYDANTIC_V2,
+    BlobChunksInZip,
+    BlobLocationInRegistry,
+    BlobPathInZip,
+    PayloadDescriptor,
+    PayloadPart,
+    write_file_atomically,
+)
+
+
+def make_payload_descriptor() -> PayloadDescriptor:
+    return PayloadDescriptor(
+        manifests_paths={"ubuntu:augmented": "manifests/ubuntu:augmented", "a:b": None},
+        blobs_paths={
+            "sha256:aa": BlobPathInZip(zip_path="blobs/sha256:aa"),
+            "sha256:bb": BlobLocationInRegistry(repository="ubuntu"),
+            "sha256:cc": BlobPathInZip(zip_path="somewhere/else"),
+            "sha256:dd": BlobChunksInZip(chunks=["sha256:ee"], gzip=None),
+        },
+    )
+
+
+def test_compact_payload_descriptor_round_trip():
+    payload_descriptor = make_payload_descriptor()
+    content = payload_descriptor.to_json("blobs/{digest}", compact=True)
+    assert json.loads(content)["blobs_paths"]["sha256:aa"] is None
+
+    parsed = PayloadDescriptor.from_json(content)
+    assert parsed.manifests_paths == payload_descriptor.manifests_paths
+    assert dict(parsed.blobs_paths) == payload_descriptor.blobs_paths
+
+
+class PayloadDescriptorOf043(BaseModel):
+    """The payload descriptor read by docker-charon 0.4.3."""
+
+    manifests_paths: Dict[str, Optional[str]]
+    blobs_paths: Dict[str, Union[BlobPathInZip, BlobLocationInRegistry]]
+
+
+def test_payload_descriptor_is_readable_by_older_versions():
+    payload_descriptor = make_payload_descriptor()
+    del payload_descriptor.blobs_paths["sha256:dd"]
+    content = payload_descriptor.to_json("blobs/{digest}")
+    if PYDANTIC_V2:
+        parsed = PayloadDescriptorOf043.model_validate_json(content)
+    else:
+        parsed = PayloadDescriptorOf043.parse_raw(content)
+    assert parsed.manifests_paths == payload_descriptor.manifests_paths
+    assert parsed.blobs_paths == payload_descriptor.blobs_paths
+    assert PayloadDescriptor.from_json(content) == payload_descriptor
+
+
+def test_first_version_of_the_payload_descriptor_is_still_readable():
+    content = json.dumps(
+        {
+            "manifests_paths": {"ubuntu:augmented": "manifests/ubuntu:augmented"},
+            "blobs_paths": {
+                "sha256:aa": {"zip_path": "blobs/sha256:aa"},
+                "sha256:bb": {"repository": "ubuntu"},
+            },
+        },
+        indent=4,
+    )
+    parsed = PayloadDescriptor.from_json(content)
+    assert parsed.blobs_paths == {
+        "sha256:aa": BlobPathInZip(zip_path="blobs/sha256:aa"),
+        "sha256:bb": BlobLocationInRegistry(repository="ubuntu"),
+    }
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_payload_part_round_trip(compact: bool):
+    payload_descriptor = make_payload_descriptor()
+    payload_descriptor.part = PayloadPart.parse("2/3")
+    parsed = PayloadDescriptor.from_json(
+        payload_descriptor.to_json("blobs/{digest}", compact)
+    )
+    assert parsed.part == PayloadPart(index=2, count=3)
+    assert "part" not in json.loads(
+        make_payload_descriptor().to_json("blobs/{digest}", compact)
+    )
+
+
+def test_each_blob_belongs_to_a_single_part():
+    parts = [PayloadPart(index=index, count=3) for index in (1, 2, 3)]
+    digests = [f"sha256:{index:064x}" for index in range(300)]
+    blobs_per_part = [
+        [digest for digest in digests if part.has_blob(digest)] for part in parts
+    ]
+    assert sorted(sum(blobs_per_part, [])) == sorted(digests)
+    # roughly balanced
+    assert all(len(blobs) > 50 for blobs in blobs_per_part)
+
+
+@pytest.mark.parametrize("part", ["0/2", "3/2", "2", "a/b"])
+def test_invalid_payload_part(part: str):
+    with pytest.raises(ValueError):
+        PayloadPart.parse(part)
+
+
+def test_same_file_written_atomically_by_several_threads(tmp_path):
+    path = tmp_path / "blobs" / "sha256" / "aa"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for write in [
+            executor.submit(write_file_atomically, path, b"content") for _ in range(300)
+        ]:
+            write.result()
+    assert path.read_bytes() == b"content"
+    # no temporary file left behind
+    assert list(path.parent.iterdir()) == [path]
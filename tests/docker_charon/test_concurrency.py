@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from docker_charon.concurrency import AdaptiveConcurrency, get_retry_after
+
+
+def make_http_error(status_code: int, headers: dict = {}) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    return requests.HTTPError(response=response)
+
+
+def test_the_concurrency_grows_while_the_throughput_improves_and_is_halved_on_429():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=8)
+    concurrency.on_success(100)
+    concurrency.on_success(100)
+    assert concurrency.limit == 3
+
+    attempts = []
+
+    def throttled_once():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise make_http_error(429, {"Retry-After": "0.1"})
+        return "done"
+
+    assert concurrency.run(throttled_once) == "done"
+    # halved to 1, then increased again by the transfer which succeeded
+    assert concurrency.limit == 2
+    assert attempts[1] - attempts[0] >= 0.1
+
+
+def test_errors_which_are_not_throttling_are_not_retried():
+    concurrency = AdaptiveConcurrency()
+
+    def not_found():
+        raise make_http_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        concurrency.run(not_found)
+    assert concurrency.active == 0
+
+
+def test_no_more_transfers_than_the_limit_at_the_same_time():
+    concurrency = AdaptiveConcurrency(initial=3, maximum=3)
+    active = []
+    lock = threading.Lock()
+
+    def transfer():
+        with lock:
+            active.append(concurrency.active)
+        time.sleep(0.01)
+
+    threads = [
+        threading.Thread(target=concurrency.run, args=(transfer,)) for _ in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(active) == 3
+
+
+def test_the_waiting_transfers_start_by_order_of_priority():
+    concurrency = AdaptiveConcurrency(initial=1, maximum=1)
+    started = []
+    concurrency.acquire()
+    threads = [
+        threading.Thread(
+            target=concurrency.run,
+            args=(started.append, priority),
+            kwargs={"priority": priority},
+        )
+        for priority in (3, 1, 2, 0)
+    ]
+    for thread in threads:
+        thread.start()
+    # all of them wait for the slot taken above
+    while len(concurrency.waiting) < len(threads):
+        time.sleep(0.01)
+    concurrency.release()
+    for thread in threads:
+        thread.join()
+    assert started == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [({}, None), ({"Retry-After": "12"}, 12), ({"Retry-After": "soon"}, None)],
+)
+def test_get_retry_after(headers: dict, expected):
+    assert get_retry_after(make_http_error(429, headers).response) == expected
@@ -1,4 +1,5 @@
 import contextlib
+import io
 import os
 import subprocess
 import sys
@@ -7,27 +8,22 @@ from pathlib import Path
 from zipfile import ZipFile
 
 import pytest
+from dxf import DXFBase
 from python_on_whales import docker
 
 import docker_charon
 from docker_charon.common import PROJECT_ROOT
-from docker_charon.decoder import push_payload
+from docker_charon.decoder import (
+    PayloadZipFile,
+    check_if_the_docker_image_is_in_the_registry,
+    inspect_payload,
+    iter_push_payload,
+    push_payload,
+    push_payload_to_registries,
+)
 from docker_charon.encoder import make_payload
 
 
-@pytest.fixture
-def add_destination_registry():
-    destination_registry = docker.run(
-        "registry:2",
-        detach=True,
-        publish=[(5001, 5000)],
-        name="docker-charon-test-registry-destination",
-    )
-    yield
-    print(docker.logs(destination_registry))
-    docker.remove(destination_registry, force=True, volumes=True)
-
-
 @pytest.mark.usefixtures("add_destination_registry")
 def test_end_to_end_single_image(tmp_path):
     payload_path = tmp_path / "payload.zip"
@@ -342,6 +338,28 @@ def test_image_skipped_is_still_declared_in_the_payload(tmp_path):
     assert set(images_pushed) == {"ubuntu:bionic-20180125", "ubuntu:augmented"}
 
 
+@pytest.mark.usefixtures("add_destination_registry")
+def test_images_with_the_same_manifest_in_the_registry_are_skipped(tmp_path, capsys):
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu:bionic-20180125", "busybox:1.24.1"],
+        registry="localhost:5000",
+        secure=False,
+    )
+    push_payload(payload_path, registry="localhost:5001", secure=False)
+    capsys.readouterr()
+
+    images_pushed = push_payload(payload_path, registry="localhost:5001", secure=False)
+    assert images_pushed == ["ubuntu:bionic-20180125", "busybox:1.24.1"]
+    stderr = capsys.readouterr().err
+    assert (
+        "Skipping busybox:1.24.1, the registry already has the same manifest" in stderr
+    )
+    # not even the blobs are checked
+    assert "blob" not in stderr
+
+
 @pytest.mark.usefixtures("add_destination_registry")
 def test_raise_error_if_image_is_not_here_and_strict(tmp_path):
     payload_path = tmp_path / "payload.zip"
@@ -427,6 +445,284 @@ def test_mounting_layers_from_another_repository(tmp_path):
     )
 
 
+@pytest.mark.usefixtures("add_destination_registry")
+def test_end_to_end_oci_layout(tmp_path):
+    payload_path = tmp_path / "payload"
+    payload_path.mkdir()
+    make_payload(
+        payload_path,
+        ["ubuntu:bionic-20180125"],
+        registry="localhost:5000",
+        secure=False,
+    )
+    assert (payload_path / "oci-layout").exists()
+    assert (payload_path / "index.json").exists()
+    blobs = set((payload_path / "blobs" / "sha256").iterdir())
+    # 6 blobs and the manifest
+    assert len(blobs) == 7
+
+    # the second run only adds the new layer, the config and the manifest
+    make_payload(
+        payload_path,
+        ["ubuntu:augmented"],
+        registry="localhost:5000",
+        secure=False,
+    )
+    new_blobs = set((payload_path / "blobs" / "sha256").iterdir()) - blobs
+    assert len(new_blobs) == 3
+
+    images_loaded = push_payload(payload_path, registry="localhost:5001", secure=False)
+    assert images_loaded == ["ubuntu:augmented"]
+
+    docker.image.remove("localhost:5001/ubuntu:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu:augmented", ["cat", "/hello-world.txt"], remove=True
+        )
+        == "hello-world"
+    )
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_payload_built_in_parts_and_merged(tmp_path):
+    parts_paths = [tmp_path / f"part_{index}.zip" for index in (1, 2)]
+    for index, part_path in enumerate(parts_paths, start=1):
+        make_payload(
+            part_path,
+            ["ubuntu:augmented", "busybox:1.24.1"],
+            registry="localhost:5000",
+            secure=False,
+            part=f"{index}/2",
+        )
+    blobs_in_parts = [
+        {name for name in ZipFile(part_path).namelist() if name.startswith("blobs/")}
+        for part_path in parts_paths
+    ]
+    assert blobs_in_parts[0] and blobs_in_parts[1]
+    assert not blobs_in_parts[0] & blobs_in_parts[1]
+    with pytest.raises(ValueError):
+        push_payload(parts_paths[0], registry="localhost:5001", secure=False)
+
+    payload_path = tmp_path / "payload.zip"
+    docker_charon.merge_payloads(parts_paths[::-1], payload_path)
+    images_loaded = push_payload(payload_path, registry="localhost:5001", secure=False)
+    assert images_loaded == ["ubuntu:augmented", "busybox:1.24.1"]
+
+    docker.image.remove("localhost:5001/ubuntu:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu:augmented", ["cat", "/hello-world.txt"], remove=True
+        )
+        == "hello-world"
+    )
+
+
+@pytest.mark.parametrize("use_cli", [True, False])
+@pytest.mark.usefixtures("add_destination_registry")
+def test_push_only_some_images_of_the_payload(tmp_path, use_cli: bool):
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu:bionic-20180125", "busybox:1.24.1", "ubuntu:augmented"],
+        registry="localhost:5000",
+        secure=False,
+    )
+    images = inspect_payload(payload_path)
+    assert [image.docker_image for image in images] == [
+        "ubuntu:bionic-20180125",
+        "busybox:1.24.1",
+        "ubuntu:augmented",
+    ]
+    assert all(image.blobs == image.blobs_in_payload for image in images)
+
+    if use_cli:
+        images_pushed = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "docker_charon",
+                "push-payload",
+                "--registry=localhost:5001",
+                "--insecure",
+                f"--file={payload_path}",
+                "--exclude=ubuntu:bionic-20180125",
+                "--only=busybox:1.24.1,ubuntu:augmented",
+            ]
+        ).decode()
+        assert images_pushed == "busybox:1.24.1\nubuntu:augmented\n"
+    else:
+        images_pushed = push_payload(
+            payload_path,
+            registry="localhost:5001",
+            secure=False,
+            images=["busybox:1.24.1", "ubuntu:augmented"],
+            exclude=["ubuntu:bionic-20180125"],
+        )
+        assert images_pushed == ["busybox:1.24.1", "ubuntu:augmented"]
+
+    # the excluded image was not pushed
+    with pytest.raises(docker_charon.ManifestNotFound):
+        check_if_the_docker_image_is_in_the_registry(
+            DXFBase("localhost:5001", insecure=True), "ubuntu:bionic-20180125", True
+        )
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_images_are_usable_as_soon_as_they_are_pushed(tmp_path):
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu:augmented", "busybox:1.24.1"],
+        registry="localhost:5000",
+        secure=False,
+    )
+
+    images_pushed = []
+    destination = DXFBase("localhost:5001", insecure=True)
+    for docker_image in iter_push_payload(
+        payload_path, registry="localhost:5001", secure=False, order="smallest"
+    ):
+        check_if_the_docker_image_is_in_the_registry(destination, docker_image, True)
+        images_pushed.append(docker_image)
+    # busybox is much smaller than ubuntu
+    assert images_pushed == ["busybox:1.24.1", "ubuntu:augmented"]
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_push_payload_to_several_registries(tmp_path):
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu:augmented", "busybox:1.24.1"],
+        registry="localhost:5000",
+        secure=False,
+    )
+
+    # the same registry under two names, and a registry which doesn't exist
+    registries = [
+        docker_charon.Registry(host="localhost:5001", secure=False),
+        docker_charon.Registry(host="127.0.0.1:5001", secure=False),
+        docker_charon.Registry(host="localhost:5009", secure=False),
+    ]
+    with pytest.raises(docker_charon.PushFailed) as exc_info:
+        push_payload_to_registries(payload_path, registries)
+    assert list(exc_info.value.errors) == ["localhost:5009"]
+    assert exc_info.value.images_pushed == {
+        "localhost:5001": ["ubuntu:augmented", "busybox:1.24.1"],
+        "127.0.0.1:5001": ["ubuntu:augmented", "busybox:1.24.1"],
+    }
+
+    for image in ["ubuntu:augmented", "busybox:1.24.1"]:
+        check_if_the_docker_image_is_in_the_registry(
+            DXFBase("localhost:5001", insecure=True), image, True
+        )
+
+
+@pytest.mark.parametrize("from_memory", [True, False])
+@pytest.mark.usefixtures("add_destination_registry")
+def test_end_to_end_encrypted_payload(tmp_path, from_memory: bool):
+    payload_path = tmp_path / "payload.zip"
+    if from_memory:
+        payload_stream = io.BytesIO()
+        make_payload(
+            payload_stream,
+            ["ubuntu:augmented"],
+            registry="localhost:5000",
+            secure=False,
+            encryption_key="hunter2",
+        )
+        payload_path.write_bytes(payload_stream.getvalue())
+    else:
+        make_payload(
+            payload_path,
+            ["ubuntu:augmented"],
+            registry="localhost:5000",
+            secure=False,
+            encryption_key="hunter2",
+        )
+
+    def open_the_payload():
+        if from_memory:
+            return io.BytesIO(payload_path.read_bytes())
+        return payload_path
+
+    # nothing is written in plaintext, except the parameters of the encryption
+    with ZipFile(payload_path) as zip_file:
+        assert "encryption.json" in zip_file.namelist()
+        assert b"ubuntu" not in zip_file.read("payload_descriptor.json")
+
+    with pytest.raises(ValueError):
+        push_payload(open_the_payload(), registry="localhost:5001", secure=False)
+    with pytest.raises(docker_charon.PayloadDecryptionError):
+        push_payload(
+            open_the_payload(),
+            registry="localhost:5001",
+            secure=False,
+            encryption_key="wrong",
+        )
+
+    images_pushed = push_payload(
+        open_the_payload(),
+        registry="localhost:5001",
+        secure=False,
+        encryption_key="hunter2",
+    )
+    assert images_pushed == ["ubuntu:augmented"]
+
+    docker.image.remove("localhost:5001/ubuntu:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu:augmented", ["cat", "/hello-world.txt"], remove=True
+        )
+        == "hello-world"
+    )
+
+
+@pytest.mark.parametrize("option", ["delta", "dedup_chunks", "oci_layout"])
+def test_encrypted_payload_without_temporary_files(tmp_path, option: str):
+    payload_path = tmp_path / "payload.zip"
+    options = {}
+    if option == "oci_layout":
+        payload_path = tmp_path / "payload"
+        payload_path.mkdir()
+    else:
+        options[option] = True
+    with pytest.raises(ValueError):
+        make_payload(
+            payload_path,
+            ["ubuntu:augmented"],
+            registry="localhost:5000",
+            secure=False,
+            encryption_key="hunter2",
+            **options,
+        )
+
+
+@pytest.mark.parametrize("from_memory", [True, False])
+def test_payload_zip_file_serves_the_blobs_bytes(tmp_path, from_memory: bool):
+    payload_path = tmp_path / "payload.zip"
+    make_payload(
+        payload_path,
+        ["ubuntu:augmented"],
+        registry="localhost:5000",
+        secure=False,
+    )
+    if from_memory:
+        payload = io.BytesIO(payload_path.read_bytes())
+    else:
+        payload = payload_path
+
+    with PayloadZipFile(payload) as zip_file:
+        for name in zip_file.namelist():
+            with zip_file.open_blob(name) as blob_data:
+                if from_memory:
+                    blob_bytes = b"".join(blob_data)
+                else:
+                    assert isinstance(blob_data, memoryview)
+                    blob_bytes = bytes(blob_data)
+            assert blob_bytes == zip_file.read(name)
+
+
 @contextlib.contextmanager
 def remember_cwd(new_directory):
     curdir = os.getcwd()
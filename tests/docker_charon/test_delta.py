@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import gzip
+import io
+import os
+import struct
+import zlib
+
+import pytest
+
+from docker_charon.delta import (
+    apply_patch,
+    decompress_chunks,
+    find_gzip_parameters,
+    index_tar_files,
+    recompress_chunks,
+    write_patch,
+)
+from docker_charon.test_utils import make_tar
+
+
+@pytest.mark.parametrize("compresslevel", [None, 1, 6, 9])
+def test_delta_rebuilds_the_layer_byte_for_byte(compresslevel):
+    files = {f"usr/lib/file-{i}": os.urandom(100_000) for i in range(10)}
+    base_tar = make_tar(files, mtime=1)
+    files["usr/lib/file-3"] = os.urandom(2_000)
+    files["usr/bin/new-file"] = os.urandom(3_000)
+    target_tar = make_tar(files, mtime=2)
+    if compresslevel is None:
+        target_layer = target_tar
+    else:
+        target_layer = gzip.compress(target_tar, compresslevel, mtime=0)
+
+    gzip_parameters = None
+    if compresslevel is not None:
+        gzip_parameters = find_gzip_parameters(
+            io.BytesIO(target_layer), io.BytesIO(target_tar)
+        )
+        assert gzip_parameters.level == compresslevel
+    patch_file = io.BytesIO()
+    write_patch(
+        index_tar_files(io.BytesIO(base_tar)), io.BytesIO(target_tar), patch_file
+    )
+    assert len(patch_file.getvalue()) < len(target_tar) / 10
+
+    patch_file.seek(0)
+    rebuilt_layer = b"".join(
+        recompress_chunks(
+            apply_patch(patch_file, io.BytesIO(base_tar)), gzip_parameters
+        )
+    )
+    assert rebuilt_layer == target_layer
+
+
+def test_find_gzip_parameters_gives_up_on_other_deflate_implementations():
+    tar_content = make_tar({"file": os.urandom(50_000) * 4}, mtime=1)
+    # a deflate stream that the default strategy of zlib doesn't produce
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, 8, zlib.Z_RLE)
+    compressed = (
+        b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        + compressor.compress(tar_content)
+        + compressor.flush()
+        + struct.pack("<II", zlib.crc32(tar_content), len(tar_content))
+    )
+    assert b"".join(decompress_chunks([compressed])) == tar_content
+    assert find_gzip_parameters(io.BytesIO(compressed), io.BytesIO(tar_content)) is None
@@ -1,17 +1,34 @@
 import json
 import subprocess
 import sys
+from zipfile import ZipFile
 
 import pytest
 from dxf import DXFBase
 
 from docker_charon.encoder import (
     get_manifest_and_list_of_blobs_to_pull,
+    get_manifest_media_type,
     make_payload,
     uniquify_blobs,
 )
 
 
+@pytest.mark.parametrize(
+    "manifest, media_type",
+    [
+        (
+            {"mediaType": "application/vnd.docker.distribution.manifest.v2+json"},
+            "application/vnd.docker.distribution.manifest.v2+json",
+        ),
+        # optional in the OCI image manifests
+        ({"schemaVersion": 2}, "application/vnd.oci.image.manifest.v1+json"),
+    ],
+)
+def test_get_manifest_media_type(manifest: dict, media_type: str):
+    assert get_manifest_media_type(json.dumps(manifest)) == media_type
+
+
 def test_get_manifest_and_list_of_all_blobs():
     dxf_base = DXFBase("localhost:5000", insecure=True)
 
@@ -115,3 +132,22 @@ def test_make_payload_from_opened_file(tmp_path):
 
     assert zip_path.exists()
     assert zip_path.stat().st_size > 1024
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_make_payload_with_concurrent_downloads(tmp_path, workers: int):
+    zip_path = tmp_path / "test.zip"
+    make_payload(
+        zip_path,
+        ["ubuntu:bionic-20180125", "ubuntu:augmented"],
+        registry="localhost:5000",
+        secure=False,
+        workers=workers,
+    )
+
+    with ZipFile(zip_path) as zip_file:
+        # checks the CRC of every member
+        assert zip_file.testzip() is None
+        blobs = [name for name in zip_file.namelist() if name.startswith("blobs/")]
+    # 6 blobs for bionic, plus the config and the new layer of augmented
+    assert len(blobs) == 8
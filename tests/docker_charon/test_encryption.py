@@ -0,0 +1,69 @@
+import pytest
+
+from docker_charon.encryption import (
+    ENCRYPTED_CHUNK_SIZE,
+    PayloadCipher,
+    PayloadDecryptionError,
+    get_cipher,
+)
+
+
+@pytest.fixture(scope="module")
+def cipher() -> PayloadCipher:
+    return PayloadCipher.new("correct horse battery staple")
+
+
+@pytest.mark.parametrize(
+    "size",
+    [
+        0,
+        1,
+        ENCRYPTED_CHUNK_SIZE - 1,
+        ENCRYPTED_CHUNK_SIZE,
+        3 * ENCRYPTED_CHUNK_SIZE + 7,
+    ],
+)
+def test_encryption_round_trip(cipher: PayloadCipher, size: int):
+    content = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+    # the chunks given don't have to be aligned with the encrypted chunks
+    chunks = [content[start : start + 1000] for start in range(0, size, 1000)]
+    encrypted = b"".join(cipher.encrypt("blobs/sha256:abc", chunks))
+    assert len(encrypted) == cipher.get_encrypted_size(size)
+    # a few bytes can be in the random ciphertext by chance
+    assert content not in encrypted or size < 16
+    assert cipher.decrypt_bytes("blobs/sha256:abc", encrypted) == content
+
+
+def test_the_same_content_is_encrypted_differently(cipher: PayloadCipher):
+    assert cipher.encrypt_bytes("a", b"hello") != cipher.encrypt_bytes("a", b"hello")
+
+
+def test_member_truncated_at_a_chunk_boundary_is_detected(cipher: PayloadCipher):
+    encrypted = cipher.encrypt_bytes("a", b"x" * (2 * ENCRYPTED_CHUNK_SIZE))
+    truncated = encrypted[: cipher.get_encrypted_size(ENCRYPTED_CHUNK_SIZE)]
+    with pytest.raises(PayloadDecryptionError):
+        cipher.decrypt_bytes("a", truncated)
+
+
+def test_members_cannot_be_swapped(cipher: PayloadCipher):
+    encrypted = cipher.encrypt_bytes("a", b"hello")
+    with pytest.raises(PayloadDecryptionError):
+        cipher.decrypt_bytes("b", encrypted)
+
+
+def test_wrong_encryption_key(cipher: PayloadCipher):
+    encrypted = cipher.encrypt_bytes("a", b"hello")
+    other_cipher = PayloadCipher("wrong key", cipher.parameters)
+    with pytest.raises(PayloadDecryptionError):
+        other_cipher.decrypt_bytes("a", encrypted)
+
+
+def test_get_cipher(cipher: PayloadCipher):
+    parameters = cipher.parameters.to_json().encode()
+    assert get_cipher(None, None) is None
+    with pytest.raises(ValueError):
+        get_cipher("key", None)
+    with pytest.raises(ValueError):
+        get_cipher(None, parameters)
+    other_cipher = get_cipher("correct horse battery staple", parameters)
+    assert other_cipher.decrypt_bytes("a", cipher.encrypt_bytes("a", b"hi")) == b"hi"
@@ -0,0 +1,77 @@
+import json
+import threading
+
+from docker_charon import manifest_cache
+from docker_charon.common import (
+    get_blob_path_in_oci_layout,
+    get_manifest_content_digest,
+)
+from docker_charon.manifest_cache import ManifestCache
+
+MANIFEST = '{"schemaVersion": 2, "layers": []}'
+
+
+def add_to_cache(cache: ManifestCache, docker_image: str, digest: str) -> None:
+    manifest_path = cache.directory / get_blob_path_in_oci_layout("sha256:aa")
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(MANIFEST)
+    tag_path = cache.get_tag_path(docker_image)
+    tag_path.parent.mkdir(parents=True, exist_ok=True)
+    tag_path.write_text(json.dumps({"digest": digest, "content_digest": "sha256:aa"}))
+
+
+def test_unchanged_tag_is_taken_from_the_cache(tmp_path):
+    cache = ManifestCache(tmp_path, "registry-1.docker.io")
+    add_to_cache(cache, "ubuntu:22.04", "sha256:bb")
+    assert cache.get_cached_content("ubuntu:22.04", "sha256:bb") == MANIFEST
+
+
+def test_changed_tag_is_not_taken_from_the_cache(tmp_path):
+    cache = ManifestCache(tmp_path, "registry-1.docker.io")
+    add_to_cache(cache, "ubuntu:22.04", "sha256:bb")
+    assert cache.get_cached_content("ubuntu:22.04", "sha256:cc") is None
+    # the registry didn't give a digest
+    assert cache.get_cached_content("ubuntu:22.04", None) is None
+    assert cache.get_cached_content("ubuntu:24.04", "sha256:bb") is None
+
+
+def test_tags_of_different_registries_are_not_mixed(tmp_path):
+    add_to_cache(
+        ManifestCache(tmp_path, "registry-1.docker.io"), "ubuntu:22.04", "sha256:bb"
+    )
+    cache = ManifestCache(tmp_path, "localhost:5000")
+    assert cache.get_cached_content("ubuntu:22.04", "sha256:bb") is None
+
+
+def test_tags_with_the_same_manifest_download_it_once(tmp_path, monkeypatch):
+    downloads = []
+    lock = threading.Lock()
+
+    class FakeDXF:
+        @classmethod
+        def from_base(cls, dxf_base, repository):
+            return cls()
+
+        def get_manifest(self, tag):
+            with lock:
+                downloads.append(tag)
+            return MANIFEST
+
+    monkeypatch.setattr(manifest_cache, "DXF", FakeDXF)
+    monkeypatch.setattr(
+        manifest_cache,
+        "get_manifest_digest",
+        lambda dxf_base, docker_image: "sha256:bb",
+    )
+    cache = ManifestCache(tmp_path, "registry-1.docker.io")
+    docker_images = [f"python:3.12.{patch}" for patch in range(20)] + ["python:3.12"]
+    manifests = cache.get_manifests(None, docker_images, workers=8)
+    assert len(downloads) == 1
+    assert {manifest.content for manifest in manifests.values()} == {MANIFEST}
+    manifest_path = tmp_path / get_blob_path_in_oci_layout(
+        get_manifest_content_digest(MANIFEST)
+    )
+    assert list(manifest_path.parent.iterdir()) == [manifest_path]
+    # every tag is in the cache now
+    for docker_image in docker_images:
+        assert cache.get_cached_content(docker_image, "sha256:bb") == MANIFEST
@@ -0,0 +1,84 @@
+import os
+import threading
+
+import pytest
+
+from docker_charon import pipeline
+from docker_charon.pipeline import map_in_order, prefetch
+
+
+@pytest.fixture(autouse=True)
+def several_cores(monkeypatch):
+    # the pipeline is skipped on a single core
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+
+
+def test_prefetch_keeps_the_order():
+    chunks = [str(index).encode() * 1000 for index in range(100)]
+    assert list(prefetch(iter(chunks), depth=3)) == chunks
+
+
+def test_prefetch_reads_in_another_thread():
+    threads = set()
+
+    def produce():
+        for index in range(10):
+            threads.add(threading.get_ident())
+            yield bytes([index])
+
+    assert b"".join(prefetch(produce())) == bytes(range(10))
+    assert threads and threading.get_ident() not in threads
+
+
+def test_prefetch_raises_the_errors_of_the_producer():
+    def produce():
+        yield b"first"
+        raise ConnectionError("the registry went away")
+
+    chunks = prefetch(produce())
+    assert next(chunks) == b"first"
+    with pytest.raises(ConnectionError, match="went away"):
+        next(chunks)
+
+
+def test_prefetch_stops_the_producer_when_the_consumer_stops():
+    produced = []
+    closed = threading.Event()
+
+    def produce():
+        try:
+            for index in range(1000):
+                produced.append(index)
+                yield b"x"
+        finally:
+            closed.set()
+
+    chunks = prefetch(produce(), depth=2)
+    assert next(chunks) == b"x"
+    chunks.close()
+    assert closed.is_set()
+    assert len(produced) < 1000
+
+
+def test_map_in_order():
+    assert list(map_in_order(lambda x: x * 2, iter(range(50)))) == list(
+        range(0, 100, 2)
+    )
+
+
+def test_threads_share_a_single_executor(monkeypatch):
+    monkeypatch.setattr(pipeline, "_executor", None)
+    barrier = threading.Barrier(8)
+    executors = []
+
+    def get_executor():
+        barrier.wait()
+        executors.append(pipeline.get_executor())
+
+    threads = [threading.Thread(target=get_executor) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(executor) for executor in executors}) == 1
+    executors[0].shutdown()
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from docker_charon import profiling
+from docker_charon.profiling import enter_phase, profile
+
+
+def spin(seconds: float) -> None:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_samples_are_split_by_phase(tmp_path):
+    with profile(tmp_path / "profile.folded", interval=0.001) as profiler:
+        enter_phase("planning")
+        spin(0.1)
+        enter_phase("transfer", zip_phase="zip write")
+        # the samples of the other threads are in the current phase too
+        thread = threading.Thread(target=spin, args=(0.1,))
+        thread.start()
+        thread.join()
+    assert set(profiler.get_samples_by_phase()) >= {"planning", "transfer"}
+    for line in (tmp_path / "profile.folded").read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        phase, *functions = stack.split(";")
+        assert phase in {"startup", "planning", "transfer"}
+        assert int(count) > 0
+    # the main thread waiting for the other one is idle
+    assert not any(
+        "join" in function for function in profiler.get_samples_by_function()
+    )
+
+
+def test_enter_phase_without_profiler():
+    enter_phase("planning")
+    assert profiling._profiler is None
@@ -0,0 +1,89 @@
+import subprocess
+import sys
+
+import pytest
+from python_on_whales import docker
+
+from docker_charon.registry_sync import sync
+
+
+@pytest.mark.parametrize("use_cli", [True, False])
+@pytest.mark.usefixtures("add_destination_registry")
+def test_sync_multiple_images(use_cli: bool):
+    if use_cli:
+        images_pushed = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "docker_charon",
+                "sync",
+                "--source-registry=localhost:5000",
+                "--source-insecure",
+                "--registry=localhost:5001",
+                "--insecure",
+                "ubuntu:bionic-20180125,ubuntu:augmented",
+            ]
+        )
+        assert images_pushed.decode() == "ubuntu:bionic-20180125\nubuntu:augmented\n"
+    else:
+        images_pushed = sync(
+            ["ubuntu:bionic-20180125", "ubuntu:augmented"],
+            source_registry="localhost:5000",
+            destination_registry="localhost:5001",
+            source_secure=False,
+            destination_secure=False,
+        )
+        assert images_pushed == ["ubuntu:bionic-20180125", "ubuntu:augmented"]
+
+    docker.image.remove("localhost:5001/ubuntu:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu:augmented", ["cat", "/hello-world.txt"], remove=True
+        )
+        == "hello-world"
+    )
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_sync_with_a_bandwidth_limit():
+    images_pushed = sync(
+        ["ubuntu:augmented"],
+        source_registry="localhost:5000",
+        destination_registry="localhost:5001",
+        source_secure=False,
+        destination_secure=False,
+        max_bandwidth="100MB/s",
+    )
+    assert images_pushed == ["ubuntu:augmented"]
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_sync_mounts_layers_already_transferred():
+    sync(
+        ["ubuntu:bionic-20180125"],
+        source_registry="localhost:5000",
+        destination_registry="localhost:5001",
+        source_secure=False,
+        destination_secure=False,
+    )
+
+    images_pushed = sync(
+        ["ubuntu-other:augmented"],
+        docker_images_already_transferred=["ubuntu:bionic-20180125"],
+        source_registry="localhost:5000",
+        destination_registry="localhost:5001",
+        source_secure=False,
+        destination_secure=False,
+        workers=1,
+    )
+    assert images_pushed == ["ubuntu-other:augmented"]
+
+    docker.image.remove("localhost:5001/ubuntu-other:augmented", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu-other:augmented",
+            ["cat", "/hello-world.txt"],
+            remove=True,
+        )
+        == "hello-world"
+    )
@@ -0,0 +1,13 @@
+from docker_charon.schedule import get_makespan, order_largest_first
+
+
+def test_the_largest_blobs_go_first_and_the_others_keep_their_order():
+    sizes = [("a", 1), ("b", 12), ("c", 3), ("d", 1), ("e", 3)]
+    ordered = order_largest_first(sizes, lambda item: item[1])
+    assert [name for name, _ in ordered] == ["b", "c", "e", "a", "d"]
+
+
+def test_a_big_blob_at_the_end_is_the_long_tail():
+    sizes = [1] * 12 + [12]
+    assert get_makespan(sizes, workers=4) == 15
+    assert get_makespan(sorted(sizes, reverse=True), workers=4) == 12
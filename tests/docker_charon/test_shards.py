@@ -0,0 +1,45 @@
+from pathlib import Path
+
+from docker_charon.shards import get_duplicated_size, get_shard_path, plan_shards
+
+
+def test_images_sharing_layers_are_kept_together():
+    blobs_of_images = {
+        "python:1": {"debian": 50, "python1": 30},
+        "node:1": {"alpine": 10, "node1": 40},
+        "python:2": {"debian": 50, "python2": 30},
+        "node:2": {"alpine": 10, "node2": 40},
+    }
+    shards = plan_shards(blobs_of_images, max_size=120)
+    assert [shard.docker_images for shard in shards] == [
+        ["python:1", "python:2"],
+        ["node:1", "node:2"],
+    ]
+    assert [shard.size for shard in shards] == [110, 90]
+    assert get_duplicated_size(shards) == 0
+
+
+def test_shared_layers_are_duplicated_when_needed():
+    blobs_of_images = {
+        "a:1": {"base": 50, "a": 40},
+        "a:2": {"base": 50, "b": 40},
+        "a:3": {"base": 50, "c": 40},
+    }
+    shards = plan_shards(blobs_of_images, max_size=150)
+    assert all(shard.size <= 150 for shard in shards)
+    assert sorted(sum((shard.docker_images for shard in shards), [])) == [
+        "a:1",
+        "a:2",
+        "a:3",
+    ]
+    assert len(shards) == 2
+    assert get_duplicated_size(shards) == 50
+
+
+def test_image_bigger_than_the_maximum_size_gets_its_own_shard():
+    shards = plan_shards({"big:1": {"big": 200}, "small:1": {"small": 10}}, 100)
+    assert [shard.docker_images for shard in shards] == [["big:1"], ["small:1"]]
+
+
+def test_shard_path():
+    assert get_shard_path("out/payload.zip", 2) == Path("out/payload-2.zip")
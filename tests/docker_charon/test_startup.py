@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import subprocess
+import sys
+
+import pytest
+
+TRANSFER_DEPENDENCIES = {"dxf", "pydantic", "requests", "tqdm"}
+
+RUN_CLI_AND_LIST_MODULES = """
+import runpy
+import sys
+
+sys.argv = ["docker-charon"] + sys.argv[1:]
+try:
+    runpy.run_module("docker_charon", run_name="__main__")
+except SystemExit:
+    pass
+print(",".join(sys.modules), file=sys.stderr)
+"""
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    [
+        ["--help"],
+        ["make-payload", "--help"],
+        ["push-payload", "--help"],
+        ["watch", "--help"],
+    ],
+)
+def test_the_help_does_not_import_the_dependencies_of_the_transfers(
+    arguments: list[str],
+):
+    result = subprocess.run(
+        [sys.executable, "-c", RUN_CLI_AND_LIST_MODULES, *arguments],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set(result.stderr.strip().splitlines()[-1].split(","))
+    assert "typer" in modules
+    assert not modules & TRANSFER_DEPENDENCIES
+
+
+def test_the_public_api_is_imported_on_first_use():
+    import docker_charon
+
+    assert docker_charon.sync.__module__ == "docker_charon.registry_sync"
+    assert docker_charon.watch.__module__ == "docker_charon.watcher"
+    assert docker_charon.make_payload.__module__ == "docker_charon.encoder"
+    assert "push_payload" in dir(docker_charon)
+    with pytest.raises(AttributeError):
+        docker_charon.not_a_function
+
+
+def test_the_orders_of_the_cli_are_the_orders_of_the_decoder():
+    from docker_charon.__main__ import ImagesOrder
+    from docker_charon.decoder import IMAGES_ORDERS
+
+    assert tuple(order.value for order in ImagesOrder) == IMAGES_ORDERS
+
+
+def test_an_unknown_order_is_a_usage_error():
+    result = subprocess.run(
+        [sys.executable, "-m", "docker_charon", "push-payload", "--order", "largest"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "Invalid value" in result.stderr
+    assert "'payload'" in result.stderr and "'smallest'" in result.stderr
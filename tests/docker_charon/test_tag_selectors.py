@@ -0,0 +1,66 @@
+import pytest
+
+from docker_charon.tag_selectors import TagSelector, is_in_version_range, is_selector
+
+TAGS = [
+    "latest",
+    "3.11.9",
+    "3.12.0",
+    "3.12.4",
+    "3.12.10",
+    "3.12-slim",
+    "3.13.0",
+    "v3.12.5",
+]
+
+
+@pytest.mark.parametrize(
+    "docker_image, expected",
+    [
+        ("python:3.12", False),
+        ("library/python:3.12-slim", False),
+        ("python:3.12.*", True),
+        ("python:>=3.11 <3.13", True),
+        ("nginx:#5", True),
+        ("myteam/*:latest", True),
+        ("python", False),
+    ],
+)
+def test_is_selector(docker_image: str, expected: bool):
+    assert is_selector(docker_image) == expected
+
+
+@pytest.mark.parametrize(
+    "selector, expected",
+    [
+        ("python:3.12.*", ["3.12.0", "3.12.4", "3.12.10"]),
+        ("python:/3\\.1[23]\\.0/", ["3.12.0", "3.13.0"]),
+        ("python:>=3.11.5 <3.13", ["3.11.9", "3.12.0", "3.12.4", "v3.12.5", "3.12.10"]),
+        ("python:~3.12", ["3.12.0", "3.12.4", "v3.12.5", "3.12.10"]),
+        ("python:^3.12.4", ["3.12.4", "v3.12.5", "3.12.10", "3.13.0"]),
+        ("python:#3", ["v3.12.5", "3.12.10", "3.13.0"]),
+        ("python:3.12.*#2", ["3.12.4", "3.12.10"]),
+    ],
+)
+def test_select_tags(selector: str, expected: list):
+    assert TagSelector(selector).select(TAGS) == expected
+
+
+@pytest.mark.parametrize(
+    "version, version_range, expected",
+    [
+        ((3, 12, 4), "<=3.12", True),
+        ((3, 13, 0), "<=3.12", False),
+        ((3, 12, 4), "=3.12", True),
+        ((3, 12), ">3.12", False),
+        ((4, 0), "^3.11", False),
+    ],
+)
+def test_version_range(version: tuple, version_range: str, expected: bool):
+    assert is_in_version_range(version, version_range) == expected
+
+
+@pytest.mark.parametrize("selector", ["python:3.12#x", "python:>=three", "python:/(/"])
+def test_invalid_selector(selector: str):
+    with pytest.raises(ValueError):
+        TagSelector(selector)
@@ -0,0 +1,102 @@
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+from dxf import DXFBase
+from python_on_whales import docker
+
+from docker_charon.decoder import push_payload
+from docker_charon.watcher import Watcher, WatchState, parse_duration
+
+
+@pytest.mark.parametrize(
+    "duration, expected", [("90s", 90), ("5m", 300), ("1.5h", 5400), ("300", 300)]
+)
+def test_parse_duration(duration: str, expected: float):
+    assert parse_duration(duration) == expected
+
+
+@pytest.mark.parametrize("duration", ["", "0s", "5 minutes", "-1h"])
+def test_parse_invalid_duration(duration: str):
+    with pytest.raises(ValueError):
+        parse_duration(duration)
+
+
+def test_watch_state_survives_a_restart(tmp_path):
+    state = WatchState.load(tmp_path)
+    state.latest = {"ubuntu:22.04": "sha256:bb", "alpine:3": "sha256:cc"}
+    state.emitted = {"ubuntu:22.04": ["sha256:aa"], "alpine:3": ["sha256:cc"]}
+    state.payloads_emitted = 1
+    state.save(tmp_path)
+
+    state = WatchState.load(tmp_path)
+    assert state.payloads_emitted == 1
+    # alpine:3 didn't change since the last payload
+    assert state.get_pending_images() == ["ubuntu:22.04"]
+
+
+def retag(docker_image: str, new_name: str):
+    docker.tag(f"localhost:5000/{docker_image}", f"localhost:5000/{new_name}")
+    docker.push(f"localhost:5000/{new_name}")
+
+
+def get_blobs_in_payload(payload_path: Path) -> set:
+    with ZipFile(payload_path) as zip_file:
+        return {name for name in zip_file.namelist() if name.startswith("blobs/")}
+
+
+def get_blobs_in_store(store: Path) -> set:
+    return {f"sha256:{path.name}" for path in (store / "blobs" / "sha256").iterdir()}
+
+
+@pytest.mark.usefixtures("add_destination_registry")
+def test_watch_emits_the_changes_since_the_previous_payload(tmp_path):
+    store = tmp_path / "store"
+    output_directory = tmp_path / "payloads"
+    retag("ubuntu:bionic-20180125", "ubuntu:watched")
+    with DXFBase("localhost:5000", insecure=True) as dxf_base:
+        watcher = Watcher(dxf_base, ["ubuntu:watched"], store, output_directory)
+        assert not watcher.is_time_to_emit(None, None)
+        assert watcher.poll() == ["ubuntu:watched"]
+        # the tag didn't change since the previous poll
+        assert watcher.poll() == []
+        assert watcher.is_time_to_emit(None, None)
+        assert watcher.is_time_to_emit(None, 1)
+
+        first_payload = watcher.emit()
+        assert first_payload == output_directory / "payload-000001.zip"
+        first_digest = watcher.state.latest["ubuntu:watched"]
+        # only the manifest is kept, the blobs are in the payload
+        assert get_blobs_in_store(store) == {first_digest}
+        assert not watcher.is_time_to_emit(None, None)
+
+        retag("ubuntu:augmented", "ubuntu:watched")
+        assert watcher.poll() == ["ubuntu:watched"]
+        assert not watcher.is_time_to_emit(3600, 10**12)
+        assert watcher.is_time_to_emit(3600, 1)
+
+        second_payload = watcher.emit()
+        assert second_payload == output_directory / "payload-000002.zip"
+        second_digest = watcher.state.latest["ubuntu:watched"]
+        assert second_digest != first_digest
+        assert get_blobs_in_store(store) == {first_digest, second_digest}
+
+    # the image configuration and the layer added by ubuntu:augmented
+    first_blobs = get_blobs_in_payload(first_payload)
+    second_blobs = get_blobs_in_payload(second_payload)
+    assert len(second_blobs) == 2
+    assert not first_blobs & second_blobs
+
+    for payload_path in [first_payload, second_payload]:
+        images_pushed = push_payload(
+            payload_path, registry="localhost:5001", secure=False
+        )
+        assert images_pushed == ["ubuntu:watched"]
+
+    docker.image.remove("localhost:5001/ubuntu:watched", force=True)
+    assert (
+        docker.run(
+            "localhost:5001/ubuntu:watched", ["cat", "/hello-world.txt"], remove=True
+        )
+        == "hello-world"
+    )